@@ -26,7 +26,11 @@ limitations under the License.
 
  mv MMSplice.pm ~/.vep/Plugins
  pip install mmsplice
- ./vep -i variants.vcf --plugin MMSplice,[intronl_len=100],[intronr_len=100],[acceptor_intronM],[acceptorModelFile],[exonModelFile],[donorModelFile],[donor_intronModelFile]
+ ./vep -i variants.vcf --plugin MMSplice,[intronl_len=100],[intronr_len=100],[acceptor_intronM],[acceptorModelFile],[exonModelFile],[donorModelFile],[donor_intronModelFile],[socket],[socket_timeout]
+
+ # or share one scoring daemon between VEP processes (e.g. with --fork)
+ mmsplice serve --socket /tmp/mmsplice.sock &
+ ./vep -i variants.vcf --fork 4 --plugin MMSplice,100,100,,,,,,/tmp/mmsplice.sock
 
 
 =head1 DESCRIPTION
@@ -38,6 +42,10 @@ limitations under the License.
  The plugin requires MMSplice python package as an external dependency since it wraps mmsplice package as vep plugin.
  Thus, MMSplice package should be installed with `pip install mmsplice`.
  Then, it automatically runs python server in background and analysis variant with python server.
+ If the path of a unix socket is given as the last parameter (or with MMSPLICE_SOCKET environment variable),
+ the plugin connects to a running `mmsplice serve` daemon instead of starting its own python server.
+ The plugin waits for responses of the daemon without timeout, unless a timeout in seconds is given
+ as the next parameter (or with MMSPLICE_SOCKET_TIMEOUT environment variable).
 
  The plugin predicts delta_logit_psi and pathogenicity values of variants in addition to the score of each component, for both reference and variant sequences, such as acceptor_intron, acceptor, exon, donor, and donor_intron.
 
@@ -50,6 +58,8 @@ use strict;
 use warnings;
 use diagnostics;
 use IPC::Open3;
+use IO::Select;
+use IO::Socket::UNIX;
 use List::Util qw(max);
 
 use Bio::EnsEMBL::Variation::Utils::BaseVepPlugin;
@@ -99,22 +109,36 @@ sub init_params {
     $self->{exonM} = shift @$params || "";
     $self->{donorM} = shift @$params || "";
     $self->{donor_intronM} = shift @$params || "";
+    $self->{socket} = shift @$params || $ENV{MMSPLICE_SOCKET} || "";
+    $self->{socket_timeout} = shift @$params || $ENV{MMSPLICE_SOCKET_TIMEOUT} || 0;
 }
 
 sub call_python {
     my ($self, $content, $timeout) = @_;
     $timeout = $timeout || 1;
+    # a shared daemon can answer late because of micro-batching, batches of
+    # other clients or warm-up, so wait without timeout unless one is given
+    $timeout = $self->{socket_timeout} || undef if $self->{socket};
     my $python_stdout = $self->{python_stdout};
     my $python_stdin = $self->{python_stdin};
     my $python_selout = $self->{python_selout};
     my $response_keyword = "MMSPLICE-RESPONSE:";
 
+    # forked VEP processes need their own connection to the daemon
+    if ($self->{socket} && (!defined $self->{socket_pid} || $self->{socket_pid} != $$)) {
+        $self->init_socket();
+        ($python_stdout, $python_stdin, $python_selout) = @{$self}{qw(python_stdout python_stdin python_selout)};
+    }
+
     print $python_stdin "$content\n";
 
     my $result = '';
+    my $responded = 0;
     while($python_selout->can_read($timeout)) {
 
-        chomp($result = <$python_stdout>);
+        my $line = <$python_stdout>;
+        last unless defined $line;
+        chomp($result = $line);
         if ($result eq "")
         {
             next;
@@ -122,17 +146,49 @@ sub call_python {
 
         if(substr($result, 0, length($response_keyword)) eq $response_keyword) {
             $result = substr($result, length($response_keyword), length($result));
+            $responded = 1;
             last;
         }
 
         print "$result\n";
     }
+
+    # a late response would be read as response of the next request,
+    # so the connection is dropped and opened again by the next call
+    if ($self->{socket} && !$responded) {
+        warn("WARNING: no response of mmsplice daemon at $self->{socket}, reconnecting\n");
+        close($python_stdin);
+        delete $self->{socket_pid};
+        return "ERROR:no response";
+    }
     return $result;
 }
 
+sub init_socket {
+    my $self = shift;
+
+    my $socket = IO::Socket::UNIX->new(
+        Type => SOCK_STREAM(),
+        Peer => $self->{socket},
+    ) or die("ERROR: cannot connect to mmsplice daemon at $self->{socket}: $!\n");
+    $socket->autoflush(1);
+
+    my $python_selout = new IO::Select();
+    $python_selout->add($socket);
+
+    $self->{python_selout} = $python_selout;
+    $self->{python_stdin} = $socket;
+    $self->{python_stdout} = $socket;
+    $self->{socket_pid} = $$;
+}
+
 sub init_python {
     my $self = shift;
 
+    if ($self->{socket}) {
+        return $self->init_socket();
+    }
+
     $self->{api_pid} = open3(my $python_stdin, my $python_stdout,  my $python_stderr, "mmsplice run");
 
     my $python_selout = new IO::Select();
@@ -341,6 +397,7 @@ sub get_psi_score {
 
     my $content = qq[{"intronl_len": $self->{overhang_l}, "intronr_len": $self->{overhang_r}, "ref_seq": "$ref_seq", "alt_seq": "$alt_seq"}];
     my $response = $self->call_python($content);
+    return () if substr($response, 0, 6) eq "ERROR:";
 
     my @scores = split(',', $response);
     return @scores;
@@ -358,6 +415,7 @@ sub fetch_seq {
 sub DESTROY {
     my $self = shift;
     kill 2, $self->{api_pid} if (defined $self->{api_pid});
+    close($self->{python_stdin}) if ($self->{socket} && defined $self->{socket_pid} && $self->{socket_pid} == $$);
 }
 
 1;
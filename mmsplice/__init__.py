@@ -18,11 +18,13 @@ from mmsplice.mmsplice import MMSplice, \
     LINEAR_MODEL, \
     LOGISTIC_MODEL,\
     EFFICIENCY_MODEL
+from mmsplice.writers import annotate_vcf
 
 __all__ = [
     'load_model',
     'MMSplice',
     'writeVCF',
+    'annotate_vcf',
     'predict_save',
     'predict_all_table',
     'ACCEPTOR_INTRON',
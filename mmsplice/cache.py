@@ -0,0 +1,110 @@
+import sqlite3
+import hashlib
+import logging
+import numpy as np
+
+logger = logging.getLogger('mmsplice')
+logger.addHandler(logging.NullHandler())
+
+
+# maximum number of keys per query, below the limit of host parameters of
+# older sqlite versions (999)
+MAX_QUERY_KEYS = 500
+
+
+def model_hash(model, spliter=None):
+    '''
+    Hash of model files of mmsplice model and parameters of the
+    SeqSpliter splitting its input sequences.
+
+    Args:
+      model: MMSplice model with `model_files` attribute.
+      spliter: SeqSpliter of sequences, `spliter` of model by default.
+    '''
+    sha = hashlib.sha1()
+    for path in model.model_files:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    spliter = spliter or getattr(model, 'spliter', None)
+    if spliter is not None:
+        params = sorted((k, v) for k, v in vars(spliter).items()
+                        if k != 'pattern_warning')
+        sha.update(repr(params).encode())
+    return sha.hexdigest()
+
+
+class PredictionCache:
+    """
+    On-disk cache of modular predictions of exon-variant pairs in a sqlite
+    database. Predictions are keyed by exon coordinates, overhang,
+    variant and hash of model files and spliter parameters, so the same
+    database can be shared between runs, vcf files and models.
+
+    Args:
+      path: path of sqlite database, created if it does not exist.
+      model: MMSplice model which predictions are cached.
+      spliter: SeqSpliter of sequences of cached predictions,
+        `spliter` of model by default.
+    """
+
+    def __init__(self, path, model, spliter=None):
+        self.path = path
+        self.model_hash = model_hash(model, spliter)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS predictions '
+                          '(model TEXT, key TEXT, scores BLOB, '
+                          'PRIMARY KEY (model, key)) WITHOUT ROWID')
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(annotation, left_overhang, right_overhang, variant):
+        return '%s|%d|%d|%s' % (annotation, left_overhang,
+                                right_overhang, variant)
+
+    def get(self, key):
+        """
+        Returns modular scores of ref and alt sequence as array of
+        10 values or None if the pair is not in cache.
+        """
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """
+        Returns dict of modular scores of ref and alt sequence of keys
+        in cache. Keys are looked up with one query per MAX_QUERY_KEYS
+        keys.
+        """
+        keys = list(dict.fromkeys(keys))
+        scores = dict()
+        for i in range(0, len(keys), MAX_QUERY_KEYS):
+            batch = keys[i:i + MAX_QUERY_KEYS]
+            rows = self.conn.execute(
+                'SELECT key, scores FROM predictions '
+                'WHERE model = ? AND key IN (%s)' % ','.join('?' * len(batch)),
+                [self.model_hash] + batch)
+            for key, blob in rows:
+                scores[key] = np.frombuffer(blob, dtype=np.float64)
+        self.hits += len(scores)
+        self.misses += len(keys) - len(scores)
+        return scores
+
+    def put_many(self, keys, ref_scores, alt_scores):
+        """
+        Store modular scores of ref and alt sequences of pairs.
+        """
+        scores = np.hstack([ref_scores, alt_scores]).astype(np.float64)
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+            [(self.model_hash, k, s.tobytes()) for k, s in zip(keys, scores)])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __str__(self):
+        total = self.hits + self.misses
+        return 'prediction cache: %d hits, %d misses (hit rate %.1f%%)' % (
+            self.hits, self.misses, 100 * self.hits / max(total, 1))
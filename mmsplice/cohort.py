@@ -0,0 +1,248 @@
+import logging
+from tqdm import tqdm
+import numpy as np
+import pandas as pd
+from pybedtools import Interval
+from kipoiseq.extractors import MultiSampleVCF
+
+from mmsplice.utils import Variant, predict_heads, \
+    pyrange_remove_chr_from_chrom_annotation
+from mmsplice.exon_dataloader import ExonVariantSeqExtrator
+from mmsplice.vcf_dataloader import read_exons, subset_exons, \
+    _merge_intervals, _fetch_regions
+from mmsplice.precompute import REF_COLUMNS, ALT_COLUMNS, _unique_exons
+from mmsplice.writers import infer_output_format
+from mmsplice.profiling import stage
+
+logger = logging.getLogger('mmsplice')
+logger.addHandler(logging.NullHandler())
+
+PLOIDY = 2
+
+HAPLOTYPE_COLUMNS = ['exons', 'gene_id', 'gene_name', 'haplotype',
+                     'n_haplotypes', 'n_samples', 'delta_logit_psi'] \
+    + REF_COLUMNS + ALT_COLUMNS
+
+
+def _exon_regions(df_exons):
+    '''
+    Merged regions of sorted exons with overhang and exons in each region.
+    '''
+    for chrom, exons in df_exons.groupby('Chromosome', sort=False):
+        merged = _merge_intervals(exons['Start'].values,
+                                  exons['End'].values)
+        region = np.searchsorted(merged[:, 0], exons['Start'].values,
+                                 'right') - 1
+        for i, (start, end) in enumerate(merged):
+            yield '%s:%d-%d' % (chrom, max(start, 1), end), \
+                exons[region == i]
+
+
+def genotype_alleles(variant):
+    '''
+    Alleles of haplotypes of samples as array of (samples, PLOIDY) and
+    whether genotypes are phased. Missing alleles are reference,
+    haploid calls are on the first haplotype.
+    '''
+    gt = variant.genotype.array()
+    alleles = np.zeros((gt.shape[0], PLOIDY), dtype=np.int16)
+    n = min(gt.shape[1] - 1, PLOIDY)
+    alleles[:, :n] = np.maximum(gt[:, :n], 0)
+    return alleles, gt[:, -1].astype(bool)
+
+
+def _haplotype_variants(records, alleles):
+    # alternative alleles of haplotype, overlapping variants are skipped
+    variants = list()
+    end = 0
+    for v, allele in zip(records, alleles):
+        if allele == 0 or v.POS < end:
+            continue
+        variants.append(Variant(v.CHROM, v.POS, v.REF, [v.ALT[allele - 1]]))
+        end = v.POS + len(v.REF)
+    return variants
+
+
+def _variant_id(v):
+    return "%s:%s:%s:['%s']" % (v.CHROM, v.POS, v.REF, v.ALT[0])
+
+
+class _ExonHaplotypes:
+    # unique haplotypes of an exon in the cohort waiting for inference
+
+    def __init__(self, annotation, exon, haplotypes, inverse, offset):
+        self.annotation = annotation
+        self.exon = exon
+        self.haplotypes = haplotypes
+        self.inverse = inverse
+        self.offset = offset
+
+
+def predict_cohort(model, gtf, fasta_file, vcf_file, overhang=(100, 100),
+                   batch_size=512, genes=None, bed=None, progress=True):
+    '''
+    Sample-aware scoring of a multi-sample vcf. Haplotypes of samples are
+    built from phased genotypes so variants of a haplotype in the same
+    exon are applied together. Identical haplotypes of an exon are scored
+    once, so the cost depends on the number of unique haplotypes rather
+    than the number of samples. Unphased heterozygous genotypes are
+    treated as phased. Requires indexed vcf.
+
+    Args:
+      model: mmsplice model object.
+      gtf: gtf file or 'grch37'/'grch38' for prebuild annotation.
+      fasta_file: fasta file of genome.
+      vcf_file: bgzipped and indexed multi-sample vcf.
+      overhang: overhang of exon to fetch flanking sequence of exon.
+      batch_size: number of sequences per inference batch.
+      genes: only scores exons of genes (see `subset_exons`).
+      bed: only scores exons overlapping regions of bed file.
+      progress: show progress bar.
+
+    Returns:
+      tuple of sample x exon matrix of delta_logit_psi (pd.DataFrame) of
+        the haplotype with largest absolute effect per sample, with
+        columns of exons with at least one alternative haplotype and 0 for
+        samples with reference haplotypes, and table of unique haplotypes
+        of each exon with HAPLOTYPE_COLUMNS.
+    '''
+    vseq_extractor = ExonVariantSeqExtrator(fasta_file)
+    vcf = MultiSampleVCF(vcf_file)
+    samples = list(vcf.samples)
+
+    pr_exons = read_exons(gtf, overhang)
+    if gtf in ('grch37', 'grch38') \
+       and not any(c.startswith('chr') for c in vcf.seqnames):
+        pr_exons = pyrange_remove_chr_from_chrom_annotation(pr_exons)
+    if genes is not None or bed is not None:
+        pr_exons = subset_exons(pr_exons, genes, bed)
+    df_exons = _unique_exons(pr_exons)
+
+    columns = list()
+    haplotype_rows = list()
+    pending = list()
+    seqs = list()
+    overhangs = list()
+    n_unphased = 0
+    n_haplotypes = 0
+
+    def flush():
+        scores = model.predict_many(seqs, overhangs, batch_size)
+        for entry in pending:
+            ref = scores[entry.offset]
+            X_alt = scores[entry.offset + 1:
+                           entry.offset + 1 + len(entry.haplotypes)]
+            X_ref = np.repeat(ref[np.newaxis], len(X_alt), axis=0)
+            effect = predict_heads(X_ref, X_alt)['delta_logit_psi']
+
+            # effect of each haplotype of samples, reference has none
+            hap_effect = np.zeros(entry.inverse.max() + 1)
+            alt_idx = np.array([i for i, _ in entry.haplotypes])
+            hap_effect[alt_idx] = effect
+            sample_effect = hap_effect[entry.inverse].reshape(-1, PLOIDY)
+            strongest = np.abs(sample_effect).argmax(axis=1)
+            columns.append((entry.annotation, sample_effect[
+                np.arange(len(sample_effect)), strongest]))
+
+            counts = np.bincount(entry.inverse)
+            carriers = entry.inverse.reshape(-1, PLOIDY)
+            for j, (i, variants) in enumerate(entry.haplotypes):
+                haplotype_rows.append(
+                    [entry.annotation, entry.exon.gene_id,
+                     entry.exon.gene_name,
+                     ';'.join(_variant_id(v) for v in variants),
+                     counts[i], int((carriers == i).any(axis=1).sum()),
+                     effect[j]] + list(ref) + list(X_alt[j]))
+        del pending[:], seqs[:], overhangs[:]
+
+    regions = _exon_regions(df_exons)
+    if progress:
+        regions = tqdm(regions)
+
+    for region, exons in regions:
+        with stage('read_vcf') as s:
+            records = [v for v in _fetch_regions(vcf, [region])
+                       if v.ALT and v.ALT[0]]
+            s.items = len(records)
+        if not records:
+            continue
+
+        alleles, phased = zip(*map(genotype_alleles, records))
+        alleles = np.stack(alleles)
+        het = (alleles[:, :, 0] != alleles[:, :, 1]) & ~np.stack(phased)
+        n_unphased += int(het.sum())
+
+        pos = np.array([v.POS for v in records])
+        span = np.array([max(len(v.REF), max(len(a) for a in v.ALT))
+                         for v in records])
+
+        for exon in exons.itertuples():
+            # variants overlapping exon with overhang as in pyranges join
+            idx = np.flatnonzero((pos < exon.End) & (pos + span > exon.Start))
+            if len(idx) == 0:
+                continue
+
+            # haplotypes of samples as rows of alleles of variants
+            haps = alleles[idx].transpose(1, 2, 0).reshape(-1, len(idx))
+            uniq, inverse = np.unique(haps, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            alt_haps = np.flatnonzero(uniq.any(axis=1))
+            if len(alt_haps) == 0:
+                continue
+
+            lo, ro = int(exon.left_overhang), int(exon.right_overhang)
+            interval = Interval(exon.Chromosome, exon.Start + lo - 1,
+                                exon.End - ro, strand=exon.Strand)
+            annotation = '%s:%d-%d:%s' % (interval.chrom, interval.start,
+                                          interval.end, exon.Strand)
+            strand_overhang = (ro, lo) if exon.Strand == '-' else (lo, ro)
+
+            haplotypes = list()
+            offset = len(seqs)
+            with stage('extract', len(alt_haps) + 1):
+                seqs.append(vseq_extractor.fasta.extract(Interval(
+                    interval.chrom, interval.start - lo, interval.end + ro,
+                    strand=exon.Strand)).upper())
+                overhangs.append(strand_overhang)
+                for i in alt_haps:
+                    variants = _haplotype_variants(
+                        [records[k] for k in idx], uniq[i])
+                    seqs.append(vseq_extractor.extract(
+                        interval, variants, overhang=(lo, ro)).upper())
+                    overhangs.append(strand_overhang)
+                    haplotypes.append((i, variants))
+
+            n_haplotypes += len(haplotypes)
+            pending.append(_ExonHaplotypes(annotation, exon, haplotypes,
+                                           inverse, offset))
+            if len(seqs) >= batch_size:
+                flush()
+
+    if seqs:
+        flush()
+
+    if n_unphased:
+        logger.warning('%d unphased heterozygous genotypes are treated'
+                       ' as phased.' % n_unphased)
+    logger.info('%d samples scored with %d unique haplotypes of %d exons'
+                % (len(samples), n_haplotypes, len(columns)))
+
+    if columns:
+        annotations, values = zip(*columns)
+        matrix = pd.DataFrame(np.column_stack(values).astype(np.float32),
+                              index=samples, columns=annotations)
+    else:
+        matrix = pd.DataFrame(index=samples, dtype=np.float32)
+    matrix.index.name = 'sample'
+    return matrix, pd.DataFrame(haplotype_rows, columns=HAPLOTYPE_COLUMNS)
+
+
+def write_matrix(matrix, output):
+    '''
+    Writes sample x exon matrix to csv or parquet file (inferred from
+    extension of output).
+    '''
+    if infer_output_format(output) == 'parquet':
+        matrix.reset_index().to_parquet(output, index=False)
+    else:
+        matrix.to_csv(output)
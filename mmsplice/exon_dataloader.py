@@ -1,14 +1,51 @@
 import logging
+import numpy as np
 import pandas as pd
 from pybedtools import Interval
-from concise.preprocessing import encodeDNA
 from kipoi.data import Dataset
 from kipoiseq.extractors import VariantSeqExtractor
 from mmsplice.utils import Variant
+from mmsplice.profiling import stage
 
 logger = logging.getLogger('mmsplice')
 logger.addHandler(logging.NullHandler())
 
+# index of bases in one-hot encoding, -1 for N and -2 for invalid bases
+# number of rows of ExonDataset which cached scores are looked up at once
+CACHE_PREFETCH_ROWS = 10000
+
+_BASE_INDEX = np.full(256, -2, dtype=np.int8)
+_BASE_INDEX[np.frombuffer(b'ACGTN', dtype=np.uint8)] = [0, 1, 2, 3, -1]
+
+
+def encode_seqs(seqs, dtype=np.float32):
+    '''
+    One-hot encodes DNA sequences in bulk with numpy. Output is the same
+    as `encodeDNA`: N is encoded as zeros and sequences are padded with
+    zeros at the end to the longest sequence.
+
+    Args:
+      seqs: list of sequences of ACGTN.
+      dtype: dtype of encoding, float32 as inputs of the models.
+
+    Returns:
+      np.array of (len(seqs), max length, 4).
+    '''
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    tokens = _BASE_INDEX[np.frombuffer(''.join(seqs).encode('ascii'),
+                                       dtype=np.uint8)]
+    if (tokens == -2).any():
+        raise ValueError('Sequences contain bases other than ACGTN.')
+
+    rows = np.repeat(np.arange(len(seqs)), lengths)
+    cols = np.arange(len(tokens)) - np.repeat(np.cumsum(lengths) - lengths,
+                                              lengths)
+    known = tokens >= 0
+    x = np.zeros((len(seqs), lengths.max() if len(seqs) else 0, 4),
+                 dtype=dtype)
+    x[rows[known], cols[known], tokens[known]] = 1
+    return x
+
 
 class ExonVariantSeqExtrator:
     """
@@ -158,10 +195,17 @@ class ExonSplicingMixin:
       endcode: if split sequence, should it be one-hot-encoded.
       overhang: overhang of exon to fetch flanking sequence of exon.
       seq_spliter: SeqSpliter class instance specific how to split seqs.
+
+    Attributes:
+      cache: optional PredictionCache (see `mmsplice.cache`). Sequences of
+        cached pairs are not extracted and their cached scores are in
+        `cached` metadata (nan if not cached). Scores of upcoming pairs
+        are looked up at once with `_prefetch_cache`.
     """
 
     def __init__(self, fasta_file, split_seq=True, encode=True,
                  overhang=(100, 100), seq_spliter=None):
+        self.cache = None
         self.fasta_file = fasta_file
         self.split_seq = split_seq
         self.encode = encode
@@ -169,36 +213,116 @@ class ExonSplicingMixin:
         self.spliter = seq_spliter or SeqSpliter()
         self.vseq_extractor = ExonVariantSeqExtrator(fasta_file)
         self.fasta = self.vseq_extractor.fasta
+        self.n_pairs = 0
+        self.n_unique_pairs = 0
+        self._last_pair = None
+        self._last_inputs = None
+        self._cache_keys = set()
+        self._cache_scores = dict()
+
+    @property
+    def dedup_ratio(self):
+        """
+        Ratio of exon-variant pairs (including pairs read from cache) to
+        pairs which sequences are extracted.
+        """
+        return self.n_pairs / max(self.n_unique_pairs, 1)
+
+    def _cache_key(self, chrom, start, end, strand, overhang, variant):
+        # same key as of `annotation` and `STR` of metadata in `_next`
+        return self.cache.key(
+            '%s:%d-%d:%s' % (chrom, start, end, strand), *overhang,
+            "%s:%s:%s:['%s']" % (variant.CHROM, str(variant.POS),
+                                 variant.REF, variant.ALT[0]))
+
+    def _prefetch_cache(self, keys):
+        """
+        Looks up cached scores of upcoming pairs in one query instead of
+        a query per pair. Pairs not in prefetched keys are looked up
+        one by one.
+
+        Args:
+          keys: cache keys of pairs.
+        """
+        self._cache_keys = set(keys)
+        self._cache_scores = self.cache.get_many(self._cache_keys)
+
+    def _pair_key(self, exon, variant, overhang):
+        return (exon.chrom, exon.start, exon.end, exon.strand,
+                tuple(overhang), variant.POS, variant.REF, variant.ALT[0],
+                self.split_seq, self.encode)
 
     def _next(self, row, exon, variant, overhang=None):
         overhang = overhang or self.overhang
+        strand_overhang = (overhang[1], overhang[0]) \
+            if exon.strand == '-' else overhang
+
+        metadata = {
+            'variant': self._variant_to_dict(variant),
+            'exon': self._exon_to_dict(row, exon, strand_overhang)
+        }
+
+        self.n_pairs += 1
+        if self.cache is not None:
+            key = self.cache.key(metadata['exon']['annotation'],
+                                 *strand_overhang, metadata['variant']['STR'])
+            if key in self._cache_keys:
+                scores = self._cache_scores.get(key)
+            else:
+                scores = self.cache.get(key)
+            if scores is not None:
+                metadata['cached'] = scores
+                return {'inputs': self._cached_inputs(),
+                        'metadata': metadata}
+            metadata['cached'] = np.full(10, np.nan)
+
+        # Exons shared between transcripts are yielded consecutively,
+        # so only sequence of the last pair need to be kept.
+        key = self._pair_key(exon, variant, overhang)
+        if key != self._last_pair:
+            self.n_unique_pairs += 1
+            self._last_inputs = self._next_inputs(exon, variant, overhang)
+            self._last_pair = key
+
+        return {
+            'inputs': self._last_inputs,
+            'metadata': metadata
+        }
+
+    def _cached_inputs(self):
+        # placeholder inputs of pairs which scores are in cache
+        seq = 'N'
+        if self.split_seq:
+            seq = {k: 'N' for k in ['acceptor_intron', 'acceptor', 'exon',
+                                    'donor', 'donor_intron']}
+            if self.encode:
+                seq = self._encode_seq(seq)
+        return {'seq': seq, 'mut_seq': seq}
 
-        seq = self.fasta.extract(Interval(
-            exon.chrom, exon.start - overhang[0],
-            exon.end + overhang[1], strand=exon.strand)).upper()
-        mut_seq = self.vseq_extractor.extract(
-            exon, [variant], overhang=overhang).upper()
+    def _next_inputs(self, exon, variant, overhang):
+        with stage('extract'):
+            seq = self.fasta.extract(Interval(
+                exon.chrom, exon.start - overhang[0],
+                exon.end + overhang[1], strand=exon.strand)).upper()
+            mut_seq = self.vseq_extractor.extract(
+                exon, [variant], overhang=overhang).upper()
 
         if exon.strand == '-':
             overhang = (overhang[1], overhang[0])
 
         if self.split_seq:
-            seq = self.spliter.split(seq, overhang, exon)
-            mut_seq = self.spliter.split(mut_seq, overhang, exon,
-                                         pattern_warning=False)
+            with stage('split'):
+                seq = self.spliter.split(seq, overhang, exon)
+                mut_seq = self.spliter.split(mut_seq, overhang, exon,
+                                             pattern_warning=False)
             if self.encode:
-                seq = self._encode_seq(seq)
-                mut_seq = self._encode_seq(mut_seq)
+                with stage('encode'):
+                    seq = self._encode_seq(seq)
+                    mut_seq = self._encode_seq(mut_seq)
 
         return {
-            'inputs': {
-                'seq': seq,
-                'mut_seq': mut_seq
-            },
-            'metadata': {
-                'variant': self._variant_to_dict(variant),
-                'exon': self._exon_to_dict(row, exon, overhang)
-            }
+            'seq': seq,
+            'mut_seq': mut_seq
         }
 
     def batch_iter(self, batch_size=32, **kwargs):
@@ -207,20 +331,21 @@ class ExonSplicingMixin:
 
         for batch in super().batch_iter(batch_size, **kwargs):
             if encode:
-                batch['inputs']['seq'] = self._encode_batch_seq(
-                    batch['inputs']['seq'])
-                batch['inputs']['mut_seq'] = self._encode_batch_seq(
-                    batch['inputs']['mut_seq'])
+                with stage('encode', len(batch['inputs']['seq']['exon'])):
+                    batch['inputs']['seq'] = self._encode_batch_seq(
+                        batch['inputs']['seq'])
+                    batch['inputs']['mut_seq'] = self._encode_batch_seq(
+                        batch['inputs']['mut_seq'])
 
             yield batch
 
         self.encode = encode
 
     def _encode_batch_seq(self, batch):
-        return {k: encodeDNA(v.tolist()) for k, v in batch.items()}
+        return {k: encode_seqs(v.tolist()) for k, v in batch.items()}
 
     def _encode_seq(self, seq):
-        return {k: encodeDNA([v]) for k, v in seq.items()}
+        return {k: encode_seqs([v]) for k, v in seq.items()}
 
     def _variant_to_dict(self, variant):
         return {
@@ -252,11 +377,13 @@ class ExonSplicingMixin:
 class ExonDataset(ExonSplicingMixin, Dataset):
     """
     Dataloader to run mmsplice on specific set of variant-exon pairs
-    provided by csv file.
+    provided by csv file or in memory (see `from_dataframe` and
+    `from_arrays`).
 
     Args:
-        exon_file: csv file specify exon-variant pairs with required
-        columns of ('chrom', 'start', 'end', 'strand', 'pos', 'ref', 'alt')
+        exon_file: csv file or pd.DataFrame specify exon-variant pairs with
+        required columns of
+        ('chrom', 'start', 'end', 'strand', 'pos', 'ref', 'alt')
         and optional columns of
         ('exon_id', 'gene_id', 'gene_name', 'transcript_id').
         fasta_file: fasta file to fetch exon sequences.
@@ -293,19 +420,70 @@ class ExonDataset(ExonSplicingMixin, Dataset):
                  overhang=(100, 100), seq_spliter=None, **kwargs):
 
         super().__init__(fasta_file, split_seq, encode, overhang, seq_spliter)
-        self.exon_file = exon_file
-        self.exons = self.read_exon_file(exon_file, **kwargs)
+        if isinstance(exon_file, pd.DataFrame):
+            self.exon_file = None
+            self.exons = self.standardize_exons(exon_file)
+        else:
+            self.exon_file = exon_file
+            self.exons = self.read_exon_file(exon_file, **kwargs)
         self._check_chrom_annotation()
+        self._cache_rows = range(0)
+
+    @classmethod
+    def from_dataframe(cls, df, fasta_file, **kwargs):
+        """
+        Dataloader of exon-variant pairs in pd.DataFrame with columns as in
+        csv file. Columns are renamed with `exon_cols_mapping` without
+        copying their data, the given pd.DataFrame is not modified.
+
+        Args:
+          df: pd.DataFrame of exon-variant pairs.
+          fasta_file: fasta file to fetch exon sequences.
+          kwargs: arguments of ExonDataset.
+        """
+        return cls(df, fasta_file, **kwargs)
+
+    @classmethod
+    def from_arrays(cls, arrays, fasta_file, **kwargs):
+        """
+        Dataloader of exon-variant pairs given as arrays of columns.
+        Arrays are used as columns without copying.
+
+        Args:
+          arrays: dict of column name to array or list, names as columns
+            of csv file such as
+            {'chrom': [...], 'start': [...], 'end': [...], 'strand': [...],
+             'pos': [...], 'ref': [...], 'alt': [...]}.
+          fasta_file: fasta file to fetch exon sequences.
+          kwargs: arguments of ExonDataset.
+        """
+        # copy=False keeps each array as its own block instead of
+        # consolidating arrays of the same dtype into a copied block
+        return cls(pd.DataFrame(arrays, copy=False), fasta_file, **kwargs)
 
     @staticmethod
     def read_exon_file(exon_file, **kwargs):
-        df = pd.read_csv(exon_file, **kwargs) \
-               .rename(columns=ExonDataset.exon_cols_mapping)
-        df['CHROM'] = df['CHROM'].astype('str')
+        return ExonDataset.standardize_exons(pd.read_csv(exon_file, **kwargs))
+
+    @staticmethod
+    def standardize_exons(df):
+        """
+        Renames columns of exon-variant pairs with `exon_cols_mapping` and
+        checks required columns. Columns are not copied, only chromosome
+        names are replaced by a new column if they need to be converted
+        to str.
+        """
+        df = df.rename(columns=ExonDataset.exon_cols_mapping, copy=False)
         missing_cols = [c for c in ExonDataset.required_cols
                         if c not in df.columns]
         assert len(missing_cols) == 0, \
             'Required columns "%s" are missings' % missing_cols
+        if not all(isinstance(c, str) for c in df['CHROM'].unique()):
+            # replaces the column of the renamed frame, so neither other
+            # columns are copied (as by `assign`) nor values shared with
+            # the given frame are converted in place
+            df.insert(df.columns.get_loc('CHROM'), 'CHROM',
+                      df.pop('CHROM').astype(str))
         return df
 
     def _check_chrom_annotation(self):
@@ -316,7 +494,23 @@ class ExonDataset(ExonSplicingMixin, Dataset):
             raise ValueError(
                 'Fasta chrom names do not match with vcf chrom names')
 
+    def _prefetch_rows(self, idx):
+        # prefetch cached scores of rows from idx on
+        rows = range(idx, min(idx + CACHE_PREFETCH_ROWS, len(self)))
+        df = self.exons.iloc[rows.start:rows.stop]
+        overhang = self.overhang
+        self._prefetch_cache(
+            self._cache_key(chrom, start - 1, end, strand,
+                            overhang[::-1] if strand == '-' else overhang,
+                            Variant(chrom, pos, ref, [alt]))
+            for chrom, start, end, strand, pos, ref, alt in zip(
+                df['CHROM'], df['Exon_Start'], df['Exon_End'], df['strand'],
+                df['POS'], df['REF'], df['ALT']))
+        self._cache_rows = rows
+
     def __getitem__(self, idx):
+        if self.cache is not None and idx not in self._cache_rows:
+            self._prefetch_rows(idx)
         row = self.exons.iloc[idx]
         exon = Interval(row['CHROM'], row['Exon_Start'] - 1,
                         row['Exon_End'], strand=row['strand'])
@@ -1,13 +1,128 @@
+import os
 import sys
 import json
+import time
+import logging
 
-import click
-import numpy as np
-from keras import backend as K
 
-from mmsplice import MMSplice
-from mmsplice.exon_dataloader import SeqSpliter
-from mmsplice.utils import predict_deltaLogitPsi, predict_pathogenicity
+def _process_start():
+    '''
+    Wall time of start of the process, so imports of the interpreter and
+    of mmsplice (keras and tensorflow) are included in time to ready.
+    Time of this import if process start time is not available.
+    '''
+    try:
+        with open('/proc/self/stat') as f:
+            # fields after the command name, which may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        started = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return time.time() - (uptime - started)
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+_START = _process_start()
+
+import click  # noqa: E402
+
+from mmsplice.server import load_model, ScoringServer, \
+    RESPONSE_KEYWORD, FROZEN_READY_TARGET  # noqa: E402
+from mmsplice.mmsplice import FrozenMMSplice  # noqa: E402
+
+logger = logging.getLogger('mmsplice')
+
+
+def _ready(model=None):
+    sys.stdout.write(RESPONSE_KEYWORD + '1\n')
+    sys.stdout.flush()
+    elapsed = time.time() - _START
+    logger.info('Ready in %.2f s after start' % elapsed)
+    if isinstance(model, FrozenMMSplice) and elapsed > FROZEN_READY_TARGET:
+        logger.warning('Start up from frozen graph took longer than'
+                       ' target of %d s' % FROZEN_READY_TARGET)
+
+
+def model_options(func):
+    '''
+    Options of model files shared by commands.
+    '''
+    options = [
+        click.option('--acceptor_intronM', 'acceptor_intronM', default='',
+                     help='acceptor intron model file.'),
+        click.option('--acceptorM', 'acceptorM', default='',
+                     help='acceptor model file.'),
+        click.option('--exonM', 'exonM', default='',
+                     help='exon model file.'),
+        click.option('--donorM', 'donorM', default='',
+                     help='donor model file.'),
+        click.option('--donor_intronM', 'donor_intronM', default='',
+                     help='donor intron model file.')
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def thread_options(func):
+    '''
+    Options of threading of inference shared by commands.
+    '''
+    options = [
+        click.option('--intra-op-threads', 'intra_op_threads', type=int,
+                     help='Threads of tensorflow within an operation'
+                     ' (all cores by default).'),
+        click.option('--inter-op-threads', 'inter_op_threads', type=int,
+                     help='Threads of tensorflow running independent'
+                     ' operations (all cores by default).')
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def _parse_ints(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return [int(i) for i in value.split(',')]
+    except ValueError:
+        raise click.BadParameter('needs to be comma separated integers')
+
+
+def _parse_genes(ctx, param, value):
+    if value is None:
+        return None
+    if os.path.isfile(value):
+        with open(value) as f:
+            return [line.strip() for line in f if line.strip()]
+    return [g.strip() for g in value.split(',') if g.strip()]
+
+
+def _parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        i, n = map(int, value.split('/'))
+    except ValueError:
+        raise click.BadParameter('shard needs to be in format of i/N')
+    if not 0 <= i < n:
+        raise click.BadParameter('shard index i needs to be in [0, N)')
+    return i, n
+
+
+def _parse_region(ctx, param, value):
+    # chrom or chrom:start-end (1-based, inclusive) to zero-based interval
+    chrom, _, interval = value.rpartition(':')
+    if not chrom:
+        return value, 0, None
+    try:
+        start, end = map(int, interval.replace(',', '').split('-'))
+    except ValueError:
+        raise click.BadParameter('region needs to be in format of'
+                                 ' chrom or chrom:start-end')
+    return chrom, start - 1, end
 
 
 @click.group()
@@ -16,36 +131,365 @@ def cli():
 
 
 @cli.command(name='run')
-def run():
-    options = json.loads(sys.stdin.readline().strip())
+@click.option('--cache-size', default=100000, show_default=True,
+              help='Maximum number of sequences in score cache'
+              ' (0 to disable).')
+def run(cache_size):
+    '''
+    Scoring server for the VEP plugin. Reads json lines from stdin.
+    The first line is model options. Each following line is either
+    a record (json object) or a batch of records (json array).
+    One response line is written per record in the order of records.
+    Options line may contain `frozen` path of frozen graph written by
+    `mmsplice freeze` (or set `MMSPLICE_FROZEN`) for faster start, and
+    `intra_op_threads` and `inter_op_threads` of tensorflow.
+    Modular scores of repeated sequences (such as ref sequence of an exon)
+    are cached. Latency percentiles of requests and cache hits are logged
+    to stderr at the end.
+    '''
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    options = json.loads(sys.stdin.buffer.readline().decode().strip())
+    model = load_model(options)
+    server = ScoringServer(model, cache_size=cache_size)
 
-    K.clear_session()
-    psi_model = MMSplice(
-        **{k: v for k, v in options.items() if v})
-    psi_model.spliter = SeqSpliter(pattern_warning=False)
+    _ready(model)
+    server.serve_stdio()
 
-    # warms up the model
-    psi_model.predict("A" * 100, (4, 4))
 
-    sys.stdout.write('MMSPLICE-RESPONSE:' + '1\n')
-    sys.stdout.flush()
+@cli.command(name='serve')
+@click.option('--socket', 'socket_path', required=True,
+              help='Path of unix domain socket to listen on.')
+@click.option('--max-batch-size', default=512, show_default=True,
+              help='Maximum number of records scored in one micro batch.')
+@click.option('--max-latency', default=0.01, show_default=True,
+              help='Maximum seconds to wait for other requests'
+              ' to fill a micro batch.')
+@click.option('--cache-size', default=100000, show_default=True,
+              help='Maximum number of sequences in score cache'
+              ' (0 to disable).')
+@click.option('--frozen', default='',
+              help='Frozen graph of model written by `mmsplice freeze`'
+              ' which loads faster than keras models.')
+@model_options
+@thread_options
+def serve(socket_path, max_batch_size, max_latency, cache_size, **options):
+    '''
+    Long-lived scoring daemon shared by many clients (such as VEP forks).
+    Clients connect to the unix socket and send requests of the `run`
+    protocol without the model options line. Latency percentiles of
+    requests and cache hits are logged to stderr on shutdown
+    (SIGINT or SIGTERM).
+    '''
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    model = load_model(options)
+    server = ScoringServer(model,
+                           max_batch_size=max_batch_size,
+                           max_latency=max_latency,
+                           cache_size=cache_size)
+    server.serve_unix(socket_path, ready=lambda: _ready(model))
+
+
+@cli.command(name='predict')
+@click.option('--gtf', required=True,
+              help='gtf file or grch37/grch38 for prebuild annotation.')
+@click.option('--fasta', required=True, help='fasta file of genome.')
+@click.option('--vcf', required=True, help='vcf file of variants.')
+@click.option('--out', required=True,
+              help='Output file of predictions (.csv, .parquet, .arrow).')
+@click.option('--batch-size', default=512, show_default=True,
+              help='Batch size of prediction.')
+@click.option('--workers', default=1, show_default=True,
+              help='Number of worker processes.')
+@click.option('--shard', callback=_parse_shard,
+              help='Only predict i-th of N shards of vcf batches'
+              ' (0-based) such as 0/10.')
+@click.option('--region',
+              help='Only predict variants in region such as'
+              ' 17:41196000-41277000. Requires indexed vcf.')
+@click.option('--format', 'output_format',
+              type=click.Choice(['csv', 'parquet', 'arrow']),
+              help='Output format, inferred from extension of --out'
+              ' by default.')
+@click.option('--pathogenicity', is_flag=True,
+              help='Add pathogenicity prediction.')
+@click.option('--efficiency', 'splicing_efficiency', is_flag=True,
+              help='Add splicing efficiency prediction.')
+@click.option('--overhang', nargs=2, type=int, default=(100, 100),
+              show_default=True,
+              help='Overhang of exon into left and right intron.')
+@click.option('--vcf-batch-size', default=10000, show_default=True,
+              help='Number of variants read from vcf at once,'
+              ' unit of sharding.')
+@click.option('--progress/--no-progress', default=True,
+              help='Show progress bar.')
+@click.option('--resume', is_flag=True,
+              help='Resume interrupted run with the same options from'
+              ' its checkpoint (csv and arrow output).')
+@click.option('--cache',
+              help='sqlite database to cache predictions across runs.')
+@click.option('--profile',
+              help='Write json report of time, calls and items/s per stage'
+              ' and peak memory to this file.')
+@click.option('--genes', callback=_parse_genes,
+              help='Only predict variants of exons of genes such as'
+              ' BRCA1,ENSG00000139618 (gene ids, gene names or transcript'
+              ' ids), or file with one gene per line.')
+@click.option('--bed',
+              help='Only predict variants of exons overlapping regions'
+              ' of bed file.')
+@click.option('--min-delta-logit-psi', type=float,
+              help='Only write predictions with absolute delta_logit_psi'
+              ' at least this.')
+@click.option('--min-pathogenicity', type=float,
+              help='Only write predictions with pathogenicity'
+              ' at least this.')
+@click.option('--top-k', type=int,
+              help='Only write k exons with largest absolute'
+              ' delta_logit_psi per variant.')
+@click.option('--pin-cpus', is_flag=True,
+              help='Pin each worker to its own group of cores.')
+@model_options
+@thread_options
+def predict(gtf, fasta, vcf, out, batch_size, workers, shard, region,
+            output_format, pathogenicity, splicing_efficiency, overhang,
+            vcf_batch_size, progress, resume, cache, profile, genes, bed,
+            min_delta_logit_psi, min_pathogenicity, top_k, pin_cpus,
+            intra_op_threads, inter_op_threads, **options):
+    '''
+    Predict variant effects of vcf and write predictions to a file.
+    Progress of csv and arrow outputs is checkpointed in `OUT.checkpoint`
+    so killed jobs can continue with `--resume`. With --genes or --bed,
+    only regions of their exons are read from indexed vcf. Setting environment
+    variable MMSPLICE_PROFILE=1 has the same effect as
+    `--profile OUT.profile.json`. With several workers, cores are divided
+    between workers unless --intra-op-threads is given
+    (see `mmsplice tune`).
+    '''
+    from mmsplice.predict import predict_vcf
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    predict_vcf(gtf, fasta, vcf, out, batch_size=batch_size,
+                workers=workers, shard=shard, region=region,
+                output_format=output_format, pathogenicity=pathogenicity,
+                splicing_efficiency=splicing_efficiency,
+                overhang=tuple(overhang), vcf_batch_size=vcf_batch_size,
+                model_options={k: v for k, v in options.items() if v},
+                progress=progress, resume=resume, cache=cache,
+                profile=profile, genes=genes, bed=bed,
+                min_delta_logit_psi=min_delta_logit_psi,
+                min_pathogenicity=min_pathogenicity, top_k=top_k,
+                intra_op_threads=intra_op_threads,
+                inter_op_threads=inter_op_threads, pin_cpus=pin_cpus)
+
+
+@cli.command(name='precompute')
+@click.option('--gtf', required=True,
+              help='gtf file or grch37/grch38 for prebuild annotation.')
+@click.option('--fasta', required=True, help='fasta file of genome.')
+@click.option('--out', required=True,
+              help='Output directory of score table.')
+@click.option('--batch-size', default=512, show_default=True,
+              help='Batch size of prediction.')
+@click.option('--overhang', nargs=2, type=int, default=(100, 100),
+              show_default=True,
+              help='Overhang of exon into left and right intron.')
+@click.option('--progress/--no-progress', default=True,
+              help='Show progress bar.')
+@model_options
+@thread_options
+def precompute(gtf, fasta, out, batch_size, overhang, progress, **options):
+    '''
+    Score every possible SNV within the overhang of every exon and write
+    a score table indexed by exon for `mmsplice lookup`.
+    '''
+    from mmsplice.mmsplice import MMSplice
+    from mmsplice.precompute import precompute_snvs
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    model = MMSplice(**{k: v for k, v in options.items() if v})
+    precompute_snvs(model, gtf, fasta, out, overhang=tuple(overhang),
+                    batch_size=batch_size, progress=progress)
+
+
+@cli.command(name='lookup')
+@click.option('--table', required=True,
+              help='Score table written by `mmsplice precompute`.')
+@click.option('--vcf', required=True, help='vcf file of variants.')
+@click.option('--out', required=True,
+              help='Output file of predictions (.csv, .parquet, .arrow).')
+@click.option('--gtf',
+              help='gtf file of the table to score indels with the model.')
+@click.option('--fasta', help='fasta file of genome to score indels.')
+@click.option('--format', 'output_format',
+              type=click.Choice(['csv', 'parquet', 'arrow']),
+              help='Output format, inferred from extension of --out'
+              ' by default.')
+@click.option('--pathogenicity', is_flag=True,
+              help='Add pathogenicity prediction.')
+@click.option('--efficiency', 'splicing_efficiency', is_flag=True,
+              help='Add splicing efficiency prediction.')
+@click.option('--overhang', nargs=2, type=int, default=(100, 100),
+              show_default=True,
+              help='Overhang of exon of the table.')
+@model_options
+def lookup(table, vcf, out, gtf, fasta, output_format, pathogenicity,
+           splicing_efficiency, overhang, **options):
+    '''
+    Predict variants of vcf with scores of SNVs looked up in score table.
+    Other variants (indels) are scored with the model if --gtf and
+    --fasta are given, otherwise they are skipped.
+    '''
+    from mmsplice.precompute import lookup_vcf
+    from mmsplice.writers import table_writer
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    model = None
+    options = {k: v for k, v in options.items() if v}
+    if options:
+        from mmsplice.mmsplice import MMSplice
+        model = MMSplice(**options)
+    with table_writer(out, output_format) as writer:
+        for df in lookup_vcf(table, vcf, gtf, fasta, model=model,
+                             pathogenicity=pathogenicity,
+                             splicing_efficiency=splicing_efficiency,
+                             overhang=tuple(overhang)):
+            writer.write(df)
+
+
+@cli.command(name='cohort')
+@click.option('--gtf', required=True,
+              help='gtf file or grch37/grch38 for prebuild annotation.')
+@click.option('--fasta', required=True, help='fasta file of genome.')
+@click.option('--vcf', required=True,
+              help='bgzipped and indexed multi-sample vcf.')
+@click.option('--out', required=True,
+              help='Output file of sample x exon matrix of delta_logit_psi'
+              ' (.csv, .parquet).')
+@click.option('--haplotypes',
+              help='Output csv file of unique haplotypes of exons'
+              ' with modular scores.')
+@click.option('--batch-size', default=512, show_default=True,
+              help='Batch size of prediction.')
+@click.option('--overhang', nargs=2, type=int, default=(100, 100),
+              show_default=True,
+              help='Overhang of exon into left and right intron.')
+@click.option('--genes', callback=_parse_genes,
+              help='Only score exons of genes, comma separated'
+              ' or file with one gene per line.')
+@click.option('--bed', help='Only score exons overlapping regions'
+              ' of bed file.')
+@click.option('--progress/--no-progress', default=True,
+              help='Show progress bar.')
+@model_options
+@thread_options
+def cohort(gtf, fasta, vcf, out, haplotypes, batch_size, overhang, genes,
+           bed, progress, **options):
+    '''
+    Score haplotypes of samples of a phased multi-sample vcf and write
+    sample x exon matrix of delta_logit_psi. Identical haplotypes are
+    scored once.
+    '''
+    from mmsplice.mmsplice import MMSplice
+    from mmsplice.cohort import predict_cohort, write_matrix
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    model = MMSplice(**{k: v for k, v in options.items() if v})
+    matrix, df_haplotypes = predict_cohort(
+        model, gtf, fasta, vcf, overhang=tuple(overhang),
+        batch_size=batch_size, genes=genes, bed=bed, progress=progress)
+    write_matrix(matrix, out)
+    if haplotypes:
+        df_haplotypes.to_csv(haplotypes, index=False)
+
+
+@cli.command(name='tune')
+@click.option('--gtf', required=True,
+              help='gtf file or grch37/grch38 for prebuild annotation.')
+@click.option('--fasta', required=True, help='fasta file of genome.')
+@click.option('--vcf',
+              help='vcf file of variants, synthetic variants around exons'
+              ' by default.')
+@click.option('--n-variants', default=1000, show_default=True,
+              help='Number of synthetic variants.')
+@click.option('--intra-op-threads', callback=_parse_ints,
+              help='Comma separated threads within an operation to try,'
+              ' powers of two up to number of cores by default.')
+@click.option('--inter-op-threads', callback=_parse_ints, default='1,2',
+              show_default=True,
+              help='Comma separated threads of independent operations'
+              ' to try.')
+@click.option('--batch-sizes', callback=_parse_ints,
+              default='64,128,256,512', show_default=True,
+              help='Comma separated batch sizes to try.')
+@click.option('--out', help='Write results as csv to this file.')
+@model_options
+def tune(gtf, fasta, vcf, n_variants, intra_op_threads, inter_op_threads,
+         batch_sizes, out, **options):
+    '''
+    Measure inference throughput of thread counts and batch sizes and
+    report the best configuration for `mmsplice predict`. Run it with
+    the cores a worker gets on the node, such as with taskset.
+    '''
+    from mmsplice.tune import tune_threads
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    df = tune_threads(gtf, fasta, vcf, n_variants=n_variants,
+                      intra_op_threads=intra_op_threads,
+                      inter_op_threads=inter_op_threads,
+                      batch_sizes=batch_sizes,
+                      model_options={k: v for k, v in options.items() if v})
+    if out:
+        df.to_csv(out, index=False)
+    click.echo(df.to_string(index=False))
+    best = df.iloc[0]
+    click.echo('Best: --intra-op-threads %d --inter-op-threads %d'
+               ' --batch-size %d (%.1f seqs/s)'
+               % (best['intra_op_threads'], best['inter_op_threads'],
+                  best['batch_size'], best['seqs_per_s']))
 
-    while True:
-        variant = json.loads(sys.stdin.readline().strip())
 
-        overhang = (variant['intronl_len'], variant['intronr_len'])
-        ref_scores = np.matrix(psi_model.predict(variant['ref_seq'], overhang))
-        alt_scores = np.matrix(psi_model.predict(variant['alt_seq'], overhang))
-        scores = np.hstack([ref_scores, alt_scores]).tolist()[0]
+@cli.command(name='scan')
+@click.option('--fasta', required=True, help='fasta file of genome.')
+@click.option('--region', required=True, callback=_parse_region,
+              help='Chromosome or region (chrom:start-end, 1-based) to'
+              ' scan.')
+@click.option('--strand', type=click.Choice(['+', '-']), default='+',
+              show_default=True, help='Strand to scan.')
+@click.option('--out', required=True,
+              help='Output file of tracks (.csv, .parquet, .arrow).')
+@click.option('--format', 'output_format',
+              type=click.Choice(['csv', 'parquet', 'arrow']),
+              help='Output format, inferred from extension of --out'
+              ' by default.')
+@click.option('--chunk-size', default=100000, show_default=True,
+              help='Number of positions scored at once.')
+@click.option('--batch-size', default=4096, show_default=True,
+              help='Batch size of prediction.')
+@model_options
+@thread_options
+def scan(fasta, region, strand, out, output_format, chunk_size, batch_size,
+         **options):
+    '''
+    Score every position of a region or chromosome as acceptor and donor
+    splice site and write tracks of logits to find cryptic splice sites.
+    '''
+    from mmsplice.mmsplice import MMSplice
+    from mmsplice.scan import scan_region
+    from mmsplice.writers import table_writer
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    model = MMSplice(**{k: v for k, v in options.items() if v})
+    chrom, start, end = region
+    with table_writer(out, output_format) as writer:
+        for df in scan_region(model, fasta, chrom, start, end, strand,
+                              chunk_size=chunk_size, batch_size=batch_size):
+            writer.write(df)
 
-        scores.extend([
-            predict_deltaLogitPsi(ref_scores, alt_scores)[0],
-            predict_pathogenicity(ref_scores, alt_scores)[0]
-        ])
 
-        sys.stdout.write('MMSPLICE-RESPONSE:' +
-                         ','.join(map(str, scores)) + '\n')
-        sys.stdout.flush()
+@cli.command(name='freeze')
+@click.option('--out', required=True,
+              help='Output path of frozen graph (.pb).')
+@model_options
+def freeze(out, **options):
+    '''
+    Write model as frozen graph for fast start of `run` and `serve`.
+    '''
+    from mmsplice.mmsplice import MMSplice, freeze_model
+    freeze_model(MMSplice(**{k: v for k, v in options.items() if v}), out)
 
 
 if __name__ == '__main__':
@@ -1,16 +1,29 @@
+import os
+import json
+import logging
+from collections import OrderedDict, defaultdict
 from pkg_resources import resource_filename
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
+import tensorflow as tf
 from keras import backend as K
-from keras.models import load_model
-from sklearn.externals import joblib
+from keras.models import load_model, Model
+from keras.layers import Input
 from concise.preprocessing import encodeDNA
 
-from mmsplice.utils import logit, predict_deltaLogitPsi, \
-    predict_pathogenicity, predict_splicing_efficiency
-from mmsplice.exon_dataloader import SeqSpliter
+from mmsplice.utils import logit, predict_heads, VarEffAccumulator, \
+    EffectFilter, LINEAR_MODEL, LOGISTIC_MODEL, EFFICIENCY_MODEL  # noqa: F401
+from mmsplice.exon_dataloader import SeqSpliter, ExonDataset, \
+    encode_seqs
 from mmsplice.layers import GlobalAveragePooling1D_Mask0
+from mmsplice.writers import table_writer
+from mmsplice.cache import PredictionCache
+from mmsplice.profiling import stage, start_profiling, stop_profiling, \
+    active_profiler, profile_path
+
+logger = logging.getLogger('mmsplice')
+logger.addHandler(logging.NullHandler())
 
 
 ACCEPTOR_INTRON = resource_filename('mmsplice', 'models/Intron3.h5')
@@ -19,12 +32,6 @@ EXON = resource_filename('mmsplice', 'models/Exon.h5')
 EXON3 = resource_filename('mmsplice', 'models/Exon_prime3.h5')
 ACCEPTOR = resource_filename('mmsplice', 'models/Acceptor.h5')
 DONOR_INTRON = resource_filename('mmsplice', 'models/Intron5.h5')
-LINEAR_MODEL = joblib.load(resource_filename(
-    'mmsplice', 'models/linear_model.pkl'))
-LOGISTIC_MODEL = joblib.load(resource_filename(
-    'mmsplice', 'models/Pathogenicity.pkl'))
-EFFICIENCY_MODEL = joblib.load(resource_filename(
-    'mmsplice', 'models/splicing_efficiency.pkl'))
 
 
 class MMSplice(object):
@@ -40,6 +47,15 @@ class MMSplice(object):
       donorM: donor splice site model, score donor sequence
         with 13bp in the intron, 5bp in the exon.
       donor_intronM: donor intron model, score donor intron sequence.
+      intra_op_threads: number of threads used within an operation
+        (such as convolution). Default lets tensorflow use all cores.
+      inter_op_threads: number of threads running independent operations
+        in parallel. Default lets tensorflow use all cores.
+      cpus: list of cpu ids to pin the process to (Linux only),
+        such as cores of a worker on a shared node.
+      exon_chunk_size: batches of exons longer than this are scored in
+        chunks of this length (see `predict_exon`).
+      exon_chunk_batch: number of chunks of exons evaluated at once.
     """
 
     def __init__(self,
@@ -48,11 +64,27 @@ class MMSplice(object):
                  exonM=EXON,
                  donorM=DONOR,
                  donor_intronM=DONOR_INTRON,
-                 seq_spliter=None):
+                 seq_spliter=None,
+                 intra_op_threads=None,
+                 inter_op_threads=None,
+                 cpus=None,
+                 exon_chunk_size=1000,
+                 exon_chunk_batch=256):
 
         self.spliter = seq_spliter or SeqSpliter()
+        self.exon_chunk_size = exon_chunk_size
+        self.exon_chunk_batch = exon_chunk_batch
+        self._exon_chunk_models = None
+        self.model_files = [acceptor_intronM, acceptorM, exonM,
+                            donorM, donor_intronM]
 
         K.clear_session()
+        # threads of tensorflow inherit affinity, so pin before session
+        if cpus:
+            set_cpu_affinity(cpus)
+        if intra_op_threads or inter_op_threads:
+            K.set_session(tf.Session(config=session_config(
+                intra_op_threads, inter_op_threads)))
         self.acceptor_intronM = load_model(acceptor_intronM, compile=False)
         self.acceptorM = load_model(acceptorM, compile=False)
         self.exonM = load_model(exonM,
@@ -74,14 +106,65 @@ class MMSplice(object):
           as [[acceptor_intronM, acceptor, exon, donor, donor_intron]]
 
         '''
-        score = np.concatenate([
-            self.acceptor_intronM.predict(batch['acceptor_intron']),
-            logit(self.acceptorM.predict(batch['acceptor'])),
-            self.exonM.predict(batch['exon']),
-            logit(self.donorM.predict(batch['donor'])),
-            self.donor_intronM.predict(batch['donor_intron'])
-        ], axis=1)
-        return score
+        scores = list()
+        for attr, key, apply_logit in MODULES:
+            with stage('inference.%s' % key, len(batch[key])):
+                if attr == 'exonM':
+                    score = self.predict_exon(batch[key])
+                else:
+                    score = getattr(self, attr).predict(batch[key])
+            scores.append(logit(score) if apply_logit else score)
+        return np.concatenate(scores, axis=1)
+
+    def predict_exon(self, x):
+        '''
+        Scores of exon module of one-hot encoded exons padded with zeros.
+        If exons are longer than `exon_chunk_size`, they are split into
+        chunks with the context seen by the convolution on each side.
+        Masked sums of activations of chunks are pooled per exon, so
+        scores are the same as of whole exons while memory of
+        activations is bounded by the chunk size.
+
+        Args:
+          x: one-hot encoded exons as array of (exons, length, 4) or
+            list of exon sequences. Sequences are split into chunks
+            before encoding, so long exons are never encoded whole.
+        '''
+        encoded = isinstance(x, np.ndarray)
+        length = x.shape[1] if encoded else max(map(len, x), default=0)
+        if length <= self.exon_chunk_size:
+            return self.exonM.predict(x if encoded else encode_seqs(x))
+
+        if self._exon_chunk_models is None:
+            self._exon_chunk_models = exon_chunk_models(self.exonM)
+        features, head, overlap = self._exon_chunk_models
+
+        if encoded:
+            chunks, owners, cores = exon_chunks(x, self.exon_chunk_size,
+                                                overlap)
+        else:
+            chunks, owners, cores = exon_seq_chunks(x, self.exon_chunk_size,
+                                                    overlap)
+        width = self.exon_chunk_size + 2 * overlap
+        pooled = np.zeros((len(x), features.output_shape[-1]))
+        weights = np.zeros(len(x))
+
+        for i in range(0, len(chunks), self.exon_chunk_batch):
+            batch = chunks[i:i + self.exon_chunk_batch]
+            if not encoded:
+                batch = encode_seqs(batch)
+            core = cores[i:i + self.exon_chunk_batch, np.newaxis]
+            # mask of pooling restricted to core positions of chunks
+            positions = np.arange(width)[np.newaxis]
+            mask = batch.max(axis=2) * ((positions >= overlap)
+                                        & (positions < overlap + core))
+            idx = owners[i:i + self.exon_chunk_batch]
+            np.add.at(pooled, idx,
+                      np.einsum('bw,bwf->bf', mask, features.predict(batch)))
+            np.add.at(weights, idx, mask.sum(axis=1))
+
+        pooled /= np.maximum(weights, K.epsilon())[:, np.newaxis]
+        return head.predict(pooled)
 
     def predict(self, seq, overhang=(100, 100)):
         """
@@ -99,23 +182,351 @@ class MMSplice(object):
         batch = {k: encodeDNA([v]) for k, v in batch.items()}
         return self.predict_on_batch(batch)[0]
 
+    def predict_many(self, seqs, overhangs=(100, 100), batch_size=512,
+                     spliter=None):
+        """
+        Performe prediction of many overhanged exon sequence strings.
+        Sequences are grouped by overhang, so intron sequences of a batch
+        have the same length, and sorted by length of exon, so exon
+        sequences of a batch are padded as little as possible. Scores are
+        the same as `predict` of each sequence.
 
-def predict_batch(model, dataloader, batch_size=512, progress=True,
-                  pathogenicity=False, splicing_efficiency=False):
+        Args:
+          seqs (List[str]): sequences of overhanged exons.
+          overhangs: list of (acceptor, donor) overhang of each sequence
+            or one overhang of all sequences.
+          batch_size: number of sequences per inference batch.
+          spliter: SeqSpliter to split sequences, `spliter` of the model
+            by default.
+
+        Returns:
+          np.array of modular predictions of shape (len(seqs), 5)
+          as [[acceptor_intronM, acceptor, exon, donor, donor_intron]].
+        """
+        spliter = spliter or self.spliter
+        if np.ndim(overhangs) == 1:
+            overhangs = [overhangs] * len(seqs)
+
+        groups = defaultdict(list)
+        for i, overhang in enumerate(overhangs):
+            groups[tuple(overhang)].append(i)
+
+        scores = np.zeros((len(seqs), 5), dtype=np.float32)
+        for overhang, idx in groups.items():
+            with stage('split', len(idx)):
+                splits = [spliter.split(seqs[i], overhang,
+                                        pattern_warning=False)
+                          for i in idx]
+            order = np.argsort([len(s['exon']) for s in splits],
+                               kind='mergesort')
+            idx = np.array(idx)
+
+            for i in range(0, len(order), batch_size):
+                batch = order[i:i + batch_size]
+                with stage('encode', len(batch)):
+                    inputs = {k: encode_seqs([splits[j][k] for j in batch])
+                              for k in splits[0] if k != 'exon'}
+                # exons are encoded by predict_exon after chunking
+                inputs['exon'] = [splits[j]['exon'] for j in batch]
+                scores[idx[batch]] = self.predict_on_batch(inputs)
+
+        return scores
+
+
+def exon_chunk_models(exonM):
+    '''
+    Splits exon module at its masked average pooling into model of
+    activations of positions and model of pooled activations.
+
+    Returns:
+      tuple of features model, head model and number of positions on
+        each side seen by convolutions of the features model.
+    '''
+    index, pool = next((i, layer) for i, layer in enumerate(exonM.layers)
+                       if isinstance(layer, GlobalAveragePooling1D_Mask0))
+    features = Model(exonM.inputs[0], pool.input[0])
+
+    x = pooled = Input(shape=(features.output_shape[-1],))
+    for layer in exonM.layers[index + 1:]:
+        x = layer(x)
+    head = Model(pooled, x)
+
+    # receptive field of 'same' convolutions before pooling
+    overlap = sum((layer.kernel_size[0] - 1) // 2 * layer.dilation_rate[0]
+                  for layer in exonM.layers[:index]
+                  if hasattr(layer, 'kernel_size'))
+    return features, head, overlap
+
+
+def exon_chunks(x, chunk_size, overlap):
+    '''
+    Splits one-hot encoded sequences padded with zeros into chunks of
+    chunk_size positions with overlap positions of context on each side.
+
+    Args:
+      x: array of (sequences, length, 4).
+      chunk_size: number of core positions of a chunk.
+      overlap: number of context positions on each side of a chunk.
+
+    Returns:
+      tuple of chunks (chunks, chunk_size + 2 * overlap, 4), index of
+        sequence of each chunk and number of core positions of each chunk.
+    '''
+    mask = x.max(axis=2) > 0
+    lengths = np.where(mask.any(axis=1),
+                       x.shape[1] - np.argmax(mask[:, ::-1], axis=1), 0)
+
+    owners = np.repeat(np.arange(len(x)),
+                       np.maximum(-(-lengths // chunk_size), 1))
+    starts = np.concatenate([
+        np.arange(0, max(n, 1), chunk_size) for n in lengths])
+    cores = np.clip(lengths[owners] - starts, 0, chunk_size)
+
+    chunks = np.zeros((len(starts), chunk_size + 2 * overlap, x.shape[2]),
+                      dtype=x.dtype)
+    for j, (i, start) in enumerate(zip(owners, starts)):
+        lo = max(start - overlap, 0)
+        hi = min(start + chunk_size + overlap, lengths[i])
+        chunks[j, lo - start + overlap: hi - start + overlap] = x[i, lo:hi]
+    return chunks, owners, cores
+
+
+def exon_seq_chunks(seqs, chunk_size, overlap):
+    '''
+    Splits exon sequences into chunks as `exon_chunks` before encoding.
+    Context beyond the ends of sequences is padded with N, which is
+    encoded as zeros.
+
+    Args:
+      seqs: list of sequences.
+      chunk_size: number of core positions of a chunk.
+      overlap: number of context positions on each side of a chunk.
+
+    Returns:
+      tuple of list of chunk sequences of chunk_size + 2 * overlap bases,
+        index of sequence of each chunk and number of core positions of
+        each chunk.
+    '''
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    owners = np.repeat(np.arange(len(seqs)),
+                       np.maximum(-(-lengths // chunk_size), 1))
+    starts = np.concatenate([
+        np.arange(0, max(n, 1), chunk_size) for n in lengths])
+    cores = np.clip(lengths[owners] - starts, 0, chunk_size)
+
+    width = chunk_size + 2 * overlap
+    chunks = list()
+    for i, start in zip(owners, starts):
+        lo = max(start - overlap, 0)
+        chunk = seqs[i][lo:start + chunk_size + overlap]
+        chunks.append(('N' * (lo - start + overlap) + chunk).ljust(width, 'N'))
+    return chunks, owners, cores
+
+
+# options of MMSplice controlling threading of inference
+THREAD_OPTIONS = ['intra_op_threads', 'inter_op_threads', 'cpus']
+
+
+def session_config(intra_op_threads=None, inter_op_threads=None):
     """
-    Return the prediction as a table
+    Tensorflow session config with number of threads of operations.
+    None lets tensorflow choose the number of cores. If any number is
+    given, the session gets its own thread pools instead of the thread
+    pools shared by sessions of the process.
 
     Args:
-      model: mmsplice model object.
-      dataloader: dataloader object.
-      progress: show progress bar.
-      pathogenicity: adds pathogenicity prediction as column
-      splicing_efficiency: adds  splicing_efficiency prediction as column
+      intra_op_threads: number of threads used within an operation.
+      inter_op_threads: number of threads running independent operations.
+    """
+    return tf.ConfigProto(
+        intra_op_parallelism_threads=intra_op_threads or 0,
+        inter_op_parallelism_threads=inter_op_threads or 0,
+        use_per_session_threads=bool(intra_op_threads or inter_op_threads))
+
+
+def set_cpu_affinity(cpus):
+    """
+    Pins the calling thread and threads started by it afterwards
+    (such as thread pools of tensorflow sessions) to cpus.
+
+    Args:
+      cpus: list of cpu ids.
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        logger.warning('CPU affinity is not supported on this platform.')
+        return
+    os.sched_setaffinity(0, cpus)
+    logger.info('Pinned to cpus %s' % ','.join(map(str, sorted(cpus))))
+
+
+# (model attribute, batch key, apply logit to output)
+MODULES = [
+    ('acceptor_intronM', 'acceptor_intron', False),
+    ('acceptorM', 'acceptor', True),
+    ('exonM', 'exon', False),
+    ('donorM', 'donor', True),
+    ('donor_intronM', 'donor_intron', False)
+]
+
+
+def freeze_model(model, path):
+    """
+    Write modules of mmsplice model as a single frozen tensorflow graph
+    with weights stored as constants. Loading the frozen graph with
+    `FrozenMMSplice` is faster than loading keras models.
+
+    Args:
+      model: MMSplice model.
+      path: output path of frozen graph (.pb).
+    """
+    session = K.get_session()
+    signature = list()
+
+    with session.graph.as_default():
+        for attr, key, _ in MODULES:
+            module = getattr(model, attr)
+            output = tf.identity(module.outputs[0], name='mmsplice_%s' % key)
+            signature.append((key, module.inputs[0].name, output.name))
+        signature = tf.constant(json.dumps(signature),
+                                name='mmsplice_signature')
+
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(),
+        [name.split(':')[0] for _, _, name in json.loads(
+            session.run(signature))] + [signature.op.name])
+
+    with open(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+
+class FrozenMMSplice(MMSplice):
+    """
+    MMSplice model loaded from frozen graph written by `freeze_model`.
+    Keras models are not built, thus loading is faster, and all modules
+    are evaluated in a single session call.
+
+    The frozen graph scores exons whole, so batches with exons longer
+    than `exon_chunk_size` are scored by the keras exon module in chunks
+    (see `MMSplice.predict_exon`), which is loaded on first use.
+
+    Args:
+      frozen_graph: path of frozen graph.
+      intra_op_threads, inter_op_threads, cpus: threading of
+        inference (see `MMSplice`).
+      exonM: keras exon module of the frozen graph.
+      exon_chunk_size, exon_chunk_batch: chunking of long exons
+        (see `MMSplice`).
+    """
+
+    def __init__(self, frozen_graph, seq_spliter=None, intra_op_threads=None,
+                 inter_op_threads=None, cpus=None, exonM=EXON,
+                 exon_chunk_size=1000, exon_chunk_batch=256):
+        self.spliter = seq_spliter or SeqSpliter()
+        self.model_files = [frozen_graph]
+        self.exon_model = exonM
+        self.exon_chunk_size = exon_chunk_size
+        self.exon_chunk_batch = exon_chunk_batch
+        self._exonM = None
+        self._exon_chunk_models = None
+
+        graph_def = tf.GraphDef()
+        with open(frozen_graph, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        if cpus:
+            set_cpu_affinity(cpus)
+        self.session = tf.Session(graph=self.graph, config=session_config(
+            intra_op_threads, inter_op_threads))
+
+        signature = json.loads(self.session.run('mmsplice_signature:0'))
+        self.keys, self.inputs, self.outputs = zip(*signature)
+
+    @property
+    def exonM(self):
+        if self._exonM is None:
+            self._exonM = load_model(
+                self.exon_model, compile=False, custom_objects={
+                    "GlobalAveragePooling1D_Mask0":
+                    GlobalAveragePooling1D_Mask0})
+        return self._exonM
+
+    def predict_on_batch(self, batch):
+        exon = batch['exon']
+        length = exon.shape[1] if isinstance(exon, np.ndarray) \
+            else max(map(len, exon), default=0)
+        # long exons are scored in chunks by keras instead of the graph
+        chunked = length > self.exon_chunk_size
+        if not chunked and not isinstance(exon, np.ndarray):
+            batch = dict(batch, exon=encode_seqs(exon))
+
+        keys, inputs, outputs = zip(*[
+            (key, name, output)
+            for key, name, output in zip(self.keys, self.inputs, self.outputs)
+            if not (chunked and key == 'exon')])
+        with stage('inference', len(exon)):
+            scores = dict(zip(keys, self.session.run(list(outputs), feed_dict={
+                name: batch[key] for key, name in zip(keys, inputs)
+            })))
+        if chunked:
+            with stage('inference.exon', len(exon)):
+                scores['exon'] = self.predict_exon(exon)
+
+        scores = [
+            logit(scores[key]) if apply_logit else scores[key]
+            for _, key, apply_logit in MODULES
+        ]
+        return np.concatenate(scores, axis=1)
+
+
+def unique_exon_variant_pairs(metadata):
+    """
+    Find unique exon-variant pairs in metadata of a batch. Pairs only
+    differing in transcript metadata (such as exon shared by transcripts)
+    are considered as same.
+
+    Args:
+      metadata: metadata of batch of dataloader.
 
     Returns:
-      iterator of pd.DataFrame of modular prediction, delta_logit_psi,
-        splicing_efficiency, pathogenicity.
+      tuple of indices of first occurrence of each unique pair and
+        inverse indices to reconstruct the batch from unique pairs.
     """
+    exon = metadata['exon']
+    keys = pd.Series(list(zip(
+        exon['annotation'], exon['left_overhang'],
+        exon['right_overhang'], metadata['variant']['STR'])))
+    inverse, uniques = pd.factorize(keys)
+    unique_idx = np.unique(inverse, return_index=True)[1]
+    return unique_idx, inverse
+
+
+def _take_inputs(inputs, idx):
+    return {k: v[idx] for k, v in inputs.items()}
+
+
+def _effect_filter(min_delta_logit_psi=None, min_pathogenicity=None,
+                   top_k=None):
+    if min_delta_logit_psi is None and min_pathogenicity is None \
+       and top_k is None:
+        return None
+    return EffectFilter(min_delta_logit_psi, min_pathogenicity, top_k)
+
+
+def _predict_batches(model, dataloader, batch_size=512, progress=True,
+                     pathogenicity=False, splicing_efficiency=False,
+                     cache=None, min_delta_logit_psi=None,
+                     min_pathogenicity=None, top_k=None):
+    # yields tables of predictions with vcf batch of their rows
+    if isinstance(cache, str):
+        cache = PredictionCache(cache, model, dataloader.spliter)
+    if cache is not None:
+        dataloader.cache = cache
+    effect_filter = _effect_filter(min_delta_logit_psi, min_pathogenicity,
+                                   top_k)
+
     dt_iter = dataloader.batch_iter(batch_size=batch_size)
     if progress:
         dt_iter = tqdm(dt_iter)
@@ -125,44 +536,332 @@ def predict_batch(model, dataloader, batch_size=512, progress=True,
     alt_cols = ['alt_acceptorIntron', 'alt_acceptor',
                 'alt_exon', 'alt_donor', 'alt_donorIntron']
 
+    n_rows = 0
+    n_unique = 0
+    n_cached = 0
+
     for batch in dt_iter:
-        X_ref = model.predict_on_batch(batch['inputs']['seq'])
-        X_alt = model.predict_on_batch(batch['inputs']['mut_seq'])
-        ref_pred = pd.DataFrame(X_ref, columns=ref_cols)
-        alt_pred = pd.DataFrame(X_alt, columns=alt_cols)
+        metadata = batch['metadata']
+        unique_idx, inverse = unique_exon_variant_pairs(metadata)
+        n_rows += len(inverse)
+        n_unique += len(unique_idx)
+
+        # ref and alt modular scores of unique pairs
+        scores = np.empty((len(unique_idx), 10), dtype=np.float32)
+        todo = np.arange(len(unique_idx))
+        if 'cached' in metadata:
+            scores[:] = metadata['cached'][unique_idx]
+            todo = todo[np.isnan(scores[:, 0])]
+        n_cached += len(unique_idx) - len(todo)
+
+        if len(todo):
+            idx = unique_idx[todo]
+            scores[todo, :5] = model.predict_on_batch(
+                _take_inputs(batch['inputs']['seq'], idx))
+            scores[todo, 5:] = model.predict_on_batch(
+                _take_inputs(batch['inputs']['mut_seq'], idx))
+
+            if cache is not None:
+                exon = metadata['exon']
+                cache.put_many([
+                    cache.key(exon['annotation'][i], exon['left_overhang'][i],
+                              exon['right_overhang'][i],
+                              metadata['variant']['STR'][i])
+                    for i in idx
+                ], scores[todo, :5], scores[todo, 5:])
+
+        X_ref = scores[inverse, :5]
+        X_alt = scores[inverse, 5:]
+        ids = np.asarray(metadata['variant']['STR'])
+        vcf_batch = metadata.get('vcf_batch')
+
+        with stage('heads', len(X_ref)):
+            heads = predict_heads(
+                X_ref, X_alt,
+                pathogenicity or min_pathogenicity is not None,
+                splicing_efficiency)
+        if not pathogenicity:
+            heads.pop('pathogenicity', None)
+
+        # filtered rows are dropped before the table is created
+        idx = slice(None)
+        if effect_filter is not None:
+            idx = effect_filter.select(ids, heads)
+            heads = OrderedDict((k, v[idx]) for k, v in heads.items())
+            if vcf_batch is not None:
+                vcf_batch = np.asarray(vcf_batch)[idx]
 
         df = pd.DataFrame({
-            'ID': batch['metadata']['variant']['STR'],
-            'exons': batch['metadata']['exon']['annotation'],
+            'ID': ids[idx],
+            'exons': np.asarray(metadata['exon']['annotation'])[idx],
         })
         for k in ['exon_id', 'gene_id', 'gene_name', 'transcript_id']:
-            if k in batch['metadata']['exon']:
-                df[k] = batch['metadata']['exon'][k]
+            if k in metadata['exon']:
+                df[k] = np.asarray(metadata['exon'][k])[idx]
+
+        df['delta_logit_psi'] = heads.pop('delta_logit_psi')
+        df = pd.concat([
+            df,
+            pd.DataFrame(X_ref[idx], columns=ref_cols),
+            pd.DataFrame(X_alt[idx], columns=alt_cols)
+        ], axis=1)
+        for k, v in heads.items():
+            df[k] = v
 
-        df['delta_logit_psi'] = predict_deltaLogitPsi(X_ref, X_alt)
-        df = pd.concat([df, ref_pred, alt_pred], axis=1)
+        if effect_filter is not None:
+            df, vcf_batch = effect_filter.merge(df, vcf_batch, ids[-1])
 
-        if pathogenicity:
-            df['pathogenicity'] = predict_pathogenicity(X_ref, X_alt)
-        if splicing_efficiency:
-            df['efficiency'] = predict_splicing_efficiency(X_ref, X_alt)
+        yield vcf_batch, df
 
-        yield df
+    if effect_filter is not None:
+        held = effect_filter.flush()
+        if held is not None:
+            yield held[1], held[0]
+        logger.info(str(effect_filter))
 
+    logger.info('%d exon-variant pairs scored as %d unique pairs'
+                ' (dedup ratio %.2f)'
+                % (n_rows, n_unique, n_rows / max(n_unique, 1)))
+    if cache is not None:
+        logger.info('%d of %d unique pairs read from cache'
+                    % (n_cached, n_unique))
+        logger.info(str(cache))
 
-def predict_save(model, dataloader, output_csv, batch_size=512, progress=True,
-                 pathogenicity=False, splicing_efficiency=False):
-    df_iter = predict_batch(model, dataloader, progress=progress,
-                            pathogenicity=pathogenicity,
-                            splicing_efficiency=splicing_efficiency)
 
-    df = next(df_iter)
-    with open(output_csv, 'w') as f:
-        df.to_csv(f, index=False)
+def predict_batch(model, dataloader, batch_size=512, progress=True,
+                  pathogenicity=False, splicing_efficiency=False,
+                  cache=None, min_delta_logit_psi=None,
+                  min_pathogenicity=None, top_k=None):
+    """
+    Return the prediction as a table
+
+    Args:
+      model: mmsplice model object.
+      dataloader: dataloader object.
+      progress: show progress bar.
+      pathogenicity: adds pathogenicity prediction as column
+      splicing_efficiency: adds  splicing_efficiency prediction as column
+      cache: path of sqlite database or PredictionCache to lookup
+        predictions of exon-variant pairs before sequence extraction
+        and inference. New predictions are stored in cache.
+      min_delta_logit_psi: only returns exon-variant pairs with absolute
+        delta_logit_psi at least this.
+      min_pathogenicity: only returns exon-variant pairs with
+        pathogenicity at least this.
+      top_k: only returns k exons with largest absolute delta_logit_psi
+        per variant. Filtered pairs are dropped right after the heads
+        are evaluated, before tables are created.
+
+    Returns:
+      iterator of pd.DataFrame of modular prediction, delta_logit_psi,
+        splicing_efficiency, pathogenicity.
+    """
+    for _, df in _predict_batches(model, dataloader, batch_size, progress,
+                                  pathogenicity, splicing_efficiency, cache,
+                                  min_delta_logit_psi, min_pathogenicity,
+                                  top_k):
+        if len(df):
+            yield df
+
+
+def predict_dataframe(model, exons, fasta_file, overhang=(100, 100),
+                      batch_size=512, progress=False, **kwargs):
+    """
+    Predicts exon-variant pairs held in memory without writing them to a
+    file (see `ExonDataset.from_dataframe`).
+
+    Args:
+      model: mmsplice model object.
+      exons: pd.DataFrame or dict of arrays of exon-variant pairs with
+        columns of csv file of ExonDataset.
+      fasta_file: fasta file to fetch exon sequences.
+      overhang: overhang of exon to fetch flanking sequence of exon.
+      batch_size: batch size of prediction.
+      progress: show progress bar.
+      kwargs: arguments of `predict_batch`.
+
+    Returns:
+      iterator of pd.DataFrame of predictions as `predict_batch`.
+    """
+    if isinstance(exons, pd.DataFrame):
+        dl = ExonDataset.from_dataframe(exons, fasta_file, overhang=overhang)
+    else:
+        dl = ExonDataset.from_arrays(exons, fasta_file, overhang=overhang)
+    return predict_batch(model, dl, batch_size, progress, **kwargs)
+
 
-    for df in df_iter:
-        with open(output_csv, 'a') as f:
-            df.to_csv(f, index=False, header=False)
+def checkpoint_path(output):
+    """
+    Path of checkpoint file of output file of `predict_save`.
+    """
+    return output + '.checkpoint'
+
+
+def read_checkpoint(output):
+    """
+    Returns checkpoint of output file of `predict_save` as dict or
+    None if there is no checkpoint.
+    """
+    path = checkpoint_path(output)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_checkpoint(output, checkpoint):
+    # atomic replace so checkpoint is complete even if job is killed
+    path = checkpoint_path(output)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+
+def _write(writer, df):
+    with stage('write', len(df)):
+        writer.write(df)
+
+
+def _predict_save_checkpoint(df_iter, dataloader, output, output_format,
+                             checkpoint):
+    resume = checkpoint['writer'] if checkpoint else None
+
+    with table_writer(output, output_format, resume) as writer:
+        pending = list()
+        pending_batch = None
+
+        for vcf_batch, df in df_iter:
+            if len(df) == 0:
+                continue
+            last_batch = int(vcf_batch[-1])
+
+            # rows of the last vcf batch are held back until the batch
+            # is complete, so output is only checkpointed at batch ends.
+            complete = pending_batch is not None and pending_batch < last_batch
+            if complete:
+                for i in pending:
+                    _write(writer, i)
+                pending = list()
+
+            done = vcf_batch < last_batch
+            if done.any():
+                _write(writer, df[done])
+                complete = True
+
+            if complete:
+                _write_checkpoint(output, {
+                    'vcf_batch': last_batch,
+                    'start': dataloader.vcf_batch_starts[last_batch],
+                    'writer': writer.state(),
+                    'done': False
+                })
+                for i in [k for k in dataloader.vcf_batch_starts
+                          if k < last_batch]:
+                    del dataloader.vcf_batch_starts[i]
+
+            pending.append(df[~done])
+            pending_batch = last_batch
+
+        for i in pending:
+            _write(writer, i)
+
+        _write_checkpoint(output, {'writer': writer.state(), 'done': True})
+
+
+def predict_save(model, dataloader, output_csv, batch_size=512, progress=True,
+                 pathogenicity=False, splicing_efficiency=False,
+                 output_format=None, checkpoint=False, resume=False,
+                 cache=None, profile=None, min_delta_logit_psi=None,
+                 min_pathogenicity=None, top_k=None):
+    """
+    Predict and write the prediction table batch by batch to a file.
+
+    Args:
+      model: mmsplice model object.
+      dataloader: dataloader object.
+      output_csv: output file path.
+      batch_size: batch size of prediction.
+      progress: show progress bar.
+      pathogenicity: adds pathogenicity prediction as column
+      splicing_efficiency: adds  splicing_efficiency prediction as column
+      output_format: 'csv', 'parquet' or 'arrow' (arrow ipc stream).
+        If None, inferred from extension of output file, default is csv.
+        Parquet and arrow outputs require pyarrow and store scores as
+        float32 and string columns as dictionary-encoded.
+      checkpoint: records progress in `output_csv + '.checkpoint'` after
+        each completely written vcf batch. Requires SplicingVCFDataloader
+        and csv or arrow output.
+      resume: continue interrupted run from its checkpoint. Written
+        predictions of incomplete vcf batch are discarded and vcf is
+        read from the beginning of the batch with index of vcf,
+        so the output is identical to uninterrupted run.
+      cache: path of sqlite database or PredictionCache of predictions
+        (see `predict_batch`).
+      profile: path of json report of wall time, calls and items/s of
+        stages (see `mmsplice.profiling`) and peak rss of the run.
+        Also written to `output_csv + '.profile.json'` if environment
+        variable `MMSPLICE_PROFILE=1`, which profiles from import of
+        mmsplice so loading of exons is included.
+      min_delta_logit_psi: only writes exon-variant pairs with absolute
+        delta_logit_psi at least this (see `predict_batch`).
+      min_pathogenicity: only writes exon-variant pairs with
+        pathogenicity at least this.
+      top_k: only writes k exons with largest absolute delta_logit_psi
+        per variant.
+    """
+    if (checkpoint or resume) and not hasattr(dataloader, 'resume'):
+        raise ValueError('Checkpointing requires SplicingVCFDataloader.')
+
+    profile = profile or profile_path(output_csv)
+    started = profile is not None and active_profiler() is None
+    if started:
+        start_profiling()
+    try:
+        _predict_save(model, dataloader, output_csv, batch_size, progress,
+                      pathogenicity, splicing_efficiency, output_format,
+                      checkpoint, resume, cache, min_delta_logit_psi,
+                      min_pathogenicity, top_k)
+    finally:
+        if profile is not None:
+            profiler = active_profiler()
+            logger.info('Profile of stages:\n%s' % profiler)
+            profiler.save(profile)
+        if started:
+            stop_profiling()
+
+
+def _predict_save(model, dataloader, output_csv, batch_size, progress,
+                  pathogenicity, splicing_efficiency, output_format,
+                  checkpoint, resume, cache, min_delta_logit_psi=None,
+                  min_pathogenicity=None, top_k=None):
+    state = read_checkpoint(output_csv) if resume else None
+
+    if state is not None:
+        if state['done']:
+            logger.info('%s is already complete.' % output_csv)
+            return
+        logger.info('Resuming %s from vcf batch %d'
+                    % (output_csv, state['vcf_batch']))
+        dataloader.resume(state['vcf_batch'], state['start'])
+
+    df_iter = _predict_batches(model, dataloader, batch_size=batch_size,
+                               progress=progress,
+                               pathogenicity=pathogenicity,
+                               splicing_efficiency=splicing_efficiency,
+                               cache=cache,
+                               min_delta_logit_psi=min_delta_logit_psi,
+                               min_pathogenicity=min_pathogenicity,
+                               top_k=top_k)
+
+    if checkpoint or resume:
+        _predict_save_checkpoint(df_iter, dataloader, output_csv,
+                                 output_format, state)
+        return
+
+    with table_writer(output_csv, output_format) as writer:
+        for _, df in df_iter:
+            if len(df):
+                _write(writer, df)
 
 
 def predict_all_table(model,
@@ -170,7 +869,12 @@ def predict_all_table(model,
                       batch_size=512,
                       progress=True,
                       pathogenicity=False,
-                      splicing_efficiency=False):
+                      splicing_efficiency=False,
+                      max_per_var=False,
+                      cache=None,
+                      min_delta_logit_psi=None,
+                      min_pathogenicity=None,
+                      top_k=None):
     """
     Return the prediction as a table
 
@@ -180,14 +884,36 @@ def predict_all_table(model,
       progress: show progress bar.
       pathogenicity: adds pathogenicity prediction as column
       splicing_efficiency: adds  splicing_efficiency prediction as column
+      max_per_var: only keep the exon with largest absolute
+        delta_logit_psi per variant (see `utils.max_varEff`). Summary is
+        computed online so all exon predictions are not kept in memory.
+      cache: path of sqlite database or PredictionCache of predictions
+        (see `predict_batch`).
+      min_delta_logit_psi, min_pathogenicity, top_k: filters of
+        exon-variant pairs (see `predict_batch`).
 
     Returns:
       pd.DataFrame of modular prediction, delta_logit_psi, splicing_efficiency,
         pathogenicity.
     """
-    return pd.concat(predict_batch(model, dataloader, progress=progress,
-                                   pathogenicity=pathogenicity,
-                                   splicing_efficiency=splicing_efficiency))
+    df_iter = predict_batch(model, dataloader, batch_size=batch_size,
+                            progress=progress,
+                            pathogenicity=pathogenicity,
+                            splicing_efficiency=splicing_efficiency,
+                            cache=cache,
+                            min_delta_logit_psi=min_delta_logit_psi,
+                            min_pathogenicity=min_pathogenicity,
+                            top_k=top_k)
+
+    if max_per_var:
+        acc = VarEffAccumulator()
+        for df in df_iter:
+            acc.update(df)
+        return acc.to_df()
+
+    dfs = list(df_iter)
+    # all pairs may be filtered
+    return pd.concat(dfs) if dfs else pd.DataFrame()
 
 
 def writeVCF(vcf_in, vcf_out, predictions):
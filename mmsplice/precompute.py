@@ -0,0 +1,416 @@
+import os
+import logging
+import tempfile
+from tqdm import tqdm
+import numpy as np
+import pandas as pd
+from pybedtools import Interval
+
+from mmsplice.utils import predict_heads, \
+    pyrange_remove_chr_from_chrom_annotation
+from mmsplice.exon_dataloader import SeqSpliter
+from mmsplice.vcf_dataloader import read_exons
+
+logger = logging.getLogger('mmsplice')
+logger.addHandler(logging.NullHandler())
+
+BASES = 'ACGT'
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+REF_COLUMNS = ['ref_acceptorIntron', 'ref_acceptor',
+               'ref_exon', 'ref_donor', 'ref_donorIntron']
+ALT_COLUMNS = ['alt_acceptorIntron', 'alt_acceptor',
+               'alt_exon', 'alt_donor', 'alt_donorIntron']
+SNV_TABLE_COLUMNS = ['CHROM', 'POS', 'REF', 'ALT', 'exons', 'gene_id',
+                     'gene_name'] + REF_COLUMNS + ALT_COLUMNS
+
+EXON_KEY = ['Chromosome', 'Start', 'End', 'Strand',
+            'left_overhang', 'right_overhang']
+
+# split of each module in the order of REF_COLUMNS
+MODULE_SPLITS = ['acceptor_intron', 'acceptor', 'exon', 'donor',
+                 'donor_intron']
+WINDOW_COLUMNS = ['%s_%s' % (c[len('ref_'):], side)
+                  for c in REF_COLUMNS for side in ('start', 'end')]
+# first code point of characters marking positions of sequence
+_MARKER = 0x10000
+
+
+def _unique_exons(pr_exons):
+    '''
+    Exons with unique coordinates and overhang sorted by position,
+    genes of exons shared between genes are comma separated.
+    '''
+    df = pr_exons.df
+    df = df.assign(Chromosome=df['Chromosome'].astype(str),
+                   Strand=df['Strand'].astype(str))
+    genes = df.groupby(EXON_KEY).agg({
+        'gene_id': lambda x: ','.join(x.astype(str).unique()),
+        'gene_name': lambda x: ','.join(x.astype(str).unique())
+    })
+    return genes.reset_index().sort_values(['Chromosome', 'Start', 'End'])
+
+
+def _exon_overhang(exon):
+    # (acceptor, donor) overhang in direction of strand
+    lo, ro = int(exon.left_overhang), int(exon.right_overhang)
+    return (ro, lo) if exon.Strand == '-' else (lo, ro)
+
+
+def module_windows(spliter, length, overhang):
+    '''
+    Windows of positions of an overhanged exon sequence seen by each
+    module, found by splitting a sequence of distinct characters. A SNV
+    only changes the scores of modules whose window contains it.
+
+    Args:
+      spliter: SeqSpliter to split sequences.
+      length: length of sequence.
+      overhang: (acceptor, donor) overhang of sequence.
+
+    Returns:
+      list of (start, end) of each module in the order of REF_COLUMNS,
+        zero-based in direction of strand.
+    '''
+    seq = ''.join(map(chr, range(_MARKER, _MARKER + length)))
+    splits = spliter.split(seq, overhang, pattern_warning=False)
+    windows = list()
+    for module in MODULE_SPLITS:
+        # N are padding of spliter
+        idx = [ord(c) - _MARKER for c in splits[module] if c != 'N']
+        windows.append((min(idx), max(idx) + 1) if idx else (0, 0))
+    return windows
+
+
+def _alt_index(ref, alt):
+    # index of alt among the 3 bases other than ref
+    return BASES.index(alt) - (BASES.index(alt) > BASES.index(ref))
+
+
+def exon_snv_scores(model, fasta, exon, batch_size=512, spliter=None):
+    '''
+    Scores of all possible SNVs within an exon and its overhang.
+    Positions are the same as variants matched to the exon by
+    `SplicingVCFDataloader`.
+
+    Args:
+      model: mmsplice model object.
+      fasta: FastaStringExtractor of genome.
+      exon: row of exon with Chromosome, Start, End (with overhang,
+        as returned by `read_exons`), Strand, left_overhang and
+        right_overhang.
+      batch_size: batch size of prediction.
+      spliter: SeqSpliter to split sequences.
+
+    Returns:
+      tuple of index of reference base in BASES per position (255 if
+        not ACGT), modular scores of reference exon, windows of modules
+        (see `module_windows`) and list of float32 arrays of scores of
+        each module of (window length, 3) for the 3 alternative bases of
+        each position of the window (in direction of strand).
+    '''
+    spliter = spliter or SeqSpliter()
+    chrom, start, end = exon.Chromosome, int(exon.Start), int(exon.End)
+    overhang = _exon_overhang(exon)
+
+    seq = fasta.extract(Interval(chrom, start - 1, end,
+                                 strand=exon.Strand)).upper()
+    plus_seq = seq if exon.Strand != '-' \
+        else seq.translate(COMPLEMENT)[::-1]
+
+    refs = np.full(end - start, 255, dtype=np.uint8)
+    idx, alt_idx, alt_seqs = [], [], []
+    for i in range(end - start):
+        ref = plus_seq[i]
+        if ref not in BASES:
+            continue
+        refs[i] = BASES.index(ref)
+        j = len(seq) - 1 - i if exon.Strand == '-' else i
+        for alt in BASES:
+            if alt == ref:
+                continue
+            if exon.Strand == '-':
+                alt_seqs.append(seq[:j] + alt.translate(COMPLEMENT)
+                                + seq[j + 1:])
+            else:
+                alt_seqs.append(seq[:j] + alt + seq[j + 1:])
+            idx.append(j)
+            alt_idx.append(_alt_index(ref, alt))
+
+    windows = module_windows(spliter, len(seq), overhang)
+    X_ref = model.predict_many([seq], overhang, batch_size, spliter)[0]
+    scores = [np.full((e - s, 3), np.nan, dtype=np.float32)
+              for s, e in windows]
+    if alt_seqs:
+        X_alt = model.predict_many(alt_seqs, overhang, batch_size, spliter)
+        idx, alt_idx = np.array(idx), np.array(alt_idx)
+        for m, (s, e) in enumerate(windows):
+            seen = (idx >= s) & (idx < e)
+            scores[m][idx[seen] - s, alt_idx[seen]] = X_alt[seen, m]
+    return refs, X_ref, windows, scores
+
+
+def precompute_snvs(model, gtf, fasta_file, output, overhang=(100, 100),
+                    batch_size=512, progress=True):
+    '''
+    Score every possible SNV within the overhang of every exon and write
+    scores to a table directory to lookup with `SNVScoreTable`:
+
+    - exons.tsv: exons sorted by position with genes, modular scores of
+      reference exon, windows of modules and offsets into arrays.
+    - refs.npy: uint8 index of reference base in BASES per position.
+    - scores.npy: float32 scores of the 3 SNVs of each position for the
+      modules whose window contains the position. Scores of other
+      modules are the same as of reference exon and delta_logit_psi is
+      computed from modular scores on lookup.
+
+    The table takes about 13 bytes per position of exons with overhang
+    (12 bytes of scores and 1 byte of reference base) and about 700
+    bytes per exon for windows of modules overlapping other modules.
+
+    Exons shared between transcripts are scored once and sequence of ref
+    exon is scored once per exon.
+
+    Args:
+      model: mmsplice model object.
+      gtf: gtf file or 'grch37'/'grch38' for prebuild annotation.
+      fasta_file: fasta file of genome.
+      output: path of output directory.
+      overhang: overhang of exon into left and right intron.
+      batch_size: batch size of prediction.
+      progress: show progress bar.
+    '''
+    from kipoiseq.extractors import FastaStringExtractor
+
+    fasta = FastaStringExtractor(fasta_file)
+    spliter = SeqSpliter()
+    pr_exons = read_exons(gtf, overhang)
+    if gtf in ('grch37', 'grch38') and not any(
+            chrom.startswith('chr') for chrom in fasta.fasta.keys()):
+        pr_exons = pyrange_remove_chr_from_chrom_annotation(pr_exons)
+    exons = _unique_exons(pr_exons).reset_index(drop=True)
+
+    # windows are known before scoring, so arrays are allocated once
+    windows = np.array([
+        module_windows(spliter, int(e.End) - int(e.Start) + 1,
+                       _exon_overhang(e))
+        for e in exons.itertuples()], dtype=np.int64).reshape(-1, 10)
+    lengths = (exons['End'] - exons['Start']).values
+    sizes = 3 * (windows[:, 1::2] - windows[:, ::2]).sum(axis=1)
+    exons['exons'] = ['%s:%d-%d:%s' % (e.Chromosome,
+                                       e.Start + e.left_overhang - 1,
+                                       e.End - e.right_overhang, e.Strand)
+                      for e in exons.itertuples()]
+    exons['ref_offset'] = np.cumsum(lengths) - lengths
+    exons['score_offset'] = np.cumsum(sizes) - sizes
+    for column, values in zip(WINDOW_COLUMNS, windows.T):
+        exons[column] = values
+
+    os.makedirs(output, exist_ok=True)
+    refs = np.lib.format.open_memmap(
+        os.path.join(output, 'refs.npy'), mode='w+', dtype=np.uint8,
+        shape=(int(lengths.sum()),))
+    scores = np.lib.format.open_memmap(
+        os.path.join(output, 'scores.npy'), mode='w+', dtype=np.float32,
+        shape=(int(sizes.sum()),))
+
+    rows = exons.itertuples()
+    if progress:
+        rows = tqdm(rows, total=len(exons))
+
+    X_ref = np.zeros((len(exons), len(REF_COLUMNS)), dtype=np.float32)
+    for i, exon in enumerate(rows):
+        exon_refs, X_ref[i], _, exon_scores = exon_snv_scores(
+            model, fasta, exon, batch_size, spliter)
+        refs[exon.ref_offset:exon.ref_offset + len(exon_refs)] = exon_refs
+        exon_scores = np.concatenate([s.ravel() for s in exon_scores])
+        scores[exon.score_offset:exon.score_offset + len(exon_scores)] = \
+            exon_scores
+    refs.flush()
+    scores.flush()
+
+    for column, values in zip(REF_COLUMNS, X_ref.T):
+        exons[column] = values
+    exons.to_csv(os.path.join(output, 'exons.tsv'), sep='\t', index=False,
+                 float_format='%.9g')
+    logger.info('Scores of SNVs of %d exons written to %s (%.1f MB)'
+                % (len(exons), output,
+                   (refs.nbytes + scores.nbytes) / 1e6))
+
+
+class SNVScoreTable:
+    """
+    Lookup of precomputed SNV scores written by `precompute_snvs`.
+    Arrays of scores are memory mapped, so only exons of looked up
+    SNVs are read from disk.
+
+    Args:
+      path: path of table directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.exons = pd.read_csv(os.path.join(path, 'exons.tsv'), sep='\t',
+                                 dtype={'Chromosome': str, 'gene_id': str,
+                                        'gene_name': str})
+        self.refs = np.load(os.path.join(path, 'refs.npy'), mmap_mode='r')
+        self.scores = np.load(os.path.join(path, 'scores.npy'),
+                              mmap_mode='r')
+
+        self._rows = list(self.exons.itertuples(index=False))
+        self._windows = self.exons[WINDOW_COLUMNS].values.reshape(-1, 5, 2)
+        self._ref_scores = self.exons[REF_COLUMNS].values
+        self._chroms = dict()
+        for chrom, df in self.exons.groupby('Chromosome'):
+            self._chroms[chrom] = (df.index.values, df['Start'].values,
+                                   (df['End'] - df['Start']).max())
+        self.contigs = set(self._chroms)
+
+    def lookup(self, chrom, pos, ref, alt):
+        '''
+        Returns rows of SNV in table as list of lists in the order of
+        SNV_TABLE_COLUMNS (one row per exon).
+        '''
+        if chrom not in self.contigs or ref not in BASES \
+           or alt not in BASES or ref == alt:
+            return list()
+        index, starts, max_length = self._chroms[chrom]
+        # exons are sorted by start and not longer than max_length
+        lo = np.searchsorted(starts, pos - max_length, 'left')
+        hi = np.searchsorted(starts, pos, 'right')
+        a = _alt_index(ref, alt)
+
+        rows = list()
+        for k in index[lo:hi]:
+            exon = self._rows[k]
+            i = pos - exon.Start
+            if i >= exon.End - exon.Start \
+               or self.refs[exon.ref_offset + i] != BASES.index(ref):
+                continue
+            # position in direction of strand
+            j = exon.End - exon.Start - i if exon.Strand == '-' else i
+            alt_scores = self._ref_scores[k].copy()
+            offset = exon.score_offset
+            for m, (s, e) in enumerate(self._windows[k]):
+                if s <= j < e:
+                    alt_scores[m] = self.scores[offset + (j - s) * 3 + a]
+                offset += (e - s) * 3
+            rows.append([chrom, pos, ref, alt, exon.exons, exon.gene_id,
+                         exon.gene_name] + self._ref_scores[k].tolist()
+                        + alt_scores.tolist())
+        return rows
+
+    def close(self):
+        self.refs = self.scores = None
+
+
+def _table_df(rows, pathogenicity=False, splicing_efficiency=False):
+    df = pd.DataFrame(rows, columns=SNV_TABLE_COLUMNS)
+    df.insert(0, 'ID', ["%s:%s:%s:['%s']" % tuple(r[:4]) for r in rows])
+    df = df.drop(columns=['CHROM', 'POS', 'REF', 'ALT'])
+    heads = predict_heads(df[REF_COLUMNS].values.astype(np.float32),
+                          df[ALT_COLUMNS].values.astype(np.float32),
+                          pathogenicity, splicing_efficiency)
+    df.insert(df.columns.get_loc('gene_name') + 1, 'delta_logit_psi',
+              heads.pop('delta_logit_psi'))
+    for k, v in heads.items():
+        df[k] = v
+    return df
+
+
+def lookup_vcf(table, vcf_file, gtf=None, fasta_file=None, model=None,
+               batch_size=512, pathogenicity=False,
+               splicing_efficiency=False, overhang=(100, 100),
+               lookup_batch_size=10000):
+    '''
+    Predict variants of vcf with precomputed SNV scores. Scores of SNVs
+    are looked up in table and only other variants (indels) are scored
+    with the model, if gtf and fasta_file are given. Predictions of
+    SNVs are returned before predictions of other variants.
+
+    Args:
+      table: path of table written by `precompute_snvs`
+        or SNVScoreTable.
+      vcf_file: vcf file of variants.
+      gtf: gtf file of table to score indels.
+      fasta_file: fasta file of genome to score indels.
+      model: mmsplice model object to score indels,
+        loaded on demand by default.
+      batch_size: batch size of prediction of indels.
+      pathogenicity: adds pathogenicity prediction as column.
+      splicing_efficiency: adds splicing_efficiency prediction as column.
+      overhang: overhang of exon of table.
+      lookup_batch_size: number of rows per returned dataframe.
+
+    Returns:
+      iterator of pd.DataFrame with columns of `predict_batch`
+        except exon_id and transcript_id.
+    '''
+    from cyvcf2 import VCF, Writer
+
+    if isinstance(table, str):
+        table = SNVScoreTable(table)
+    score_indels = gtf is not None and fasta_file is not None
+
+    vcf = VCF(vcf_file)
+    indel_fd, indel_vcf = tempfile.mkstemp(suffix='.vcf')
+    os.close(indel_fd)
+    writer = Writer(indel_vcf, vcf)
+    n_snvs = 0
+    n_indels = 0
+
+    rows = list()
+    for variant in vcf:
+        if len(variant.ALT) != 1:
+            logger.warning('Variant %s:%d has multiple alt alleles,'
+                           ' split them into multiple lines.'
+                           % (variant.CHROM, variant.POS))
+            continue
+        alt = variant.ALT[0]
+        if len(variant.REF) == 1 and len(alt) == 1 and alt in BASES:
+            n_snvs += 1
+            rows.extend(table.lookup(variant.CHROM, variant.POS,
+                                     variant.REF, alt))
+            if len(rows) >= lookup_batch_size:
+                yield _table_df(rows, pathogenicity, splicing_efficiency)
+                rows = list()
+        else:
+            n_indels += 1
+            writer.write_record(variant)
+    writer.close()
+    vcf.close()
+
+    if rows:
+        yield _table_df(rows, pathogenicity, splicing_efficiency)
+    logger.info('Scores of %d SNVs looked up in %s'
+                % (n_snvs, table.path))
+
+    try:
+        if not n_indels:
+            return
+        if not score_indels:
+            logger.warning('%d variants other than SNVs are skipped,'
+                           ' gtf and fasta are required to score them.'
+                           % n_indels)
+            return
+
+        from mmsplice.mmsplice import MMSplice, predict_batch
+        from mmsplice.vcf_dataloader import SplicingVCFDataloader
+
+        model = model or MMSplice()
+        dl = SplicingVCFDataloader(gtf, fasta_file, indel_vcf,
+                                   overhang=overhang)
+        columns = ['ID', 'exons', 'gene_id', 'gene_name',
+                   'delta_logit_psi'] + REF_COLUMNS + ALT_COLUMNS
+        if pathogenicity:
+            columns.append('pathogenicity')
+        if splicing_efficiency:
+            columns.append('efficiency')
+        for df in predict_batch(model, dl, batch_size=batch_size,
+                                progress=False, pathogenicity=pathogenicity,
+                                splicing_efficiency=splicing_efficiency):
+            yield df[columns]
+        logger.info('%d variants other than SNVs scored with model'
+                    % n_indels)
+    finally:
+        os.remove(indel_vcf)
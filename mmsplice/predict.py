@@ -0,0 +1,198 @@
+import os
+import logging
+import multiprocessing
+import numpy as np
+
+from mmsplice.mmsplice import MMSplice, predict_save, checkpoint_path
+from mmsplice.vcf_dataloader import SplicingVCFDataloader
+from mmsplice.writers import infer_output_format, concat_tables
+from mmsplice.profiling import start_profiling, stop_profiling, \
+    active_profiler, profile_path, merge_reports
+
+logger = logging.getLogger('mmsplice')
+logger.addHandler(logging.NullHandler())
+
+
+def worker_shards(shard=None, workers=1):
+    '''
+    Split shard of vcf batches into shards of workers.
+
+    Args:
+      shard: tuple of (i, n) or None for all batches.
+      workers: number of workers.
+
+    Returns:
+      list of shards (i, n), one per worker.
+    '''
+    i, n = shard or (0, 1)
+    return [(i + w * n, n * workers) for w in range(workers)]
+
+
+def available_cpus():
+    '''
+    Sorted ids of cpus the process may run on.
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def worker_cpus(workers, cpus=None):
+    '''
+    Split cpus into contiguous groups of workers, so workers do not
+    share cores.
+
+    Args:
+      workers: number of workers.
+      cpus: list of cpu ids, available cpus by default.
+
+    Returns:
+      list of lists of cpu ids, one per worker.
+    '''
+    cpus = cpus or available_cpus()
+    if workers > len(cpus):
+        raise ValueError('%d workers can not be pinned to %d cpus.'
+                         % (workers, len(cpus)))
+    return [[int(c) for c in group]
+            for group in np.array_split(cpus, workers)]
+
+
+def _predict_shard(gtf, fasta, vcf, output, shard=None, region=None,
+                   overhang=(100, 100), vcf_batch_size=10000,
+                   model_options=None, profile=None, genes=None, bed=None,
+                   **kwargs):
+    # profiling starts before loading of model and exons
+    started = profile is not None and active_profiler() is None
+    if started:
+        start_profiling()
+    try:
+        model = MMSplice(**(model_options or dict()))
+        dl = SplicingVCFDataloader(gtf, fasta, vcf, overhang=overhang,
+                                   region=region, shard=shard,
+                                   vcf_batch_size=vcf_batch_size,
+                                   genes=genes, bed=bed)
+        predict_save(model, dl, output, profile=profile, **kwargs)
+    finally:
+        if started:
+            stop_profiling()
+
+
+def _predict_shard_kwargs(kwargs):
+    return _predict_shard(**kwargs)
+
+
+def predict_vcf(gtf, fasta, vcf, output, batch_size=512, workers=1,
+                shard=None, region=None, output_format=None,
+                pathogenicity=False, splicing_efficiency=False,
+                overhang=(100, 100), vcf_batch_size=10000,
+                model_options=None, progress=True, resume=False,
+                cache=None, profile=None, genes=None, bed=None,
+                min_delta_logit_psi=None, min_pathogenicity=None,
+                top_k=None, intra_op_threads=None, inter_op_threads=None,
+                pin_cpus=False):
+    '''
+    Predict variants of vcf and write predictions to a file.
+
+    Args:
+      gtf: gtf file or 'grch37'/'grch38' for prebuild annotation.
+      fasta: fasta file of reference genome.
+      vcf: vcf file.
+      output: output file path.
+      batch_size: batch size of prediction.
+      workers: number of worker processes. Each worker loads the model
+        and processes every `workers`-th vcf batch, outputs of workers
+        are concatenated worker by worker.
+      shard: tuple of (i, n), only predicts i-th of n shards of vcf batches
+        so a job array of n jobs processes the whole vcf.
+      region: only predicts variants in region such as '17:41196000-41277000'.
+        Requires indexed vcf.
+      output_format: 'csv', 'parquet' or 'arrow'. If None, inferred from
+        extension of output file.
+      pathogenicity: adds pathogenicity prediction as column
+      splicing_efficiency: adds splicing_efficiency prediction as column
+      overhang: overhang of exon to fetch flanking sequence of exon.
+      vcf_batch_size: number of variants read from vcf at once,
+        unit of sharding.
+      model_options: dict of model file paths passed to MMSplice.
+      progress: show progress bar (only with single worker).
+      resume: resume interrupted run with the same arguments from its
+        checkpoint. Progress is checkpointed for csv and arrow outputs.
+      cache: path of sqlite database to cache predictions across runs
+        (see `predict_batch`), shared by workers.
+      profile: path of json report of time per stage and peak rss
+        (see `predict_save`). Reports of workers are merged.
+      genes: only predicts variants of exons of genes given as list of
+        gene ids, gene names or transcript ids.
+      bed: only predicts variants of exons overlapping regions of bed file.
+      min_delta_logit_psi, min_pathogenicity, top_k: only writes
+        exon-variant pairs passing thresholds and k exons with largest
+        absolute delta_logit_psi per variant (see `predict_batch`).
+      intra_op_threads: number of threads of tensorflow within an
+        operation per worker. By default cores are divided between
+        workers if there are several workers.
+      inter_op_threads: number of threads of tensorflow running
+        independent operations per worker.
+      pin_cpus: pin each worker to its own group of cores.
+    '''
+    output_format = output_format or infer_output_format(output)
+    profile = profile or profile_path(output)
+    checkpoint = output_format != 'parquet'
+    if resume and not checkpoint:
+        raise ValueError('Parquet output can not be resumed,'
+                         ' use csv or arrow output.')
+
+    model_options = dict(model_options or dict())
+    if inter_op_threads:
+        model_options['inter_op_threads'] = inter_op_threads
+    if intra_op_threads:
+        model_options['intra_op_threads'] = intra_op_threads
+    elif workers > 1:
+        # workers would oversubscribe cores with a thread per core each
+        model_options['intra_op_threads'] = max(
+            1, len(available_cpus()) // workers)
+
+    kwargs = dict(gtf=gtf, fasta=fasta, vcf=vcf, region=region,
+                  overhang=overhang, vcf_batch_size=vcf_batch_size,
+                  model_options=model_options, batch_size=batch_size,
+                  pathogenicity=pathogenicity,
+                  splicing_efficiency=splicing_efficiency,
+                  output_format=output_format, checkpoint=checkpoint,
+                  resume=resume, cache=cache, genes=genes, bed=bed,
+                  min_delta_logit_psi=min_delta_logit_psi,
+                  min_pathogenicity=min_pathogenicity, top_k=top_k)
+
+    if workers <= 1:
+        _predict_shard(output=output, shard=shard, progress=progress,
+                       profile=profile, **kwargs)
+        _remove(checkpoint_path(output))
+        return
+
+    shards = worker_shards(shard, workers)
+    parts = ['%s.part%d' % (output, w) for w in range(workers)]
+    profiles = ['%s.profile.json' % part if profile else None
+                for part in parts]
+    jobs = [dict(kwargs, output=part, shard=s, progress=False, profile=p)
+            for part, s, p in zip(parts, shards, profiles)]
+    if pin_cpus:
+        for job, cpus in zip(jobs, worker_cpus(workers)):
+            job['model_options'] = dict(model_options, cpus=cpus)
+
+    # spawn so workers do not inherit tensorflow state of parent
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        pool.map(_predict_shard_kwargs, jobs, chunksize=1)
+
+    logger.info('Concatenating outputs of %d workers' % workers)
+    concat_tables(parts, output, output_format)
+    for part in parts:
+        _remove(part)
+        _remove(checkpoint_path(part))
+
+    if profile:
+        merge_reports(profiles, profile)
+        for p in profiles:
+            _remove(p)
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('mmsplice')
+logger.addHandler(logging.NullHandler())
+
+PROFILE_ENV = 'MMSPLICE_PROFILE'
+
+_profiler = None
+
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of the process in MB.
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+class _Stage:
+
+    def __init__(self, profiler, name, items):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, time.perf_counter() - self.start,
+                          self.items)
+
+
+class _NullStage:
+    # shared no-op stage when profiling is off, `items` is ignored
+    items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Profiler:
+    """
+    Records wall time, number of calls and number of items of stages of
+    prediction. Overhead is two clock reads and a dict update per call
+    of a stage.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stage(self, name, items=1):
+        '''
+        Context manager timing a stage processing given number of items.
+        Items can be set later with `items` attribute of returned object.
+        '''
+        return _Stage(self, name, items)
+
+    def add(self, name, seconds, items=1):
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = [0., 0, 0]
+            stats[0] += seconds
+            stats[1] += 1
+            stats[2] += items
+
+    def report(self):
+        '''
+        Report as dict of wall time, peak rss and time, calls, items
+        and items/s per stage.
+        '''
+        stages = OrderedDict()
+        with self._lock:
+            for name, (seconds, calls, items) in self.stages.items():
+                stages[name] = {
+                    'time': seconds,
+                    'calls': calls,
+                    'items': items,
+                    'items_per_s': items / seconds if seconds else None
+                }
+        return {
+            'wall_time': time.time() - self.start,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': stages
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        logger.info('Profile written to %s' % path)
+
+    def __str__(self):
+        report = self.report()
+        lines = ['wall time %.2f s, peak rss %.1f MB'
+                 % (report['wall_time'], report['peak_rss_mb'])]
+        for name, s in report['stages'].items():
+            lines.append('%-24s %10.3f s %10d calls %12d items'
+                         % (name, s['time'], s['calls'], s['items']))
+        return '\n'.join(lines)
+
+
+def start_profiling():
+    '''
+    Starts profiling of stages unless it is already started.
+    Returns the active Profiler.
+    '''
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
+
+
+def stop_profiling():
+    '''
+    Stops profiling and returns the stopped Profiler or None.
+    '''
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def active_profiler():
+    return _profiler
+
+
+def stage(name, items=1):
+    '''
+    Context manager timing a stage if profiling is active, otherwise a
+    no-op.
+
+    Args:
+      name: name of stage.
+      items: number of items processed in the stage.
+    '''
+    if _profiler is None:
+        return _NULL_STAGE
+    return _profiler.stage(name, items)
+
+
+def profile_path(output):
+    '''
+    Path of profile report of output set by `MMSPLICE_PROFILE`:
+    `output + '.profile.json'` if it is 1, the value if it is a path,
+    otherwise None.
+    '''
+    value = os.environ.get(PROFILE_ENV, '')
+    if value in ('', '0'):
+        return None
+    if value == '1':
+        return output + '.profile.json'
+    return value
+
+
+def merge_reports(paths, path):
+    '''
+    Merges profile reports of worker processes into one report. Stage
+    statistics are summed up, wall time and peak rss are the maximum
+    of workers.
+
+    Args:
+      paths: profile reports of workers, missing paths are skipped.
+      path: output path of merged report.
+    '''
+    merged = {'wall_time': 0., 'peak_rss_mb': 0.,
+              'stages': OrderedDict()}
+    for p in paths:
+        if not os.path.exists(p):
+            continue
+        with open(p) as f:
+            report = json.load(f, object_pairs_hook=OrderedDict)
+        merged['wall_time'] = max(merged['wall_time'], report['wall_time'])
+        merged['peak_rss_mb'] = max(merged['peak_rss_mb'],
+                                    report['peak_rss_mb'])
+        for name, s in report['stages'].items():
+            m = merged['stages'].setdefault(
+                name, {'time': 0., 'calls': 0, 'items': 0})
+            for k in ('time', 'calls', 'items'):
+                m[k] += s[k]
+    for m in merged['stages'].values():
+        m['items_per_s'] = m['items'] / m['time'] if m['time'] else None
+    with open(path, 'w') as f:
+        json.dump(merged, f, indent=2)
+
+
+if os.environ.get(PROFILE_ENV, '') not in ('', '0'):
+    # started at import to include loading of exons and models
+    start_profiling()
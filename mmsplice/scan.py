@@ -0,0 +1,274 @@
+import logging
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import as_strided
+from pybedtools import Interval
+from kipoiseq.extractors import FastaStringExtractor
+
+from mmsplice.utils import logit
+from mmsplice.exon_dataloader import SeqSpliter, encode_seqs
+from mmsplice.precompute import COMPLEMENT
+from mmsplice.profiling import stage
+
+logger = logging.getLogger('mmsplice')
+logger.addHandler(logging.NullHandler())
+
+SCAN_COLUMNS = ['Chromosome', 'Position', 'Strand', 'acceptor', 'donor']
+
+
+def _windows(x, offset, n, size):
+    # zero-copy view of n windows of size positions starting at offset
+    x = x[offset:]
+    return as_strided(x, (n, size, x.shape[1]),
+                      (x.strides[0],) + x.strides)
+
+
+_ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x))
+}
+
+
+def _activation(name):
+    if name not in _ACTIVATIONS:
+        raise ValueError('Activation "%s" is not supported.' % name)
+    return _ACTIVATIONS[name]
+
+
+def _pointwise(layer):
+    # numpy function of layer applied to each position or vector
+    name = type(layer).__name__
+    config = layer.get_config()
+    weights = [w.astype(np.float32) for w in layer.get_weights()]
+
+    if name == 'Dropout':
+        return lambda x: x
+    if name == 'Activation':
+        return _activation(config['activation'])
+    if name == 'ReLU' and not any(config.get(k) for k in
+                                  ['max_value', 'negative_slope',
+                                   'threshold']):
+        return _ACTIVATIONS['relu']
+    if name == 'BatchNormalization' and config['axis'] in (-1, 2):
+        gamma = weights.pop(0) if config['scale'] else 1
+        beta = weights.pop(0) if config['center'] else 0
+        mean, variance = weights
+        scale = gamma / np.sqrt(variance + config['epsilon'])
+        shift = beta - mean * scale
+        return lambda x: x * scale + shift
+    if name == 'Dense' or (hasattr(layer, 'kernel_size')
+                           and tuple(layer.kernel_size) == (1,)):
+        kernel = weights[0].reshape(-1, weights[0].shape[-1])
+        bias = weights[1] if config['use_bias'] else 0
+        activation = _activation(config['activation'])
+        return lambda x: activation(x @ kernel + bias)
+    raise ValueError('Layer %s is not supported.' % name)
+
+
+def _compose(functions):
+    def f(x):
+        for function in functions:
+            x = function(x)
+        return x
+    return f
+
+
+def sliding_module(module):
+    '''
+    Converts a splice site module scoring windows of fixed length into a
+    function scoring the windows starting at every position of an encoded
+    sequence in one pass. The convolution and the layers before flatten
+    are evaluated once per position of the sequence, and the dense layer
+    after flatten is evaluated as a convolution over these activations.
+    Positions near the ends of a window, which see zero padding of
+    'same' convolution within the window, are evaluated with the taps of
+    the convolution inside the window, so scores are the same as of the
+    module applied to each window.
+
+    Args:
+      module: keras model of (windows, window size, 4) to (windows, 1)
+        made of an optional convolution followed by layers applied to
+        each position, flatten, dense and layers applied to each vector.
+
+    Returns:
+      tuple of window size and function of encoded sequence of
+        (n + window size - 1, 4) to np.array of n scores.
+
+    Raises:
+      ValueError: if module is not made of such layers.
+    '''
+    layers = [layer for layer in module.layers
+              if type(layer).__name__ != 'InputLayer']
+    names = [type(layer).__name__ for layer in layers]
+    if 'Flatten' not in names:
+        raise ValueError('Module without flatten layer is not supported.')
+    window = module.input_shape[1]
+    flatten = names.index('Flatten')
+
+    conv = layers[0] if hasattr(layers[0], 'kernel_size') \
+        and tuple(layers[0].kernel_size) != (1,) else None
+    if conv is not None:
+        config = conv.get_config()
+        if tuple(config['strides']) != (1,) \
+           or tuple(config['dilation_rate']) != (1,) \
+           or config['padding'] not in ('same', 'valid'):
+            raise ValueError('Convolution with strides, dilation or'
+                             ' causal padding is not supported.')
+        kernel, bias = [w.astype(np.float32) for w in conv.get_weights()]
+        size = kernel.shape[0]
+        if config['padding'] == 'same':
+            left, right = (size - 1) // 2, size // 2
+            width = window
+        else:
+            left, right = 0, 0
+            width = window - size + 1
+        features = _compose([_activation(config['activation'])]
+                            + [_pointwise(layer)
+                               for layer in layers[1:flatten]])
+    else:
+        features = _compose([_pointwise(layer)
+                             for layer in layers[:flatten]])
+        width = window
+
+    # dropout between flatten and dense is identity at inference
+    index = flatten + 1
+    while index < len(layers) and names[index] == 'Dropout':
+        index += 1
+    if index == len(layers) or names[index] != 'Dense':
+        raise ValueError('Flatten should be followed by dense layer.')
+    dense = layers[index]
+    config = dense.get_config()
+    weights = [w.astype(np.float32) for w in dense.get_weights()]
+    # dense kernel as convolution over positions of window
+    dense_kernel = weights[0].reshape(width, -1, weights[0].shape[-1])
+    dense_bias = weights[1] if config['use_bias'] else 0
+    head = _compose([_activation(config['activation'])]
+                    + [_pointwise(layer) for layer in layers[index + 1:]])
+
+    def taps(x, j, n, indices):
+        # pre-activations of position j of n windows with given taps
+        return sum(x[j + i:j + i + n] @ kernel[i] for i in indices) + bias
+
+    def score(x):
+        x = x.astype(np.float32)
+        n = len(x) - window + 1
+        if conv is None:
+            activations = features(x)
+        else:
+            x = np.pad(x, ((left, right), (0, 0)), 'constant')
+            activations = features(taps(x, 0, n + width - 1, range(size)))
+
+        z = dense_bias
+        for j in range(width):
+            if conv is None or left <= j < window - size + 1 + left:
+                a = activations[j:j + n]
+            else:
+                # taps of convolution inside the window
+                a = features(taps(x, j, n, range(max(left - j, 0),
+                                                 min(window - j + left,
+                                                     size))))
+            z = z + a @ dense_kernel[j]
+        return head(z)[:, 0]
+
+    return window, score
+
+
+def _module_scorer(module, batch_size):
+    # sliding evaluation of module with fallback to inference of windows
+    try:
+        return sliding_module(module)
+    except ValueError as e:
+        logger.warning('%s Windows of module are scored one by one.' % e)
+    window = module.input_shape[1]
+
+    def score(x):
+        n = len(x) - window + 1
+        return module.predict(_windows(x, 0, n, window),
+                              batch_size=batch_size)[:, 0]
+
+    return window, score
+
+
+def _extract(fasta, chrom, start, end):
+    # sequence of plus strand padded with N outside of chromosome
+    length = len(fasta.fasta[chrom])
+    seq = fasta.extract(Interval(chrom, max(start, 0),
+                                 min(end, length))).upper()
+    return 'N' * max(-start, 0) + seq + 'N' * max(end - length, 0)
+
+
+def scan_region(model, fasta_file, chrom, start=0, end=None, strand='+',
+                chunk_size=100000, batch_size=4096, spliter=None):
+    '''
+    Scores every position of a region as acceptor and donor splice site
+    to find cryptic splice sites. Acceptor and donor modules are
+    evaluated as sliding convolutions over each encoded chunk of the
+    region in one pass (see `sliding_module`), so memory is bounded by
+    chunk_size and whole chromosomes can be streamed.
+
+    Acceptor score of a position is of an exon starting at the position
+    and donor score is of an exon ending at the position (in direction
+    of strand), same as acceptor and donor scores of `MMSplice.predict`.
+
+    Args:
+      model: MMSplice model.
+      fasta_file: fasta file of genome.
+      chrom: chromosome.
+      start: zero-based start of region.
+      end: end of region (exclusive), end of chromosome by default.
+      strand: '+' or '-'.
+      chunk_size: number of positions scored at once.
+      batch_size: number of windows per inference batch of modules
+        which cannot be evaluated as sliding convolutions.
+      spliter: SeqSpliter defining windows of acceptor and donor,
+        `spliter` of the model by default.
+
+    Returns:
+      iterator of pd.DataFrame of SCAN_COLUMNS per chunk sorted by
+        position, with 1-based Position and logit of acceptor and donor.
+    '''
+    if strand not in ('+', '-'):
+        raise ValueError('Strand should be "+" or "-".')
+    spliter = spliter or getattr(model, 'spliter', None) or SeqSpliter()
+    fasta = FastaStringExtractor(fasta_file)
+    if end is None:
+        end = len(fasta.fasta[chrom])
+
+    acceptor_len, score_acceptor = _module_scorer(model.acceptorM,
+                                                  batch_size)
+    donor_len, score_donor = _module_scorer(model.donorM, batch_size)
+    # context on each side of chunk in either direction of strand
+    flank = max(spliter.acceptor_intron_len, spliter.acceptor_exon_len,
+                spliter.donor_exon_len, spliter.donor_intron_len + 1)
+
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        n = chunk_end - chunk_start
+
+        with stage('extract', n):
+            seq = _extract(fasta, chrom, chunk_start - flank,
+                           chunk_end + flank)
+            if strand == '-':
+                seq = seq.translate(COMPLEMENT)[::-1]
+        with stage('encode', n):
+            x = encode_seqs([seq])[0]
+
+        # windows of positions of chunk in direction of strand
+        with stage('inference.acceptor', n):
+            offset = flank - spliter.acceptor_intron_len
+            acceptor = score_acceptor(x[offset:offset + n + acceptor_len - 1])
+        with stage('inference.donor', n):
+            offset = flank - spliter.donor_exon_len + 1
+            donor = score_donor(x[offset:offset + n + donor_len - 1])
+
+        if strand == '-':
+            acceptor, donor = acceptor[::-1], donor[::-1]
+
+        yield pd.DataFrame({
+            'Chromosome': chrom,
+            'Position': np.arange(chunk_start + 1, chunk_end + 1),
+            'Strand': strand,
+            'acceptor': logit(acceptor),
+            'donor': logit(donor)
+        }, columns=SCAN_COLUMNS)
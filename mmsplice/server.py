@@ -0,0 +1,489 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from keras import backend as K
+
+from mmsplice.mmsplice import MMSplice, FrozenMMSplice, THREAD_OPTIONS
+from mmsplice.exon_dataloader import SeqSpliter
+from mmsplice.utils import predict_heads
+
+logger = logging.getLogger('mmsplice')
+logger.addHandler(logging.NullHandler())
+
+RESPONSE_KEYWORD = 'MMSPLICE-RESPONSE:'
+# response of request which cannot be parsed, so its records are unknown
+ERROR_KEYWORD = RESPONSE_KEYWORD + 'ERROR:'
+# target of seconds from process start until `mmsplice run` or
+# `mmsplice serve` loading a frozen graph is ready, including imports of
+# tensorflow (checked by tests/test_main.py)
+FROZEN_READY_TARGET = 10
+
+
+def load_model(options=None):
+    '''
+    Load and warm up model for scoring server. Model is loaded from frozen
+    graph (see `mmsplice freeze`) if `frozen` option or `MMSPLICE_FROZEN`
+    environment variable is set, which is faster than loading keras models.
+
+    Args:
+      options: dict of model file paths and threading options
+        passed to MMSplice or `frozen` path of frozen graph.
+        Empty values are ignored.
+    '''
+    start = time.monotonic()
+    options = {k: v for k, v in (options or dict()).items() if v}
+    frozen = options.pop('frozen', None) or os.environ.get('MMSPLICE_FROZEN')
+    spliter = SeqSpliter(pattern_warning=False)
+
+    if frozen:
+        # exon module of keras scores exons longer than the chunk size
+        kwargs = {k: options[k] for k in THREAD_OPTIONS + ['exonM']
+                  if k in options}
+        model = FrozenMMSplice(frozen, seq_spliter=spliter, **kwargs)
+    else:
+        K.clear_session()
+        model = MMSplice(seq_spliter=spliter, **options)
+        for attr in ['acceptor_intronM', 'acceptorM', 'exonM',
+                     'donorM', 'donor_intronM']:
+            getattr(model, attr)._make_predict_function()
+
+    # first call of session initializes kernels of the graph.
+    model.predict("A" * 100, (4, 4))
+    logger.info('Model loaded in %.2f s' % (time.monotonic() - start))
+    return model
+
+
+class ScoreCache:
+    '''
+    LRU cache of modular scores keyed by sequence hash and overhang.
+    Ref sequence of an exon is sent once per variant and transcript,
+    so most ref sequences are scored only once.
+
+    Args:
+      maxsize: maximum number of cached sequences.
+    '''
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(seq, overhang):
+        return hashlib.sha1(seq.encode()).digest(), overhang
+
+    def predict(self, model, seqs, overhangs):
+        '''
+        Predict modular scores of sequences, only sequences
+        not in cache are scored by model.
+        '''
+        scores = np.zeros((len(seqs), 5))
+        missing = OrderedDict()
+
+        for i, (seq, overhang) in enumerate(zip(seqs, overhangs)):
+            key = self.key(seq, overhang)
+            if key in self.scores:
+                self.scores.move_to_end(key)
+                scores[i] = self.scores[key]
+                self.hits += 1
+            elif key in missing:
+                missing[key].append(i)
+                self.hits += 1
+            else:
+                missing[key] = [i]
+                self.misses += 1
+
+        if missing:
+            idx = [i[0] for i in missing.values()]
+            new_scores = model.predict_many([seqs[i] for i in idx],
+                                            [overhangs[i] for i in idx])
+            for (key, i), score in zip(missing.items(), new_scores):
+                scores[i] = score
+                self.scores[key] = score
+            while len(self.scores) > self.maxsize:
+                self.scores.popitem(last=False)
+
+        return scores
+
+    def __str__(self):
+        total = self.hits + self.misses
+        return 'score cache: %d hits, %d misses (hit rate %.1f%%), ' \
+            '%d cached sequences' % (self.hits, self.misses,
+                                     100 * self.hits / max(total, 1),
+                                     len(self.scores))
+
+
+def score_records(model, records, cache=None):
+    '''
+    Score batch of records of `run` protocol.
+
+    Args:
+      model: MMSplice model.
+      records: list of dict with keys of
+        ('intronl_len', 'intronr_len', 'ref_seq', 'alt_seq').
+      cache: optional ScoreCache of modular scores.
+
+    Returns:
+      np.array of shape (len(records), 12) as ref scores, alt scores,
+        delta_logit_psi and pathogenicity.
+    '''
+    overhangs = [(r['intronl_len'], r['intronr_len']) for r in records]
+    seqs = [r['ref_seq'] for r in records] + [r['alt_seq'] for r in records]
+
+    if cache is None:
+        scores = model.predict_many(seqs, overhangs * 2)
+    else:
+        scores = cache.predict(model, seqs, overhangs * 2)
+    ref_scores, alt_scores = scores[:len(records)], scores[len(records):]
+    heads = predict_heads(ref_scores, alt_scores, pathogenicity=True)
+
+    return np.column_stack([
+        ref_scores,
+        alt_scores,
+        heads['delta_logit_psi'],
+        heads['pathogenicity']
+    ])
+
+
+def parse_request(line):
+    '''
+    Parse request line of a single record or a json array of records.
+    '''
+    request = json.loads(line.strip())
+    if isinstance(request, dict):
+        return [request]
+    if not isinstance(request, list):
+        raise ValueError('Request needs to be json object or array.')
+    return request
+
+
+def validate_record(record):
+    '''
+    Raises ValueError if record misses keys or values have wrong types,
+    so it fails before it is merged into a micro batch.
+    '''
+    if not isinstance(record, dict):
+        raise ValueError('Record needs to be json object.')
+    for key in ('intronl_len', 'intronr_len'):
+        if not isinstance(record.get(key), int) \
+           or isinstance(record[key], bool):
+            raise ValueError('Record needs integer "%s".' % key)
+    for key in ('ref_seq', 'alt_seq'):
+        if not isinstance(record.get(key), str):
+            raise ValueError('Record needs string "%s".' % key)
+
+
+def format_response(scores):
+    return RESPONSE_KEYWORD + ','.join(map(str, scores)) + '\n'
+
+
+def format_error(error):
+    return ERROR_KEYWORD + ' '.join(str(error).split()) + '\n'
+
+
+class LatencyStats:
+    '''
+    Keeps latencies of the last `size` requests.
+
+    Args:
+      size: number of latest requests to keep.
+    '''
+
+    def __init__(self, size=100000):
+        self.latencies = deque(maxlen=size)
+        self.n_requests = 0
+
+    def add(self, latency):
+        self.latencies.append(latency)
+        self.n_requests += 1
+
+    def percentiles(self, q=(50, 90, 99, 100)):
+        '''
+        Returns dict of latency percentiles in milliseconds
+        such as {'p50': 1.2, 'p90': 3.1, 'p99': 8.3, 'p100': 9.0}.
+        '''
+        if not self.latencies:
+            return {'p%d' % i: float('nan') for i in q}
+        values = np.percentile(np.array(self.latencies) * 1000, q)
+        return {'p%d' % i: v for i, v in zip(q, values)}
+
+    def __str__(self):
+        return 'latency of %d requests (ms): %s' % (
+            self.n_requests, ', '.join('%s=%.2f' % kv for kv in
+                                       self.percentiles().items()))
+
+
+class MicroBatcher:
+    '''
+    Collects records submitted by concurrent requests into micro batches
+    and scores each micro batch with one model call in executor thread,
+    so the event loop keeps reading requests while a batch is scored.
+
+    Args:
+      model: MMSplice model.
+      max_batch_size: maximum number of records in micro batch.
+      max_latency: maximum time in seconds to wait for other requests
+        after the first request of micro batch arrived.
+      cache: optional ScoreCache of modular scores.
+    '''
+
+    def __init__(self, model, max_batch_size=512, max_latency=0.01,
+                 cache=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.cache = cache
+        self.pending = list()
+        self.n_pending = 0
+        self._arrived = asyncio.Event()
+        self._full = asyncio.Event()
+        # models need to be called in graph they were loaded.
+        self.graph = getattr(model, 'graph', None) or K.get_session().graph
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, records):
+        '''
+        Score records, returns when micro batch of records is scored.
+        '''
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((records, future))
+        self.n_pending += len(records)
+        self._arrived.set()
+        if self.n_pending >= self.max_batch_size:
+            self._full.set()
+        return await future
+
+    async def _next_batch(self):
+        await self._arrived.wait()
+        try:
+            await asyncio.wait_for(self._full.wait(), self.max_latency)
+        except asyncio.TimeoutError:
+            pass
+
+        n_records = 0
+        for i, (records, _) in enumerate(self.pending):
+            if i > 0 and n_records + len(records) > self.max_batch_size:
+                break
+            n_records += len(records)
+        else:
+            i = len(self.pending)
+
+        requests, self.pending = self.pending[:i], self.pending[i:]
+        self.n_pending -= n_records
+
+        if not self.pending:
+            self._arrived.clear()
+        if self.n_pending < self.max_batch_size:
+            self._full.clear()
+        return requests
+
+    def _score(self, records):
+        with self.graph.as_default():
+            if not records:
+                return np.zeros((0, 12))
+            return score_records(self.model, records, self.cache)
+
+    async def _loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            requests = await self._next_batch()
+            records = [r for request, _ in requests for r in request]
+            try:
+                scores = await loop.run_in_executor(
+                    self.executor, self._score, records)
+            except Exception:
+                # score requests separately so only failing requests
+                # get the error, not other clients of the micro batch
+                for request, future in requests:
+                    try:
+                        result = await loop.run_in_executor(
+                            self.executor, self._score, request)
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                    else:
+                        if not future.done():
+                            future.set_result(result)
+                continue
+
+            start = 0
+            for request, future in requests:
+                end = start + len(request)
+                if not future.done():
+                    future.set_result(scores[start:end])
+                start = end
+
+
+class ScoringServer:
+    '''
+    Asyncio scoring server. Request lines of the `run` protocol are read,
+    scored in micro batches and responses are written concurrently;
+    responses of a client are written in the order of its requests.
+
+    Args:
+      model: MMSplice model.
+      max_batch_size: maximum number of records in micro batch.
+      max_latency: maximum waiting time in seconds to fill micro batch.
+      max_pending: maximum number of requests of a client waiting for
+        response before reading of its requests pauses.
+      cache_size: maximum number of sequences in score cache,
+        0 disables cache.
+    '''
+
+    def __init__(self, model, max_batch_size=512, max_latency=0.01,
+                 max_pending=1024, cache_size=100000):
+        self.cache = ScoreCache(cache_size) if cache_size > 0 else None
+        self.batcher = MicroBatcher(model, max_batch_size, max_latency,
+                                    self.cache)
+        self.latency = LatencyStats()
+        self.max_pending = max_pending
+
+    async def _respond(self, line, start):
+        # one response line per record, so clients stay in sync
+        try:
+            records = parse_request(line)
+        except ValueError as e:
+            logger.error('Failed to parse request: %s' % e)
+            return format_error(e), start
+
+        try:
+            for record in records:
+                validate_record(record)
+            scores = await self.batcher.submit(records)
+            response = ''.join(format_response(s) for s in scores.tolist())
+        except Exception as e:
+            logger.error('Failed to score request: %s' % e)
+            response = (RESPONSE_KEYWORD + '\n') * len(records)
+        return response, start
+
+    async def _write_responses(self, responses, write):
+        loop = asyncio.get_event_loop()
+        while True:
+            task = await responses.get()
+            if task is None:
+                break
+            response, start = await task
+            await write(response.encode())
+            self.latency.add(loop.time() - start)
+
+    async def handle(self, readline, write):
+        '''
+        Serve requests of a client until end of its input.
+
+        Args:
+          readline: coroutine function returning next request line
+            (bytes) or empty bytes at the end of input.
+          write: coroutine function writing response (bytes).
+        '''
+        loop = asyncio.get_event_loop()
+        responses = asyncio.Queue(maxsize=self.max_pending)
+        writer = asyncio.ensure_future(
+            self._write_responses(responses, write))
+
+        while True:
+            line = await readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            await responses.put(asyncio.ensure_future(
+                self._respond(line.decode(), loop.time())))
+
+        await responses.put(None)
+        await writer
+
+    async def _handle_connection(self, reader, writer):
+        async def write(data):
+            writer.write(data)
+            await writer.drain()
+
+        try:
+            await self.handle(reader.readline, write)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.warning('Client disconnected: %s' % e)
+        finally:
+            writer.close()
+
+    def report(self):
+        logger.info(str(self.latency))
+        if self.cache is not None:
+            logger.info(str(self.cache))
+
+    def serve_unix(self, socket_path, ready=None):
+        '''
+        Serve clients on unix domain socket until SIGINT or SIGTERM.
+
+        Args:
+          socket_path: path of unix domain socket.
+          ready: called once the server listens.
+        '''
+        loop = asyncio.get_event_loop()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        server = loop.run_until_complete(asyncio.start_unix_server(
+            self._handle_connection, socket_path, limit=2 ** 28))
+        self.batcher.start()
+        if ready is not None:
+            ready()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, loop.stop)
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.batcher.stop()
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.report()
+
+    def serve_stdio(self, stdin=None, stdout=None):
+        '''
+        Serve requests of stdin until end of input. Stdin is read
+        in a separate thread so reading never waits for scoring.
+        '''
+        stdin = stdin or sys.stdin.buffer
+        stdout = stdout or sys.stdout.buffer
+        loop = asyncio.get_event_loop()
+        lines = asyncio.Queue()
+
+        def _read():
+            for line in iter(stdin.readline, b''):
+                loop.call_soon_threadsafe(lines.put_nowait, line)
+            loop.call_soon_threadsafe(lines.put_nowait, b'')
+
+        async def write(data):
+            stdout.write(data)
+            stdout.flush()
+
+        threading.Thread(target=_read, daemon=True).start()
+        self.batcher.start()
+        try:
+            loop.run_until_complete(self.handle(lines.get, write))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.batcher.stop()
+            self.report()
@@ -0,0 +1,146 @@
+import os
+import time
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+from pybedtools import Interval
+from concise.preprocessing import encodeDNA
+from kipoiseq.extractors import FastaStringExtractor
+
+from mmsplice.mmsplice import MMSplice
+from mmsplice.vcf_dataloader import read_exons, SplicingVCFDataloader
+from mmsplice.predict import available_cpus
+
+logger = logging.getLogger('mmsplice')
+logger.addHandler(logging.NullHandler())
+
+
+def write_synthetic_vcf(path, n, gtf, fasta_file, seed=0):
+    '''
+    Writes sorted vcf of n random variants (90% SNVs, 5% deletions and
+    5% insertions) in exons of gtf and their overhang.
+
+    Args:
+      path: output vcf file.
+      n: number of variants.
+      gtf: gtf file or 'grch37'/'grch38' for prebuild annotation.
+      fasta_file: fasta file of genome.
+      seed: seed of random variants.
+    '''
+    rng = np.random.RandomState(seed)
+    fasta = FastaStringExtractor(fasta_file)
+    df = read_exons(gtf).df
+    df = df[df['Chromosome'].astype(str).isin(fasta.fasta.keys())] \
+        .drop_duplicates(['Chromosome', 'Start', 'End'])
+    lengths = (df['End'] - df['Start']).values
+    exons = rng.choice(len(df), n, p=lengths / lengths.sum())
+    variants = pd.DataFrame({
+        'CHROM': df['Chromosome'].astype(str).values[exons],
+        'POS': df['Start'].values[exons]
+        + (rng.rand(n) * lengths[exons]).astype(int),
+        'kind': rng.choice(3, n, p=[.9, .05, .05])
+    }, columns=['CHROM', 'POS', 'kind']).sort_values(['CHROM', 'POS'])
+
+    with open(path, 'w') as f:
+        f.write('##fileformat=VCFv4.0\n')
+        for chrom in variants['CHROM'].unique():
+            f.write('##contig=<ID=%s,length=%d>\n'
+                    % (chrom, len(fasta.fasta[chrom])))
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for chrom, pos, kind in variants.itertuples(index=False):
+            seq = fasta.extract(Interval(chrom, pos - 1, pos + 2)).upper()
+            ref = seq[0]
+            if kind == 0:
+                alt = 'ACGT'[('ACGT'.index(ref) + rng.randint(1, 4)) % 4] \
+                    if ref in 'ACGT' else 'A'
+            elif kind == 1:
+                ref = seq
+                alt = ref[0]
+            else:
+                alt = ref + ''.join(rng.choice(list('ACGT'), 2))
+            f.write("%s\t%d\t%s:%d:%s:['%s']\t%s\t%s\t.\t.\t.\n"
+                    % (chrom, pos, chrom, pos, ref, alt, ref, alt))
+
+
+def _power_of_two_threads():
+    n = len(available_cpus())
+    threads = [2 ** i for i in range(n.bit_length()) if 2 ** i <= n]
+    return threads + [n] if threads[-1] != n else threads
+
+
+def tune_threads(gtf, fasta_file, vcf_file=None, n_variants=1000,
+                 intra_op_threads=None, inter_op_threads=(1, 2),
+                 batch_sizes=(64, 128, 256, 512), repeats=3,
+                 model_options=None):
+    '''
+    Measures inference throughput for combinations of thread counts
+    and batch sizes on sequences of exon-variant pairs.
+
+    Args:
+      gtf: gtf file or 'grch37'/'grch38' for prebuild annotation.
+      fasta_file: fasta file of genome.
+      vcf_file: vcf file of variants. By default, n_variants synthetic
+        variants around exons (as in the benchmarks) are used.
+      n_variants: number of synthetic variants.
+      intra_op_threads: list of numbers of threads within an operation,
+        powers of two up to the number of available cpus by default.
+      inter_op_threads: list of numbers of threads running independent
+        operations.
+      batch_sizes: list of batch sizes.
+      repeats: throughput is the best of repeats.
+      model_options: dict of model file paths passed to MMSplice.
+
+    Returns:
+      pd.DataFrame of intra_op_threads, inter_op_threads, batch_size and
+        seqs_per_s sorted by throughput, best configuration first.
+    '''
+    intra_op_threads = intra_op_threads or _power_of_two_threads()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if vcf_file is None:
+            vcf_file = os.path.join(tmpdir, 'synthetic.vcf')
+            write_synthetic_vcf(vcf_file, n_variants, gtf, fasta_file)
+        dl = SplicingVCFDataloader(gtf, fasta_file, vcf_file, encode=False)
+        splits = list()
+        for row in dl:
+            splits.append(row['inputs']['seq'])
+            splits.append(row['inputs']['mut_seq'])
+
+    batches = {
+        batch_size: [{k: encodeDNA([s[k] for s in splits[i:i + batch_size]])
+                      for k in splits[0]}
+                     for i in range(0, len(splits), batch_size)]
+        for batch_size in batch_sizes
+    }
+
+    results = list()
+    for intra in intra_op_threads:
+        for inter in inter_op_threads:
+            model = MMSplice(intra_op_threads=intra, inter_op_threads=inter,
+                             **(model_options or dict()))
+            for batch_size in batch_sizes:
+                # first call initializes kernels of the graph
+                model.predict_on_batch(batches[batch_size][0])
+                seconds = float('inf')
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    for batch in batches[batch_size]:
+                        model.predict_on_batch(batch)
+                    seconds = min(seconds, time.perf_counter() - start)
+                results.append({
+                    'intra_op_threads': intra,
+                    'inter_op_threads': inter,
+                    'batch_size': batch_size,
+                    'seqs_per_s': len(splits) / seconds
+                })
+                logger.info('intra_op_threads=%d inter_op_threads=%d'
+                            ' batch_size=%d: %.1f seqs/s'
+                            % (intra, inter, batch_size,
+                               results[-1]['seqs_per_s']))
+
+    columns = ['intra_op_threads', 'inter_op_threads', 'batch_size',
+               'seqs_per_s']
+    return pd.DataFrame(results, columns=columns) \
+        .sort_values('seqs_per_s', ascending=False) \
+        .reset_index(drop=True)
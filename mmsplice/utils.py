@@ -1,17 +1,19 @@
-from collections import namedtuple
+import re
+import csv
+import gzip
+from collections import namedtuple, OrderedDict
 import pandas as pd
 import numpy as np
 import pyranges
-from kipoiseq.extractors import MultiSampleVCF
-from sklearn.externals import joblib
 from pkg_resources import resource_filename
 
-LINEAR_MODEL = joblib.load(resource_filename(
-    'mmsplice', 'models/linear_model.pkl'))
-LOGISTIC_MODEL = joblib.load(resource_filename(
-    'mmsplice', 'models/Pathogenicity.pkl'))
-EFFICIENCY_MODEL = joblib.load(resource_filename(
-    'mmsplice', 'models/splicing_efficiency.pkl'))
+# scikit-learn models of heads, only read by `export_heads`
+LINEAR_MODEL_FILE = resource_filename('mmsplice', 'models/linear_model.pkl')
+LOGISTIC_MODEL_FILE = resource_filename(
+    'mmsplice', 'models/Pathogenicity.pkl')
+EFFICIENCY_MODEL_FILE = resource_filename(
+    'mmsplice', 'models/splicing_efficiency.pkl')
+HEADS = resource_filename('mmsplice', 'models/heads.npz')
 
 
 class Variant(namedtuple('Variant', ['CHROM', 'POS', 'REF', 'ALT'])):
@@ -72,20 +74,284 @@ def max_varEff(df):
     if isinstance(df, str):
         df = pd.read_csv(df, index_col=0)
 
-    df_max = df.groupby(['ID'], as_index=False).agg(
-        {'delta_logit_psi': lambda x: max(x, key=abs)})
+    if 'ID' not in df.columns:
+        df = df.reset_index()
+    df = df.reset_index(drop=True)
 
-    df_max = df_max.merge(df, how='left', on=['ID', 'delta_logit_psi'])
-    df_max = df_max.drop_duplicates(subset=['ID', 'delta_logit_psi'])
-    return df_max
+    idx = df['delta_logit_psi'].abs().fillna(-1) \
+                               .groupby(df['ID']).idxmax()
+    cols = ['ID', 'delta_logit_psi']
+    cols += [c for c in df.columns if c not in cols]
+    return df.loc[idx.values, cols].reset_index(drop=True)
 
 
-def _not_close0(arr):
-    return ~np.isclose(arr, 0)
+class VarEffAccumulator:
+    """ Online version of `max_varEff`. Keeps the row with the largest
+    absolute delta_logit_psi per variant while prediction tables are
+    streamed, so all exon rows do not need to be kept in memory.
 
+    Args:
+        min_compact_size: number of rows to buffer before compacting.
+    """
+
+    def __init__(self, min_compact_size=100000):
+        self.min_compact_size = min_compact_size
+        self._chunks = list()
+        self._n_rows = 0
+        self._n_compacted = 0
+
+    def update(self, df):
+        """ Add prediction table to summary.
+        Args:
+            df: batch of `predict_batch`
+        """
+        if df.shape[0] == 0:
+            return
+        df = max_varEff(df)
+        self._chunks.append(df)
+        self._n_rows += df.shape[0]
+
+        if self._n_rows > max(2 * self._n_compacted, self.min_compact_size):
+            self._compact()
+
+    def _compact(self):
+        df = max_varEff(pd.concat(self._chunks, ignore_index=True))
+        self._chunks = [df]
+        self._n_rows = self._n_compacted = df.shape[0]
+
+    def to_df(self):
+        """ Returns summary as `max_varEff`.
+        """
+        if not self._chunks:
+            return pd.DataFrame()
+        self._compact()
+        return self._chunks[0]
+
+
+def top_k_mask(ids, effect, k):
+    """ Mask of k rows with the largest absolute effect per variant.
+    Args:
+        ids: variant id of rows.
+        effect: effect size of rows such as delta_logit_psi.
+        k: number of rows to keep per variant.
+    """
+    codes = pd.factorize(np.asarray(ids))[0]
+    # NaN effects are sorted last
+    order = np.lexsort((-np.abs(effect), codes))
+    codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    sizes = np.diff(np.r_[starts, len(codes)])
+    rank = np.arange(len(codes)) - np.repeat(starts, sizes)
+    mask = np.zeros(len(codes), dtype=bool)
+    mask[order[rank < k]] = True
+    return mask
+
+
+class EffectFilter:
+    """ Filters predictions right after the heads are evaluated, so
+    rows without impact are never turned into tables or written.
+    Rows of a variant need to be consecutive (as in batches of
+    `SplicingVCFDataloader`), top k is exact even if the rows of a
+    variant are split across batches.
+
+    Args:
+        min_delta_logit_psi: keep rows with absolute delta_logit_psi
+            at least this.
+        min_pathogenicity: keep rows with pathogenicity at least this.
+        top_k: keep k rows with largest absolute delta_logit_psi
+            per variant.
+    """
+
+    def __init__(self, min_delta_logit_psi=None, min_pathogenicity=None,
+                 top_k=None):
+        self.min_delta_logit_psi = min_delta_logit_psi
+        self.min_pathogenicity = min_pathogenicity
+        self.top_k = top_k
+        self._held = None
+        self.n_rows = 0
+        self.n_kept = 0
+
+    def select(self, ids, heads):
+        """ Indices of rows of batch passing thresholds and top k.
+        Args:
+            ids: variant id of rows.
+            heads: dict of predictions of `predict_heads`.
+        """
+        effect = heads['delta_logit_psi']
+        keep = np.ones(len(ids), dtype=bool)
+        with np.errstate(invalid='ignore'):
+            if self.min_delta_logit_psi is not None:
+                keep &= np.abs(effect) >= self.min_delta_logit_psi
+            if self.min_pathogenicity is not None:
+                keep &= heads['pathogenicity'] >= self.min_pathogenicity
+        idx = np.flatnonzero(keep)
+        if self.top_k is not None:
+            idx = idx[top_k_mask(np.asarray(ids)[idx], effect[idx],
+                                 self.top_k)]
+        self.n_rows += len(ids)
+        return idx
+
+    def merge(self, df, vcf_batch=None, last_id=None):
+        """ Merges table of selected rows of batch with rows held back
+        from previous batch. Rows of the last variant of batch are held
+        back because the variant may continue in the next batch.
+
+        Args:
+            df: table of selected rows of batch.
+            vcf_batch: vcf batch of rows or None.
+            last_id: id of the last variant of batch before selection.
+
+        Returns:
+            tuple of table and vcf batch of rows which are complete.
+        """
+        if self.top_k is None:
+            self.n_kept += len(df)
+            return df, vcf_batch
+
+        if self._held is not None:
+            held_df, held_batch = self._held
+            df = pd.concat([held_df, df], ignore_index=True)
+            if vcf_batch is not None:
+                vcf_batch = np.concatenate([held_batch, vcf_batch])
+            self._held = None
+
+            mask = top_k_mask(df['ID'].values, df['delta_logit_psi'].values,
+                              self.top_k)
+            df = df[mask].reset_index(drop=True)
+            if vcf_batch is not None:
+                vcf_batch = vcf_batch[mask]
+
+        tail = (df['ID'] == last_id).values
+        if tail.any():
+            self._held = (df[tail], None if vcf_batch is None
+                          else vcf_batch[tail])
+            df = df[~tail].reset_index(drop=True)
+            if vcf_batch is not None:
+                vcf_batch = vcf_batch[~tail]
+
+        self.n_kept += len(df)
+        return df, vcf_batch
+
+    def flush(self):
+        """ Returns rows held back from the last batch as `merge`.
+        """
+        held, self._held = self._held, None
+        if held is None:
+            return None
+        self.n_kept += len(held[0])
+        return held[0].reset_index(drop=True), held[1]
+
+    def __str__(self):
+        return '%d of %d exon-variant pairs kept by filter' \
+            % (self.n_kept, self.n_rows)
+
+
+class LinearHead:
+    """ Linear regression head evaluated with numpy
+    (coefficients of HuberRegressor).
+
+    Args:
+        coef: coefficients of features.
+        intercept: intercept.
+    """
+
+    def __init__(self, coef, intercept):
+        self.coef_ = np.asarray(coef, dtype=np.float64)
+        self.intercept_ = float(intercept)
+
+    def predict(self, X):
+        return np.dot(X, self.coef_) + self.intercept_
+
+
+class LogisticHead:
+    """ Logistic regression head evaluated with numpy. Standardization
+    of features (pipeline of StandardScaler and LogisticRegression)
+    is fused into coefficients.
+
+    Args:
+        mean: mean of features subtracted by scaler.
+        scale: scale of features divided by scaler.
+        coef: coefficients of standardized features.
+        intercept: intercept.
+    """
+
+    def __init__(self, mean, scale, coef, intercept):
+        coef = np.ravel(coef) / scale
+        self.coef_ = coef
+        self.intercept_ = float(np.ravel(intercept)[0] - np.dot(mean, coef))
 
-def _and_not_close0(x, y):
-    return np.logical_and(_not_close0(x), _not_close0(y))
+    def decision_function(self, X):
+        return np.dot(X, self.coef_) + self.intercept_
+
+    def predict_proba(self, X):
+        p = expit(self.decision_function(X))
+        return np.vstack([1 - p, p]).T
+
+
+def load_heads(path=HEADS):
+    """ Load heads exported by `export_heads`.
+    Returns:
+        tuple of linear (delta_logit_psi), logistic (pathogenicity)
+        and efficiency heads.
+    """
+    with np.load(path) as heads:
+        return (
+            LinearHead(heads['linear_coef'], heads['linear_intercept']),
+            LogisticHead(heads['logistic_mean'], heads['logistic_scale'],
+                         heads['logistic_coef'],
+                         heads['logistic_intercept']),
+            LinearHead(heads['efficiency_coef'],
+                       heads['efficiency_intercept'])
+        )
+
+
+def export_heads(path=HEADS, linear_model=LINEAR_MODEL_FILE,
+                 logistic_model=LOGISTIC_MODEL_FILE,
+                 efficiency_model=EFFICIENCY_MODEL_FILE):
+    """ Extract coefficients of scikit-learn models of heads into npz file
+    read by `load_heads`. Only needed after models are retrained,
+    scoring does not depend on scikit-learn.
+    Args:
+        path: output npz file.
+        linear_model: HuberRegressor of delta_logit_psi.
+        logistic_model: pipeline of StandardScaler and LogisticRegression
+          of pathogenicity.
+        efficiency_model: HuberRegressor of splicing efficiency.
+    """
+    from sklearn.externals import joblib
+    linear = joblib.load(linear_model)
+    efficiency = joblib.load(efficiency_model)
+    scaler, logistic = [step for _, step in
+                        joblib.load(logistic_model).steps]
+    n_features = logistic.coef_.shape[-1]
+
+    np.savez(
+        path,
+        linear_coef=linear.coef_,
+        linear_intercept=linear.intercept_,
+        logistic_mean=scaler.mean_ if scaler.with_mean
+        else np.zeros(n_features),
+        logistic_scale=scaler.scale_ if scaler.with_std
+        else np.ones(n_features),
+        logistic_coef=logistic.coef_,
+        logistic_intercept=logistic.intercept_,
+        efficiency_coef=efficiency.coef_,
+        efficiency_intercept=efficiency.intercept_
+    )
+
+
+LINEAR_MODEL, LOGISTIC_MODEL, EFFICIENCY_MODEL = load_heads()
+
+
+def _overlaps(X):
+    # indicators of overlapping prediction regions, not close to zero
+    # as `np.isclose(X, 0)` (nan is not close)
+    not_close0 = ~(np.abs(X) <= 1e-8)
+    exon_overlap = (not_close0[:, 1] & not_close0[:, 2]) \
+        | (not_close0[:, 2] & not_close0[:, 3])
+    donor_intron_overlap = not_close0[:, 3] & not_close0[:, 4]
+    acceptor_intron_overlap = not_close0[:, 0] & not_close0[:, 1]
+    return exon_overlap, donor_intron_overlap, acceptor_intron_overlap
 
 
 def transform(X, region_only=False):
@@ -94,85 +360,183 @@ def transform(X, region_only=False):
         X: modular prediction. Shape (, 5)
         region_only: only interaction terms with indicator function on overlapping
     '''
-    exon_overlap = np.logical_or(
-        _and_not_close0(X[:, 1], X[:, 2]),
-        _and_not_close0(X[:, 2], X[:, 3])
-    )
-    acceptor_intron_overlap = _and_not_close0(X[:, 0], X[:, 1])
-    donor_intron_overlap = _and_not_close0(X[:, 3], X[:, 4])
+    exon_overlap, donor_intron_overlap, acceptor_intron_overlap = \
+        _overlaps(X)
 
     if not region_only:
         exon_overlap = X[:, 2] * exon_overlap
         donor_intron_overlap = X[:, 4] * donor_intron_overlap
         acceptor_intron_overlap = X[:, 0] * acceptor_intron_overlap
 
-    return np.hstack([
-        X,
-        exon_overlap.reshape(-1, 1),
-        donor_intron_overlap.reshape(-1, 1),
-        acceptor_intron_overlap.reshape(-1, 1)
-    ])
+    return np.column_stack([X, exon_overlap, donor_intron_overlap,
+                            acceptor_intron_overlap])
+
+
+def predict_heads(X_ref, X_alt, pathogenicity=False,
+                  splicing_efficiency=False):
+    ''' Evaluate delta_logit_psi and optionally pathogenicity and splicing
+    efficiency heads in one pass over `X_alt - X_ref`, so overlaps of
+    prediction regions are computed once.
+    Args:
+        X_ref: modular predictions of ref sequences. Shape (, 5)
+        X_alt: modular predictions of alt sequences. Shape (, 5)
+        pathogenicity: adds pathogenicity prediction.
+        splicing_efficiency: adds splicing efficiency prediction.
+    Returns:
+        OrderedDict of column name (delta_logit_psi, pathogenicity,
+        efficiency) to predictions.
+    '''
+    X = X_alt - X_ref
+    exon_overlap, donor_intron_overlap, acceptor_intron_overlap = \
+        _overlaps(X)
+    exon = X[:, 2] * exon_overlap
+    features = np.column_stack([X, exon, X[:, 4] * donor_intron_overlap,
+                                X[:, 0] * acceptor_intron_overlap])
+
+    preds = OrderedDict()
+    preds['delta_logit_psi'] = LINEAR_MODEL.predict(features)
+    if pathogenicity:
+        preds['pathogenicity'] = LOGISTIC_MODEL.predict_proba(
+            np.column_stack([X_ref, X_alt, exon_overlap,
+                             donor_intron_overlap,
+                             acceptor_intron_overlap]))[:, 1]
+    if splicing_efficiency:
+        # no intronic modules
+        preds['efficiency'] = EFFICIENCY_MODEL.predict(
+            features[:, [1, 2, 3, 5]])
+    return preds
 
 
 def predict_deltaLogitPsi(X_ref, X_alt):
-    return LINEAR_MODEL.predict(transform(X_alt - X_ref, region_only=False))
+    return predict_heads(X_ref, X_alt)['delta_logit_psi']
 
 
 def predict_pathogenicity(X_ref, X_alt):
-    X = transform(X_alt - X_ref, region_only=True)
-    X = np.concatenate([X_ref, X_alt, X[:, -3:]], axis=-1)
-    return LOGISTIC_MODEL.predict_proba(X)[:, 1]
+    return predict_heads(X_ref, X_alt, pathogenicity=True)['pathogenicity']
 
 
 def predict_splicing_efficiency(X_ref, X_alt):
-    X = transform(X_alt - X_ref, region_only=False)
-    X = X[:, [1, 2, 3, 5]]  # no intronic modules
-    return EFFICIENCY_MODEL.predict(X)
+    return predict_heads(X_ref, X_alt,
+                         splicing_efficiency=True)['efficiency']
+
+
+VEP_KEYS = [
+    'alt_acceptor',
+    'alt_acceptorIntron',
+    'alt_donor',
+    'alt_donorIntron',
+    'alt_exon',
+    'delta_logit_psi',
+    'pathogenicity',
+    'ref_acceptor',
+    'ref_acceptorIntron',
+    'ref_donor',
+    'ref_donorIntron',
+    'ref_exon'
+]
+
+
+def _vep_field_name(key):
+    key = key.replace('acceptorIntron', 'acceptor_intron') \
+             .replace('donorIntron', 'donor_intron')
+    return 'mmsplice_' + key
+
+
+def _read_vep_header(vep_result_path):
+    ''' Returns compression, number of header lines and fields of CSQ.
+    '''
+    with open(vep_result_path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    opener = gzip.open if gzipped else open
+
+    n_header = 0
+    csq_fields = None
+    with opener(vep_result_path, 'rt') as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            n_header += 1
+            if line.startswith('##INFO=<ID=CSQ,'):
+                match = re.search(r'Format: ([^"]*)"', line)
+                if match:
+                    csq_fields = match.group(1).strip().split('|')
+    return 'gzip' if gzipped else None, n_header, csq_fields
+
+
+def read_vep_chunks(vep_result_path, chunksize=100000):
+    ''' Read MMSplice VEP plugin output in chunks.
+    Only support vcf type output.
+
+    Args:
+        vep_result_path: file path to the returned result of VEP plugin.
+        chunksize: number of vcf records per chunk.
+
+    Returns:
+        iterator of pd.DataFrame with one row per prediction.
+    '''
+    compression, n_header, csq_fields = _read_vep_header(vep_result_path)
+    field_names = [_vep_field_name(k) for k in VEP_KEYS]
+
+    if csq_fields and all(f in csq_fields for f in field_names):
+        idx = [csq_fields.index(f) for f in field_names]
+    else:
+        idx = None
+
+    chunks = pd.read_csv(vep_result_path, sep='\t', header=None,
+                         skiprows=n_header, usecols=[0, 1, 3, 4, 7],
+                         names=['CHROM', 'POS', 'REF', 'ALT', 'INFO'],
+                         dtype=str, quoting=csv.QUOTE_NONE,
+                         compression=compression, chunksize=chunksize)
+
+    for df in chunks:
+        csq = df['INFO'].str.extract(r'(?:^|;)CSQ=([^;]*)', expand=False)
+        has_csq = csq.notnull().values
+        df, csq = df[has_csq], csq[has_csq]
+        if df.shape[0] == 0:
+            continue
+
+        ids = (df['CHROM'] + ':' + df['POS'] + ':' + df['REF'] + ":['"
+               + df['ALT'].str.replace(',', "', '") + "']").values
+
+        entries = csq.str.split(',')
+        n_entries = entries.str.len().values
+        entries = pd.Series(np.concatenate(entries.values))
+        fields = entries.str.split('|', expand=True)
+
+        cols = idx or list(range(fields.shape[1] - len(VEP_KEYS),
+                                 fields.shape[1]))
+        values = fields.iloc[:, cols].fillna('').values
+        predicted = (values != '').any(axis=1)
+        values[values == ''] = '0'
+
+        df_pred = pd.DataFrame(values[predicted].astype(float),
+                               columns=VEP_KEYS)
+        df_pred['ID'] = np.repeat(ids, n_entries)[predicted]
+        yield df_pred
 
 
 def read_vep(vep_result_path,
-             max_per_var=False):
+             max_per_var=False,
+             chunksize=100000):
     ''' Read MMSplice VEP plugin output. Only support vcf type output.
 
     Args:
         vep_result_path: file path to the returned result of VEP plugin.
         max_per_var: return maximum absolute effect size per variant.
+        chunksize: number of vcf records parsed at once.
     '''
-    keys = [
-        'alt_acceptor',
-        'alt_acceptorIntron',
-        'alt_donor',
-        'alt_donorIntron',
-        'alt_exon',
-        'delta_logit_psi',
-        'pathogenicity',
-        'ref_acceptor',
-        'ref_acceptorIntron',
-        'ref_donor',
-        'ref_donorIntron',
-        'ref_exon'
-    ]
-
-    score_pred = []
-
-    for l in MultiSampleVCF(vep_result_path):
-        csq = l.INFO['CSQ'].split(',')
-        predictions = map(lambda x: tuple(x.split('|')[-len(keys):]), csq)
-
-        for pred in predictions:
-            if pred != ('',) * len(keys):
-                x = dict(
-                    zip(keys, map(float, (i if i != '' else 0 for i in pred))))
-                x['ID'] = "%s:%d:%s:%s" % (
-                    l.CHROM, int(l.start) + 1, l.REF, l.ALT)
-                score_pred.append(x)
-
-    df_plugin = pd.DataFrame(score_pred)
+    chunks = read_vep_chunks(vep_result_path, chunksize=chunksize)
 
     if max_per_var:
-        df_plugin = max_varEff(df_plugin).set_index('ID')
-
-    return df_plugin
+        acc = VarEffAccumulator()
+        for df in chunks:
+            acc.update(df)
+        return acc.to_df().set_index('ID')
+
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame(columns=VEP_KEYS + ['ID'])
+    return pd.concat(chunks, ignore_index=True)
 
 
 def get_var_side(variant, exon):
@@ -1,7 +1,11 @@
+import os
+import re
 import logging
-from itertools import islice
+import warnings
+from itertools import islice, chain
 from pkg_resources import resource_filename
 
+import numpy as np
 import pandas as pd
 import pyranges
 from pybedtools import Interval
@@ -9,6 +13,7 @@ from kipoi.data import SampleIterator
 from kipoiseq.extractors import MultiSampleVCF
 from mmsplice.utils import pyrange_remove_chr_from_chrom_annotation
 from mmsplice.exon_dataloader import ExonSplicingMixin
+from mmsplice.profiling import stage
 
 logger = logging.getLogger('mmsplice')
 logger.addHandler(logging.NullHandler())
@@ -16,6 +21,9 @@ logger.addHandler(logging.NullHandler())
 GRCH37 = resource_filename('mmsplice', 'models/grch37_exons.csv.gz')
 GRCH38 = resource_filename('mmsplice', 'models/grch38_exons.csv.gz')
 
+EXON_VARIANT_KEY = ['Chromosome', 'Start_exon', 'End_exon', 'Strand',
+                    'left_overhang', 'right_overhang', 'Start', 'End']
+
 
 def read_exon_pyranges(gtf_file, overhang=(100, 100), first_last=True):
     '''
@@ -50,33 +58,240 @@ def read_exon_pyranges(gtf_file, overhang=(100, 100), first_last=True):
     return pyranges.PyRanges(df_exons)
 
 
-def batch_iter_vcf(vcf_file, batch_size=10000):
+def read_exons(gtf, overhang=(100, 100)):
+    '''
+    Read exons with overhang as pyranges from gtf file
+    or prebuild annotation.
+
+    Args:
+      gtf: gtf file or 'grch37'/'grch38' for prebuild annotation.
+      overhang: padding of exon to match variants, ignored for
+        prebuild annotation.
+    '''
+    with stage('read_exons') as s:
+        if gtf in ('grch37', 'grch38'):
+            if overhang != (100, 100):
+                logger.warning('Overhang argument will be ignored'
+                               ' for prebuild annotation.')
+            pr_exons = pyranges.PyRanges(pd.read_csv(
+                GRCH37 if gtf == 'grch37' else GRCH38))
+        else:
+            pr_exons = read_exon_pyranges(gtf, overhang=overhang)
+        s.items = len(pr_exons.df)
+    return pr_exons
+
+
+def read_bed(bed_file):
+    '''
+    Read regions of bed file as dataframe of Chromosome, Start and End
+    (0-based, end exclusive).
+    '''
+    df = pd.read_csv(bed_file, sep='\t', header=None, usecols=[0, 1, 2],
+                     names=['Chromosome', 'Start', 'End'], comment='#',
+                     dtype={0: str})
+    return df[~df['Chromosome'].str.startswith(('track', 'browser'))] \
+        .astype({'Start': int, 'End': int})
+
+
+def _merge_intervals(starts, ends):
+    # merge sorted intervals with inclusive ends
+    merged = list()
+    for start, end in zip(starts, ends):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return np.array(merged).reshape(-1, 2)
+
+
+_ENSEMBL_VERSION = r'^(ENS\w+)\.\d+$'
+
+
+def _strip_version(ids):
+    return ids.str.replace(_ENSEMBL_VERSION, r'\1', regex=True)
+
+
+def subset_exons(pr_exons, genes=None, bed=None):
+    '''
+    Subset exons to genes or regions, such as genes of a clinical panel.
+
+    Args:
+      pr_exons: exons as returned by `read_exons`.
+      genes: list of gene ids, gene names or transcript ids. Versions
+        of ensembl ids are ignored.
+      bed: bed file of regions. Exons which overhang overlaps with
+        a region are kept.
+    '''
+    df = pr_exons.df
+    keep = np.ones(len(df), dtype=bool)
+
+    if genes is not None:
+        genes = [str(g) for g in genes]
+        queries = {re.sub(_ENSEMBL_VERSION, r'\1', g) for g in genes} \
+            | set(genes)
+        match = np.zeros(len(df), dtype=bool)
+        found = set()
+        for col in ['gene_id', 'gene_name', 'transcript_id']:
+            if col in df.columns:
+                values = df[col].astype(str)
+                if col != 'gene_name':
+                    values = _strip_version(values)
+                matched = values.isin(queries).values
+                match |= matched
+                found.update(values[matched])
+        missing = [g for g in genes
+                   if g not in found and
+                   re.sub(_ENSEMBL_VERSION, r'\1', g) not in found]
+        if missing:
+            logger.warning('Genes or transcripts not found in annotation: %s'
+                           % ', '.join(missing))
+        keep &= match
+
+    if bed is not None:
+        in_regions = np.zeros(len(df), dtype=bool)
+        chroms = df['Chromosome'].astype(str).values
+        regions = read_bed(bed).sort_values(['Chromosome', 'Start'])
+        for chrom, r in regions.groupby('Chromosome'):
+            # 1-based inclusive coordinates of regions
+            merged = _merge_intervals(r['Start'].values + 1, r['End'].values)
+            idx = np.where(chroms == chrom)[0]
+            i = np.searchsorted(merged[:, 1], df['Start'].values[idx])
+            overlaps = i < len(merged)
+            overlaps[overlaps] = merged[i[overlaps], 0] \
+                <= df['End'].values[idx[overlaps]]
+            in_regions[idx] = overlaps
+        keep &= in_regions
+
+    if not keep.any():
+        raise ValueError('No exons of given genes or regions'
+                         ' are in the annotation.')
+    return pyranges.PyRanges(df[keep])
+
+
+def exon_regions(pr_exons, seqnames=None):
+    '''
+    Sorted and merged regions of exons with overhang to fetch variants
+    from indexed vcf, such as ['17:41196000-41197000'].
+
+    Args:
+      pr_exons: exons as returned by `read_exons`.
+      seqnames: chromosomes in order of contigs of vcf, regions are
+        in this order so variants are read in order of vcf. Other
+        chromosomes are not in vcf and are skipped. By default,
+        chromosomes are sorted by name.
+    '''
+    df = pr_exons.df
+    chroms = df['Chromosome'].astype(str).values
+    if seqnames is None:
+        seqnames = sorted(set(chroms))
+
+    regions = list()
+    for chrom in seqnames:
+        exons = df[chroms == chrom].sort_values('Start')
+        for start, end in _merge_intervals(exons['Start'].values,
+                                           exons['End'].values):
+            regions.append('%s:%d-%d' % (chrom, max(start, 1), end))
+    return regions
+
+
+def _regions(region):
+    if region is None or isinstance(region, str):
+        return region and [region]
+    return list(region)
+
+
+def _fetch_regions(variants, regions):
+    '''
+    Variants of sorted and non-overlapping regions. Variants overlapping
+    several regions (such as long deletions) are returned once.
+    '''
+    last = (None, 0)
+
+    for region in regions:
+        records = variants(region)
+        # cyvcf2 warns for chromosomes without variants
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            first = next(records, None)
+        if first is None:
+            continue
+
+        # variants starting before the last variant of previous regions
+        # are already returned for them
+        previous = last
+        for v in chain([first], records):
+            if v.CHROM == previous[0] and v.POS <= previous[1]:
+                continue
+            last = (v.CHROM, v.POS)
+            yield v
+
+
+def _iter_vcf_from(variants, start, region=None):
+    chrom, pos, skip = start
+    seqnames = list(variants.seqnames)
+
+    regions = _regions(region)
+    if regions:
+        order = {c: i for i, c in enumerate(seqnames)}
+        regions = [r for r in regions
+                   if order.get(r.split(':')[0], -1) >= order[chrom]]
+    else:
+        # jump to start position with index of vcf
+        regions = ['%s:%d' % (chrom, pos)] \
+            + seqnames[seqnames.index(chrom) + 1:]
+
+    for v in _fetch_regions(variants, regions):
+        if v.CHROM == chrom:
+            if v.POS < pos:
+                continue
+            if v.POS == pos and skip > 0:
+                skip -= 1
+                continue
+        yield v
+
+
+def batch_iter_vcf(vcf_file, batch_size=10000, region=None, start=None):
     '''
     Iterates variatns in vcf file.
 
     Args:
       vcf_file: path of vcf file.
       batch_size: size of each batch.
+      region: only iterates variants in region such as '17:41196000-41277000'
+        or '17', or list of sorted and non-overlapping regions.
+        Requires indexed vcf.
+      start: tuple of (chrom, pos, skip) to start iteration from
+        the variants at chrom:pos after skipping first `skip` variants
+        at the position. Requires indexed vcf.
     '''
     variants = MultiSampleVCF(vcf_file)
-    batch = list(islice(variants, batch_size))
-
-    while batch:
+    if start:
+        variants = _iter_vcf_from(variants, start, region)
+    elif region:
+        variants = _fetch_regions(variants, _regions(region))
+
+    while True:
+        with stage('read_vcf') as s:
+            batch = list(islice(variants, batch_size))
+            s.items = len(batch)
+        if not batch:
+            break
         yield batch
-        batch = list(islice(variants, batch_size))
 
 
-def variants_to_pyranges(variants):
+def variants_to_pyranges(variants, vcf_batch=0):
     '''
     Create pyrange object given list of variant objects.
 
     Args:
       variants: list of variant objects have CHROM, POS, REF, ALT properties.
+      vcf_batch: index of vcf batch of variants.
     '''
     def _from_variants(variants):
-        for v in variants:
+        for i, v in enumerate(variants):
             if len(v.ALT) == 1:
-                yield v.CHROM, v.POS, v.POS + max(len(v.REF), len(v.ALT[0])), v
+                yield v.CHROM, v.POS, \
+                    v.POS + max(len(v.REF), len(v.ALT[0])), v, i
             else:
                 # Only support one alternative.
                 # If multiple alternative, need to split into multiple variants
@@ -85,20 +300,69 @@ def variants_to_pyranges(variants):
                     'split into mutliple variants with bedtools' % v)
 
     df = pd.DataFrame(list(_from_variants(variants)),
-                      columns=['Chromosome', 'Start', 'End', 'variant'])
+                      columns=['Chromosome', 'Start', 'End', 'variant',
+                               'variant_index'])
+    df['vcf_batch'] = vcf_batch
     return pyranges.PyRanges(df)
 
 
-def read_vcf_pyranges(vcf_file, batch_size=10000):
+def read_vcf_pyranges(vcf_file, batch_size=10000, region=None, shard=None,
+                      start=None, start_batch=0, batch_starts=None):
     '''
     Reads vcf and returns batch of pyranges objects.
 
     Args:
       vcf_file: path of vcf file.
       batch_size: size of each batch.
+      region: only reads variants in region (see `batch_iter_vcf`).
+      shard: tuple of (i, n), only returns every n-th batch starting
+        from the i-th batch (0-based), so n jobs with i in [0, n)
+        process all batches.
+      start: start position to resume reading (see `batch_iter_vcf`).
+      start_batch: index of the first batch, when reading is resumed.
+      batch_starts: if dict, start position (chrom, pos, skip) of each
+        batch is stored with batch index as key to resume from the batch.
+    '''
+    last = start or (None, None, 0)
+    batches = batch_iter_vcf(vcf_file, batch_size, region, start)
+
+    for i, batch in enumerate(batches, start_batch):
+        if batch_starts is not None:
+            first = (batch[0].CHROM, batch[0].POS)
+            batch_starts[i] = first + (
+                last[2] if first == last[:2] else 0,)
+            for v in batch:
+                if (v.CHROM, v.POS) == last[:2]:
+                    last = (v.CHROM, v.POS, last[2] + 1)
+                else:
+                    last = (v.CHROM, v.POS, 1)
+
+        if shard is None or i % shard[1] == shard[0]:
+            with stage('variants_to_pyranges', len(batch)):
+                pr_variants = variants_to_pyranges(batch, vcf_batch=i)
+            yield pr_variants
+
+
+def group_exon_variant_pairs(df):
     '''
-    for batch in batch_iter_vcf(vcf_file, batch_size):
-        yield variants_to_pyranges(batch)
+    Reorder exon-variant pairs so pairs are in the order of variants in vcf
+    and pairs with the same exon coordinates, overhang and variant
+    (the same exon shared by several transcripts) are consecutive.
+
+    Args:
+      df: dataframe of joined variants and exons.
+    '''
+    if df.empty:
+        return df
+
+    if 'variant_index' in df.columns:
+        df = df.sort_values('variant_index', kind='mergesort')
+
+    cols = [c for c in EXON_VARIANT_KEY if c in df.columns]
+    alleles = df['variant'].map(lambda v: (v.REF, v.ALT[0]))
+    group = df[cols].assign(alleles=alleles.values) \
+                    .groupby(cols + ['alleles'], sort=False).ngroup()
+    return df.iloc[np.argsort(group.values, kind='mergesort')]
 
 
 class SplicingVCFDataloader(ExonSplicingMixin, SampleIterator):
@@ -118,21 +382,69 @@ class SplicingVCFDataloader(ExonSplicingMixin, SampleIterator):
       overhang: overhang of exon to fetch flanking sequence of exon.
       seq_spliter: SeqSpliter class instance specific how to split seqs. 
          if None, use the default arguments of SeqSpliter
+      region: only load variants in region such as '17:41196000-41277000'.
+        Requires indexed vcf.
+      shard: tuple of (i, n), only load i-th of n shards of vcf batches
+        (see `read_vcf_pyranges`).
+      vcf_batch_size: number of variants read from vcf at once.
+      genes: only load variants of exons of genes given as list of
+        gene ids, gene names or transcript ids (see `subset_exons`).
+      bed: only load variants of exons overlapping regions of bed file.
+        With genes or bed, only regions of the exons are read from
+        indexed vcf (unless region is given).
     """
 
     def __init__(self, gtf, fasta_file, vcf_file,
                  variant_filter=True, split_seq=True, encode=True,
-                 overhang=(100, 100), seq_spliter=None):
+                 overhang=(100, 100), seq_spliter=None,
+                 region=None, shard=None, vcf_batch_size=10000,
+                 genes=None, bed=None):
         super().__init__(fasta_file, split_seq, encode, overhang, seq_spliter)
         self.gtf_file = gtf
         self.pr_exons = self._read_exons(gtf, overhang)
         self.vcf_file = vcf_file
         self.vcf = MultiSampleVCF(vcf_file)
-        self.variants_batchs = read_vcf_pyranges(vcf_file)
-
         self._check_chrom_annotation()
+
+        if genes is not None or bed is not None:
+            self.pr_exons = subset_exons(self.pr_exons, genes, bed)
+            if region is None and self._indexed_vcf():
+                region = exon_regions(self.pr_exons,
+                                      list(self.vcf.seqnames) or None)
+
+        self.region = region
+        self.shard = shard
+        self.vcf_batch_size = vcf_batch_size
+        self.variant_filter = variant_filter
+        self.vcf_batch_starts = dict()
+        self.variants_batchs = read_vcf_pyranges(
+            vcf_file, vcf_batch_size, region=region, shard=shard,
+            batch_starts=self.vcf_batch_starts)
+
         self._generator = self._generate(variant_filter=variant_filter)
 
+    def resume(self, vcf_batch, start):
+        '''
+        Resume loading from the beginning of a vcf batch, such as
+        stored in checkpoint of `predict_save`. Needs to be called before
+        iteration starts.
+
+        Args:
+          vcf_batch: index of vcf batch to resume from.
+          start: start position (chrom, pos, skip) of the vcf batch
+            in `vcf_batch_starts`.
+        '''
+        self.vcf_batch_starts.clear()
+        self.variants_batchs = read_vcf_pyranges(
+            self.vcf_file, self.vcf_batch_size, region=self.region,
+            shard=self.shard, start=tuple(start), start_batch=vcf_batch,
+            batch_starts=self.vcf_batch_starts)
+        self._generator = self._generate(variant_filter=self.variant_filter)
+
+    def _indexed_vcf(self):
+        return any(os.path.exists(self.vcf_file + ext)
+                   for ext in ('.tbi', '.csi'))
+
     def _check_chrom_annotation(self):
         fasta_chroms = set(self.fasta.fasta.keys())
         vcf_chroms = set(self.vcf.seqnames)
@@ -154,26 +466,29 @@ class SplicingVCFDataloader(ExonSplicingMixin, SampleIterator):
                 'GTF chrom names do not match with vcf chrom names')
 
     def _read_exons(self, gtf, overhang=(100, 100)):
-        if gtf == 'grch37':
-            if overhang != (100, 100):
-                logger.warning('Overhang argument will be ignored'
-                               ' for prebuild annotation.')
-            return pyranges.PyRanges(pd.read_csv(GRCH37))
-        elif gtf == 'grch38':
-            if overhang != (100, 100):
-                logger.warning('Overhang argument will be ignored'
-                               ' for prebuild annotation.')
-            return pyranges.PyRanges(pd.read_csv(GRCH38))
-        else:
-            return read_exon_pyranges(self.gtf_file, overhang=overhang)
+        return read_exons(gtf, overhang)
 
     def _generate(self, variant_filter=True):
         for pr_variants in self.variants_batchs:
 
-            exon_variant_pairs = pr_variants.join(
-                self.pr_exons, suffix="_exon")
+            with stage('join') as s:
+                exon_variant_pairs = pr_variants.join(
+                    self.pr_exons, suffix="_exon")
+
+                df = group_exon_variant_pairs(exon_variant_pairs.df)
+                s.items = len(df)
+
+            if self.cache is not None and not df.empty:
+                self._prefetch_cache(
+                    self._cache_key(chrom, start + lo - 1, end - ro, strand,
+                                    (ro, lo) if strand == '-' else (lo, ro),
+                                    variant)
+                    for chrom, start, end, strand, lo, ro, variant in zip(
+                        df['Chromosome'], df['Start_exon'], df['End_exon'],
+                        df['Strand'], df['left_overhang'],
+                        df['right_overhang'], df['variant']))
 
-            for i, row in exon_variant_pairs.df.iterrows():
+            for i, row in df.iterrows():
                 yield row
 
     def __next__(self):
@@ -184,7 +499,9 @@ class SplicingVCFDataloader(ExonSplicingMixin, SampleIterator):
                         row['End_exon'] - overhang[1],
                         strand=row['Strand'])
         variant = row['variant']
-        return self._next(row, exon, variant, overhang)
+        sample = self._next(row, exon, variant, overhang)
+        sample['metadata']['vcf_batch'] = row['vcf_batch']
+        return sample
 
     def __iter__(self):
         return self
@@ -0,0 +1,452 @@
+import os
+import shutil
+import importlib
+import pandas as pd
+
+
+def _import_optional(module, extra, feature):
+    # optional dependencies are installed with extras of setup.py
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise ImportError('%s requires %s, install it with'
+                          ' `pip install mmsplice[%s]`.'
+                          % (feature, module.split('.')[0], extra))
+
+
+def _import_pyarrow(module='pyarrow'):
+    return _import_optional(module, 'arrow', 'parquet and arrow output')
+
+
+class TableWriter:
+    """
+    Writes batches of prediction tables to a single open file.
+
+    Args:
+      path: output file path.
+      resume: state of writer returned by `state()` to continue writing
+        a file of an interrupted run. Content written after the state
+        is discarded.
+    """
+
+    def __init__(self, path, resume=None):
+        self.path = path
+
+    def write(self, df):
+        raise NotImplementedError()
+
+    def state(self):
+        """
+        Returns state (json serializable) of written content
+        to resume writing from.
+        """
+        raise NotImplementedError('%s does not support resuming'
+                                  % type(self).__name__)
+
+    def close(self):
+        raise NotImplementedError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CSVWriter(TableWriter):
+    """
+    Writes batches of prediction tables to csv file.
+    """
+
+    def __init__(self, path, resume=None):
+        super().__init__(path, resume)
+        if resume is None:
+            self.file = open(path, 'w')
+        else:
+            os.truncate(path, resume['size'])
+            self.file = open(path, 'a')
+        self._header = resume is None or resume['size'] == 0
+
+    def write(self, df):
+        df.to_csv(self.file, index=False, header=self._header)
+        self._header = False
+
+    def state(self):
+        self.file.flush()
+        return {'size': os.fstat(self.file.fileno()).st_size}
+
+    def close(self):
+        self.file.close()
+
+
+class _ArrowTableWriter(TableWriter):
+    """
+    Base class of columnar writers. Schema is inferred from the first batch:
+    float columns are stored as float32 and string columns are
+    dictionary-encoded.
+    """
+
+    def __init__(self, path, resume=None):
+        super().__init__(path, resume)
+        self.pa = _import_pyarrow()
+        self.schema = None
+        self.writer = None
+
+    def _infer_schema(self, df):
+        pa = self.pa
+        fields = list()
+        for col, dtype in df.dtypes.items():
+            if dtype.kind == 'f':
+                field_type = pa.float32()
+            elif dtype.kind == 'O':
+                field_type = pa.dictionary(pa.int32(), pa.string())
+            else:
+                field_type = pa.from_numpy_dtype(dtype)
+            fields.append(pa.field(col, field_type))
+        return pa.schema(fields)
+
+    def _to_table(self, df):
+        pa = self.pa
+        arrays = list()
+        for field in self.schema:
+            values = df[field.name].values
+            if pa.types.is_dictionary(field.type):
+                arr = pa.array(values, type=pa.string(),
+                               from_pandas=True).dictionary_encode()
+            else:
+                arr = pa.array(values.astype(field.type.to_pandas_dtype()))
+            arrays.append(arr)
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def _open(self, schema):
+        raise NotImplementedError()
+
+    def write(self, df):
+        if self.writer is None:
+            self.schema = self._infer_schema(df)
+            self.writer = self._open(self.schema)
+        self.writer.write_table(self._to_table(df))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ParquetWriter(_ArrowTableWriter):
+    """
+    Writes batches of prediction tables to parquet file
+    with one row group per batch. Parquet file is only readable after
+    it is closed, thus writing can not be resumed.
+    """
+
+    def __init__(self, path, resume=None):
+        if resume is not None:
+            raise ValueError('Writing parquet file can not be resumed,'
+                             ' use csv or arrow output.')
+        super().__init__(path)
+
+    def _open(self, schema):
+        pq = _import_pyarrow('pyarrow.parquet')
+        return pq.ParquetWriter(self.path, schema)
+
+
+class ArrowWriter(_ArrowTableWriter):
+    """
+    Writes batches of prediction tables to arrow ipc stream file
+    with one record batch per batch. Output can be read with
+    `pyarrow.ipc.open_stream(path).read_pandas()`.
+    """
+
+    def __init__(self, path, resume=None):
+        super().__init__(path, resume)
+        self.n_batches = 0
+        if resume is not None and resume['batches'] > 0:
+            self._resume(resume['batches'])
+
+    def _resume(self, n_batches):
+        # stream of killed run is readable until the last complete batch,
+        # copy the batches to new stream and continue writing it.
+        tmp_path = self.path + '.resume'
+        os.replace(self.path, tmp_path)
+        with self.pa.OSFile(tmp_path) as f:
+            reader = self.pa.ipc.open_stream(f)
+            self.schema = reader.schema
+            self.writer = self._open(self.schema)
+            for _ in range(n_batches):
+                self.writer.write_batch(reader.read_next_batch())
+        self.n_batches = n_batches
+        os.remove(tmp_path)
+
+    def _open(self, schema):
+        return self.pa.ipc.new_stream(self.path, schema)
+
+    def write(self, df):
+        # empty tables are skipped so each write is one record batch
+        if len(df) > 0:
+            super().write(df)
+            self.n_batches += 1
+
+    def state(self):
+        return {'batches': self.n_batches}
+
+
+TABLE_WRITERS = {
+    'csv': CSVWriter,
+    'parquet': ParquetWriter,
+    'arrow': ArrowWriter
+}
+
+_EXTENSIONS = {
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.arrow': 'arrow',
+    '.arrows': 'arrow',
+    '.ipc': 'arrow'
+}
+
+
+def infer_output_format(path):
+    """
+    Infer output format from extension of file path. Csv is default.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    return _EXTENSIONS.get(ext, 'csv')
+
+
+def table_writer(path, output_format=None, resume=None):
+    """
+    Create writer for given output format.
+
+    Args:
+      path: output file path.
+      output_format: one of 'csv', 'parquet' and 'arrow'.
+        If None, inferred from extension of path.
+      resume: state of writer to continue writing from
+        (see `TableWriter.state`).
+    """
+    output_format = output_format or infer_output_format(path)
+    if output_format not in TABLE_WRITERS:
+        raise ValueError('Output format "%s" is not supported. Supported'
+                         ' formats are %s'
+                         % (output_format, list(TABLE_WRITERS)))
+    return TABLE_WRITERS[output_format](path, resume)
+
+
+def concat_tables(paths, path, output_format=None):
+    """
+    Concatenate tables written by table writers into a single file
+    in the order of paths without parsing csv rows or converting
+    columnar batches. Missing paths (no predictions written) are skipped.
+
+    Args:
+      paths: paths of tables to concatenate.
+      path: output file path.
+      output_format: one of 'csv', 'parquet' and 'arrow'.
+        If None, inferred from extension of path.
+    """
+    output_format = output_format or infer_output_format(path)
+    paths = [p for p in paths if os.path.exists(p)]
+
+    if output_format == 'csv':
+        with open(path, 'w') as out:
+            header = True
+            for p in paths:
+                with open(p) as f:
+                    line = f.readline()
+                    if header and line:
+                        out.write(line)
+                        header = False
+                    shutil.copyfileobj(f, out)
+
+    elif output_format == 'parquet':
+        pq = _import_pyarrow('pyarrow.parquet')
+        writer = None
+        for p in paths:
+            f = pq.ParquetFile(p)
+            for i in range(f.num_row_groups):
+                table = f.read_row_group(i)
+                writer = writer or pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+        if writer is not None:
+            writer.close()
+
+    elif output_format == 'arrow':
+        pa = _import_pyarrow()
+        writer = None
+        for p in paths:
+            with pa.OSFile(p) as f:
+                reader = pa.ipc.open_stream(f)
+                writer = writer or pa.ipc.new_stream(path, reader.schema)
+                for batch in reader:
+                    writer.write_batch(batch)
+        if writer is not None:
+            writer.close()
+
+    else:
+        raise ValueError('Output format "%s" is not supported. Supported'
+                         ' formats are %s'
+                         % (output_format, list(TABLE_WRITERS)))
+
+
+VCF_INFO_FIELDS = [
+    ('exons', 'String', 'exon affected by the variant'),
+    ('exon_id', 'String', 'id of the exon'),
+    ('gene_id', 'String', 'id of the gene of the exon'),
+    ('gene_name', 'String', 'name of the gene of the exon'),
+    ('transcript_id', 'String', 'id of the transcript of the exon'),
+    ('delta_logit_psi', 'Float', 'delta logit psi score of variant'),
+    ('pathogenicity', 'Float', 'pathogenicity effect of variant'),
+    ('efficiency', 'Float', 'splicing efficiency effect of variant'),
+    ('ref_acceptorIntron', 'Float',
+     'acceptor intron score of reference sequence'),
+    ('ref_acceptor', 'Float', 'acceptor score of reference sequence'),
+    ('ref_exon', 'Float', 'exon score of reference sequence'),
+    ('ref_donor', 'Float', 'donor score of reference sequence'),
+    ('ref_donorIntron', 'Float', 'donor intron score of reference sequence'),
+    ('alt_acceptorIntron', 'Float',
+     'acceptor intron score of variant sequence'),
+    ('alt_acceptor', 'Float', 'acceptor score of variant sequence'),
+    ('alt_exon', 'Float', 'exon score of variant sequence'),
+    ('alt_donor', 'Float', 'donor score of variant sequence'),
+    ('alt_donorIntron', 'Float', 'donor intron score of variant sequence')
+]
+
+
+def _format_info_values(values, field_type):
+    if field_type == 'Float':
+        values = values.map('{:.6g}'.format).replace('nan', '.')
+    else:
+        values = values.fillna('.').astype(str) \
+                       .str.replace(r'[,;= ]', '_', regex=True)
+    return values
+
+
+class VCFAnnotator:
+    """
+    Annotates vcf records with mmsplice predictions in a single pass.
+    Each column of prediction table is written to a typed INFO field
+    (such as `mmsplice_delta_logit_psi`) with one value per affected exon.
+
+    Prediction tables are consumed lazily and only predictions of variants
+    not yet reached in the vcf are kept in memory. Thus, the vcf need to be
+    coordinate-sorted and prediction tables need to be in the same order
+    as vcf (such as output of `predict_batch`).
+
+    Args:
+      predictions: iterable of prediction tables (pd.DataFrame)
+        with `ID` column.
+      fields: prediction columns to write as INFO. If None, all columns
+        in `VCF_INFO_FIELDS`.
+    """
+
+    def __init__(self, predictions, fields=None):
+        self.predictions = iter(predictions)
+        self.fields = [f for f in VCF_INFO_FIELDS
+                       if fields is None or f[0] in fields]
+        self.pending = dict()
+        self._chrom_rank = dict()
+        self._last_key = None
+        self._exhausted = False
+
+    def header_info(self):
+        return [{
+            'ID': 'mmsplice_%s' % name,
+            'Description': 'mmsplice %s' % desc,
+            'Type': field_type,
+            'Number': '.'
+        } for name, field_type, desc in self.fields]
+
+    def _key(self, chrom, pos):
+        return (self._chrom_rank.get(chrom, float('inf')), pos)
+
+    def _pull(self):
+        df = next(self.predictions, None)
+        if df is None:
+            self._exhausted = True
+            return
+
+        grouped = pd.DataFrame({
+            name: _format_info_values(df[name], field_type)
+            .groupby(df['ID'].values, sort=False).agg(','.join)
+            for name, field_type, _ in self.fields if name in df.columns
+        })
+        names = list(grouped.columns)
+
+        for var_id, values in zip(grouped.index, grouped.values.tolist()):
+            info = self.pending.get(var_id)
+            if info is None:
+                self.pending[var_id] = dict(zip(names, values))
+            else:
+                for name, value in zip(names, values):
+                    info[name] += ',' + value
+
+        chrom, pos = df['ID'].iloc[-1].split(':')[:2]
+        self._last_key = (chrom, int(pos))
+
+    def _purge(self, key):
+        # drop predictions without matching vcf record
+        for var_id in list(self.pending):
+            chrom, pos = var_id.split(':')[:2]
+            if self._key(chrom, int(pos)) < key:
+                del self.pending[var_id]
+
+    def info(self, chrom, pos, var_id):
+        """
+        Returns INFO string of variant or None if there is no prediction.
+        Variants need to be queried in order of the vcf.
+        """
+        self._chrom_rank.setdefault(chrom, len(self._chrom_rank))
+        key = self._key(chrom, pos)
+
+        pulled = False
+        while not self._exhausted and (
+                self._last_key is None or self._key(*self._last_key) <= key):
+            self._pull()
+            pulled = True
+        if pulled:
+            self._purge(key)
+
+        pred = self.pending.pop(var_id, None)
+        if pred is None:
+            return None
+        return ';'.join('mmsplice_%s=%s' % (k, v) for k, v in pred.items())
+
+
+def annotate_vcf(vcf_in, vcf_out, predictions, fields=None, index=True):
+    """
+    Writes bgzipped vcf annotated with predictions and build tabix index
+    of it. Memory usage is bounded by the size of prediction batches.
+
+    Args:
+      vcf_in: input vcf file, coordinate-sorted.
+      vcf_out: output path of bgzipped vcf.
+      predictions: iterable of prediction tables in order of the vcf,
+        such as output of `predict_batch`.
+      fields: prediction columns to write as INFO fields. If None, all.
+      index: build tabix index (`vcf_out` + '.tbi').
+    """
+    from cyvcf2 import VCF
+    pysam = _import_optional('pysam', 'vcf', 'vcf output')
+
+    annotator = VCFAnnotator(predictions, fields)
+
+    with VCF(vcf_in) as vcf, pysam.BGZFile(vcf_out, 'wb') as f:
+        for header in annotator.header_info():
+            vcf.add_info_to_header(header)
+        f.write(vcf.raw_header.encode())
+
+        for var in vcf:
+            line = str(var)
+            var_id = "%s:%s:%s:['%s']" % (var.CHROM, var.POS,
+                                          var.REF, ','.join(var.ALT))
+            info = annotator.info(var.CHROM, var.POS, var_id)
+
+            if info is not None:
+                cols = line.rstrip('\n').split('\t')
+                cols[7] = info if cols[7] == '.' else cols[7] + ';' + info
+                line = '\t'.join(cols) + '\n'
+            f.write(line.encode())
+
+    if index:
+        pysam.tabix_index(vcf_out, preset='vcf', force=True)
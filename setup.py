@@ -26,6 +26,11 @@ requirements = [
     'pyranges'
 ]
 
+extras_requirements = {
+    'arrow': ['pyarrow'],
+    'vcf': ['pysam']
+}
+
 setup_requirements = ['pytest-runner', ]
 
 test_requirements = ['pytest', 'pytest-benchmark']
@@ -44,6 +49,7 @@ setup(
     ],
     description="Predict splicing variant effect from VCF",
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
     long_description_content_type='text/markdown',
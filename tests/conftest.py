@@ -1,3 +1,4 @@
+import os
 import tempfile
 import pytest
 
@@ -7,6 +8,24 @@ vcf_file = 'tests/data/test.vcf.gz'
 exon_file = 'tests/data/test_exons.csv'
 
 
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'benchmark: benchmark, only run with --benchmark-only'
+        ' or MMSPLICE_BENCHMARK=1')
+
+
+def pytest_collection_modifyitems(config, items):
+    # benchmarks are slow, so plain test runs skip them
+    if config.getoption('benchmark_only', False) \
+       or os.environ.get('MMSPLICE_BENCHMARK'):
+        return
+    skip = pytest.mark.skip(
+        reason='benchmark, run with --benchmark-only or MMSPLICE_BENCHMARK=1')
+    for item in items:
+        if item.get_closest_marker('benchmark') is not None:
+            item.add_marker(skip)
+
+
 snps = [
     "17:41276033:C:['G']"
 ]
@@ -59,3 +78,50 @@ def vcf_path():
 
         temp_vcf.flush()
         yield temp_vcf.name
+
+
+@pytest.fixture
+def multi_chrom_data(tmpdir):
+    '''
+    gtf, fasta and indexed vcf of the BRCA1 region of test data copied to
+    chromosomes 2 and 10, which are sorted differently by name than in
+    order of contigs of vcf.
+    '''
+    pysam = pytest.importorskip('pysam')
+    from cyvcf2 import VCF
+    from pybedtools import Interval
+    from kipoiseq.extractors import FastaStringExtractor
+
+    offset, length = 41195000, 83000
+    chroms = ['2', '10']
+    seq = FastaStringExtractor(fasta_file).extract(
+        Interval('17', offset, offset + length))
+
+    fasta = str(tmpdir.join('genome.fa'))
+    with open(fasta, 'w') as f:
+        for chrom in chroms:
+            f.write('>%s\n%s\n' % (chrom, seq))
+
+    gtf = str(tmpdir.join('genes.gtf'))
+    with open(gtf_file) as f:
+        lines = [line.split('\t') for line in f if not line.startswith('#')]
+    with open(gtf, 'w') as f:
+        for chrom in chroms:
+            for cols in lines:
+                f.write('\t'.join([chrom] + cols[1:3]
+                                  + [str(int(cols[3]) - offset),
+                                     str(int(cols[4]) - offset)]
+                                  + cols[5:]))
+
+    vcf = str(tmpdir.join('variants.vcf'))
+    records = list(VCF(vcf_file))[::10]
+    with open(vcf, 'w') as f:
+        f.write('##fileformat=VCFv4.0\n')
+        for chrom in chroms:
+            f.write('##contig=<ID=%s,length=%d>\n' % (chrom, length))
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for chrom in chroms:
+            for v in records:
+                f.write('%s\t%d\t.\t%s\t%s\t.\t.\t.\n'
+                        % (chrom, v.POS - offset, v.REF, v.ALT[0]))
+    return gtf, fasta, pysam.tabix_index(vcf, preset='vcf', force=True)
@@ -0,0 +1,262 @@
+# Benchmarks of each stage of prediction on synthetic variants around exons
+# of tests/data. Run only benchmarks with:
+#
+#   pytest tests/test_benchmark.py --benchmark-only
+#
+# or set MMSPLICE_BENCHMARK=1, benchmarks are skipped by plain test runs.
+# Number of variants is set with MMSPLICE_BENCHMARK_SIZES (comma separated,
+# default 1000) such as 1000,100000,1000000. Runs are saved and compared
+# with --benchmark-autosave and --benchmark-compare.
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pytest
+from pybedtools import Interval
+from concise.preprocessing import encodeDNA
+
+from mmsplice import MMSplice
+from mmsplice.mmsplice import MODULES, writeVCF
+from mmsplice.utils import predict_deltaLogitPsi, predict_pathogenicity, \
+    predict_splicing_efficiency
+from mmsplice.exon_dataloader import SeqSpliter, encode_seqs
+from mmsplice.vcf_dataloader import read_exon_pyranges, batch_iter_vcf, \
+    read_vcf_pyranges, group_exon_variant_pairs, SplicingVCFDataloader
+from mmsplice.writers import table_writer, annotate_vcf
+from mmsplice.tune import write_synthetic_vcf
+
+from conftest import gtf_file, fasta_file
+
+pytestmark = pytest.mark.benchmark
+
+SIZES = [int(n) for n in
+         os.environ.get('MMSPLICE_BENCHMARK_SIZES', '1000').split(',')]
+
+# number of sequences per inference benchmark
+INFERENCE_BATCH = 512
+
+REF_COLUMNS = ['ref_acceptorIntron', 'ref_acceptor',
+               'ref_exon', 'ref_donor', 'ref_donorIntron']
+ALT_COLUMNS = ['alt_acceptorIntron', 'alt_acceptor',
+               'alt_exon', 'alt_donor', 'alt_donorIntron']
+
+
+def variant_id(v):
+    return "%s:%s:%s:['%s']" % (v.CHROM, v.POS, v.REF, v.ALT[0])
+
+
+@pytest.fixture(scope='module', params=SIZES)
+def synthetic_vcf(request, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('benchmark')
+               .join('synthetic_%d.vcf' % request.param))
+    write_synthetic_vcf(path, request.param, gtf_file, fasta_file)
+    return path
+
+
+@pytest.fixture(scope='module')
+def pr_exons():
+    return read_exon_pyranges(gtf_file)
+
+
+@pytest.fixture(scope='module')
+def dataloader(synthetic_vcf):
+    return SplicingVCFDataloader(gtf_file, fasta_file, synthetic_vcf,
+                                 split_seq=False)
+
+
+@pytest.fixture(scope='module')
+def pairs(dataloader):
+    '''
+    Unique exon-variant pairs as (exon, variant, overhang) in vcf order.
+    '''
+    pairs = OrderedDict()
+    for row in dataloader._generate():
+        overhang = (row['left_overhang'], row['right_overhang'])
+        exon = Interval(row['Chromosome'],
+                        row['Start_exon'] + overhang[0] - 1,
+                        row['End_exon'] - overhang[1],
+                        strand=row['Strand'])
+        variant = row['variant']
+        key = dataloader._pair_key(exon, variant, overhang)
+        pairs[key] = (exon, variant, overhang)
+    return list(pairs.values())
+
+
+@pytest.fixture(scope='module')
+def seqs(dataloader, pairs):
+    '''
+    Ref sequences of pairs with overhang in the direction of strand.
+    '''
+    seqs = list()
+    for exon, _, overhang in pairs:
+        seq = dataloader.fasta.extract(Interval(
+            exon.chrom, exon.start - overhang[0],
+            exon.end + overhang[1], strand=exon.strand)).upper()
+        if exon.strand == '-':
+            overhang = (overhang[1], overhang[0])
+        seqs.append((seq, overhang))
+    return seqs
+
+
+@pytest.fixture(scope='module')
+def splits(seqs):
+    spliter = SeqSpliter()
+    return [spliter.split(seq, overhang, pattern_warning=False)
+            for seq, overhang in seqs]
+
+
+@pytest.fixture(scope='module')
+def model():
+    return MMSplice()
+
+
+@pytest.fixture(scope='module')
+def scores(pairs):
+    rng = np.random.RandomState(0)
+    return rng.randn(len(pairs), 5), rng.randn(len(pairs), 5)
+
+
+@pytest.fixture(scope='module')
+def df_predictions(pairs, scores):
+    X_ref, X_alt = scores
+    df = pd.DataFrame({
+        'ID': [variant_id(variant) for _, variant, _ in pairs],
+        'exons': ['%s:%d-%d:%s' % (exon.chrom, exon.start,
+                                   exon.end, exon.strand)
+                  for exon, _, _ in pairs],
+        'gene_id': 'ENSG00000012048',
+        'gene_name': 'BRCA1',
+        'delta_logit_psi': predict_deltaLogitPsi(X_ref, X_alt)
+    })
+    return pd.concat([
+        df,
+        pd.DataFrame(X_ref, columns=REF_COLUMNS),
+        pd.DataFrame(X_alt, columns=ALT_COLUMNS)
+    ], axis=1)
+
+
+@pytest.mark.benchmark(group='exons')
+def test_benchmark_read_exon_pyranges(benchmark):
+    pr = benchmark(read_exon_pyranges, gtf_file)
+    assert len(pr.df) > 0
+
+
+@pytest.mark.benchmark(group='vcf')
+def test_benchmark_batch_iter_vcf(benchmark, synthetic_vcf):
+    n = benchmark(lambda: sum(len(batch)
+                              for batch in batch_iter_vcf(synthetic_vcf)))
+    assert n > 0
+
+
+@pytest.mark.benchmark(group='vcf')
+def test_benchmark_read_vcf_pyranges(benchmark, synthetic_vcf):
+    n = benchmark(lambda: sum(len(pr.df)
+                              for pr in read_vcf_pyranges(synthetic_vcf)))
+    assert n > 0
+
+
+@pytest.mark.benchmark(group='join')
+def test_benchmark_join(benchmark, synthetic_vcf, pr_exons):
+    batches = list(read_vcf_pyranges(synthetic_vcf))
+
+    def join():
+        return sum(len(group_exon_variant_pairs(
+            pr.join(pr_exons, suffix='_exon').df)) for pr in batches)
+
+    assert benchmark(join) > 0
+
+
+@pytest.mark.benchmark(group='extraction')
+def test_benchmark_extract(benchmark, dataloader, pairs):
+    def extract():
+        for exon, variant, overhang in pairs:
+            dataloader._next_inputs(exon, variant, overhang)
+
+    benchmark.pedantic(extract, rounds=3)
+
+
+@pytest.mark.benchmark(group='split')
+def test_benchmark_split(benchmark, seqs):
+    spliter = SeqSpliter()
+    splits = benchmark(lambda: [
+        spliter.split(seq, overhang, pattern_warning=False)
+        for seq, overhang in seqs
+    ])
+    assert len(splits) == len(seqs)
+
+
+@pytest.mark.benchmark(group='encoding')
+def test_benchmark_encode(benchmark, splits):
+    batch = benchmark(lambda: {k: encodeDNA([s[k] for s in splits])
+                               for k in splits[0]})
+    assert len(batch['exon']) == len(splits)
+
+
+@pytest.mark.benchmark(group='encoding')
+def test_benchmark_encode_seqs(benchmark, splits):
+    batch = benchmark(lambda: {k: encode_seqs([s[k] for s in splits])
+                               for k in splits[0]})
+    assert len(batch['exon']) == len(splits)
+
+
+@pytest.mark.benchmark(group='predict_many')
+def test_benchmark_predict_loop(benchmark, model, seqs):
+    seqs = seqs[:INFERENCE_BATCH]
+    scores = benchmark.pedantic(
+        lambda: [model.predict(seq, overhang) for seq, overhang in seqs],
+        rounds=1)
+    assert len(scores) == len(seqs)
+
+
+@pytest.mark.benchmark(group='predict_many')
+def test_benchmark_predict_many(benchmark, model, seqs):
+    seqs = seqs[:INFERENCE_BATCH]
+    scores = benchmark(model.predict_many, [seq for seq, _ in seqs],
+                       [overhang for _, overhang in seqs])
+    assert scores.shape == (len(seqs), 5)
+
+
+@pytest.mark.benchmark(group='inference')
+@pytest.mark.parametrize('module, key',
+                         [(module, key) for module, key, _ in MODULES])
+def test_benchmark_module_inference(benchmark, model, splits, module, key):
+    x = encodeDNA([s[key] for s in splits[:INFERENCE_BATCH]])
+    pred = benchmark(getattr(model, module).predict, x)
+    assert len(pred) == len(x)
+
+
+@pytest.mark.benchmark(group='heads')
+@pytest.mark.parametrize('head', [predict_deltaLogitPsi,
+                                  predict_pathogenicity,
+                                  predict_splicing_efficiency])
+def test_benchmark_head(benchmark, scores, head):
+    X_ref, X_alt = scores
+    assert len(benchmark(head, X_ref, X_alt)) == len(X_ref)
+
+
+@pytest.mark.benchmark(group='writers')
+def test_benchmark_csv_writer(benchmark, df_predictions, tmpdir):
+    path = str(tmpdir.join('pred.csv'))
+
+    def write():
+        with table_writer(path, 'csv') as writer:
+            writer.write(df_predictions)
+
+    benchmark(write)
+
+
+@pytest.mark.benchmark(group='writers')
+def test_benchmark_writeVCF(benchmark, synthetic_vcf, df_predictions,
+                            tmpdir):
+    predictions = dict(zip(df_predictions['ID'],
+                           df_predictions['delta_logit_psi'].astype(str)))
+    path = str(tmpdir.join('pred.vcf'))
+    benchmark(writeVCF, synthetic_vcf, path, predictions)
+
+
+@pytest.mark.benchmark(group='writers')
+def test_benchmark_annotate_vcf(benchmark, synthetic_vcf, df_predictions,
+                                tmpdir):
+    pytest.importorskip('pysam')
+    path = str(tmpdir.join('pred.vcf.gz'))
+    benchmark(annotate_vcf, synthetic_vcf, path, [df_predictions])
@@ -0,0 +1,52 @@
+import numpy as np
+from mmsplice import MMSplice
+from mmsplice.cache import PredictionCache, model_hash, MAX_QUERY_KEYS
+from mmsplice.exon_dataloader import SeqSpliter
+
+
+def test_PredictionCache(tmpdir):
+    model = MMSplice()
+    path = str(tmpdir.join('cache.sqlite'))
+    cache = PredictionCache(path, model)
+    assert cache.model_hash == model_hash(model)
+
+    key = cache.key('17:41197694-41197819:-', 100, 100,
+                    "17:41197805:ACATCTGCC:['A']")
+    assert cache.get(key) is None
+
+    ref = np.arange(5).reshape(1, 5)
+    cache.put_many([key], ref, ref + 5)
+    cache.close()
+
+    cache = PredictionCache(path, model)
+    np.testing.assert_array_equal(cache.get(key), np.arange(10))
+    assert cache.hits == 1
+
+    cache.model_hash = 'other model'
+    assert cache.get(key) is None
+    assert cache.misses == 1
+
+
+def test_PredictionCache_get_many(tmpdir):
+    model = MMSplice()
+    cache = PredictionCache(str(tmpdir.join('cache.sqlite')), model)
+    keys = ['17:1-100:+|100|100|17:%d:A:[\'C\']' % i
+            for i in range(2 * MAX_QUERY_KEYS + 1)]
+    ref = np.arange(len(keys) * 5).reshape(-1, 5)
+    cache.put_many(keys[::2], ref[::2], ref[::2] + 1)
+
+    scores = cache.get_many(keys + keys[:3])
+    assert sorted(scores) == sorted(keys[::2])
+    np.testing.assert_array_equal(scores[keys[2]], [10, 11, 12, 13, 14,
+                                                    11, 12, 13, 14, 15])
+    assert cache.hits == len(keys[::2])
+    assert cache.misses == len(keys[1::2])
+
+
+def test_model_hash_spliter():
+    model = MMSplice()
+    assert model_hash(model) == model_hash(model, SeqSpliter())
+    assert model_hash(model) == model_hash(
+        model, SeqSpliter(pattern_warning=True))
+    assert model_hash(model) != model_hash(
+        model, SeqSpliter(donor_intron_len=20))
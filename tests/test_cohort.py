@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from mmsplice import MMSplice, predict_all_table
+from mmsplice.vcf_dataloader import SplicingVCFDataloader
+from mmsplice.cohort import predict_cohort, write_matrix
+
+from conftest import gtf_file, fasta_file
+
+
+@pytest.fixture
+def cohort_vcf(tmpdir):
+    pysam = pytest.importorskip('pysam')
+    path = str(tmpdir.join('cohort.vcf'))
+    with open(path, 'w') as f:
+        f.write('##fileformat=VCFv4.2\n')
+        f.write('##contig=<ID=17,length=81195210>\n')
+        f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="GT">\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT'
+                '\ts0\ts1\ts2\ts3\n')
+        f.write('17\t41276033\t.\tC\tG\t.\t.\t.\tGT\t1|0\t1|0\t0|1\t0|0\n')
+        f.write('17\t41276132\t.\tA\tACT\t.\t.\t.\tGT\t0|0\t0|0\t0|1\t0|0\n')
+    return pysam.tabix_index(path, preset='vcf', force=True)
+
+
+def test_predict_cohort(cohort_vcf, tmpdir):
+    model = MMSplice()
+    # batch size of 1 to avoid padding of sequences of different exons
+    matrix, haplotypes = predict_cohort(model, gtf_file, fasta_file,
+                                        cohort_vcf, batch_size=1,
+                                        progress=False)
+    assert matrix.index.tolist() == ['s0', 's1', 's2', 's3']
+    assert (matrix.loc['s3'] == 0).all()
+
+    snv = "17:41276033:C:['G']"
+    df = haplotypes[haplotypes['haplotype'] == snv]
+    assert (df['n_samples'] >= 2).all()
+    # variants of a haplotype in the same exon are applied together
+    combined = haplotypes[haplotypes['haplotype'].str.contains(';')]
+    assert len(combined) > 0
+    assert (combined['n_samples'] == 1).all()
+
+    # samples with the same haplotype are scored once
+    np.testing.assert_allclose(matrix.loc['s0'], matrix.loc['s1'])
+
+    vcf = str(tmpdir.join('snv.vcf'))
+    with open(vcf, 'w') as f:
+        f.write('##fileformat=VCFv4.0\n')
+        f.write('##contig=<ID=17,length=81195210>\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        f.write('17\t41276033\t1\tC\tG\t.\t.\t.\n')
+    expected = predict_all_table(
+        model, SplicingVCFDataloader(gtf_file, fasta_file, vcf),
+        batch_size=1, progress=False).drop_duplicates('exons')
+    np.testing.assert_allclose(
+        matrix.loc['s0', expected['exons']].values,
+        expected['delta_logit_psi'].values, rtol=1e-4, atol=1e-4)
+
+    output = str(tmpdir.join('matrix.csv'))
+    write_matrix(matrix, output)
+    with open(output) as f:
+        assert f.readline().startswith('sample,')
@@ -1,6 +1,9 @@
+import pytest
+import numpy as np
 import pandas as pd
+from concise.preprocessing import encodeDNA
 from conftest import fasta_file, exon_file
-from mmsplice.exon_dataloader import ExonDataset
+from mmsplice.exon_dataloader import ExonDataset, encode_seqs
 
 
 def test_ExonDataset():
@@ -52,3 +55,38 @@ def test_ExonDataset__len__():
     dl = ExonDataset(exon_file, fasta_file)
     df = pd.read_csv(exon_file)
     assert len(dl) == df.shape[0]
+
+
+def test_ExonDataset_from_dataframe():
+    df = pd.read_csv(exon_file)
+    seqnames = df['seqnames'].copy()
+    dl = ExonDataset.from_dataframe(df, fasta_file, encode=False,
+                                    split_seq=False)
+    pd.testing.assert_series_equal(df['seqnames'], seqnames)
+    expected = ExonDataset(exon_file, fasta_file, encode=False,
+                           split_seq=False)
+    assert 'seqnames' in df.columns
+    assert len(dl) == len(expected)
+    assert dl[10] == expected[10]
+
+    arrays = {
+        k: df[k].values.copy()
+        for k in ['seqnames', 'start', 'end', 'strand',
+                  'hg19_variant_position', 'reference', 'variant']
+    }
+    dl = ExonDataset.from_arrays(arrays, fasta_file, encode=False,
+                                 split_seq=False)
+    assert dl[10] == expected[10]
+    # numeric columns are read without copying
+    for col, k in [('Exon_Start', 'start'), ('Exon_End', 'end'),
+                   ('POS', 'hg19_variant_position')]:
+        assert np.shares_memory(dl.exons[col].values, arrays[k])
+    assert arrays['seqnames'].dtype == np.int64
+
+
+def test_encode_seqs():
+    seqs = ['ACGTN', 'NNA', 'TTGCAGGTAN', 'G']
+    np.testing.assert_array_equal(encode_seqs(seqs), encodeDNA(seqs))
+
+    with pytest.raises(ValueError):
+        encode_seqs(['ACGU'])
@@ -1,5 +1,16 @@
 import json
+import time
+import socket
 from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from click.testing import CliRunner
+from mmsplice.main import cli
+from mmsplice.predict import worker_cpus
+from mmsplice.server import FROZEN_READY_TARGET
+
+from conftest import gtf_file, fasta_file
 
 
 def test_cli():
@@ -27,3 +38,173 @@ def test_cli():
 
     assert len(pred) == 12
     assert pred[10] != 0
+
+
+def test_cli_frozen(tmpdir):
+    frozen_path = str(tmpdir.join('mmsplice.pb'))
+    Popen(['mmsplice', 'freeze', '--out', frozen_path]).wait()
+
+    variant = {
+        'intronl_len': 10,
+        'intronr_len': 6,
+        'ref_seq': 'ACGT' * 30,
+        'alt_seq': 'ACGT' * 29 + 'AGT'
+    }
+    outputs = list()
+
+    for options in [{}, {'frozen': frozen_path}]:
+        start = time.monotonic()
+        process = Popen(['mmsplice', 'run'], stdin=PIPE, stdout=PIPE)
+        process.stdin.write((json.dumps(options) + '\n').encode())
+        process.stdin.flush()
+        assert process.stdout.readline().decode() == 'MMSPLICE-RESPONSE:1\n'
+        if 'frozen' in options:
+            assert time.monotonic() - start < FROZEN_READY_TARGET
+
+        process.stdin.write((json.dumps(variant) + '\n').encode())
+        process.stdin.flush()
+        out = process.stdout.readline().decode().strip()
+        process.terminate()
+        outputs.append(list(map(float, out.split(':')[1].split(','))))
+
+    np.testing.assert_almost_equal(outputs[0], outputs[1], decimal=5)
+
+
+def test_cli_batch():
+    process = Popen(['mmsplice', 'run'], stdin=PIPE, stdout=PIPE)
+
+    process.stdin.write((json.dumps({}) + '\n').encode())
+    process.stdin.flush()
+    assert process.stdout.readline().decode() == 'MMSPLICE-RESPONSE:1\n'
+
+    records = [
+        {
+            'intronl_len': 4,
+            'intronr_len': 4,
+            'ref_seq': 'A' * 100,
+            'alt_seq': 'T' * 100
+        },
+        {
+            'intronl_len': 10,
+            'intronr_len': 6,
+            'ref_seq': 'ACGT' * 30,
+            'alt_seq': 'ACGT' * 29 + 'AGT'
+        }
+    ]
+
+    process.stdin.write((json.dumps(records[1]) + '\n').encode())
+    process.stdin.flush()
+    single = process.stdout.readline().decode().strip()
+
+    process.stdin.write((json.dumps(records) + '\n').encode())
+    process.stdin.flush()
+    batch = [process.stdout.readline().decode().strip() for _ in records]
+    process.terminate()
+
+    preds = [list(map(float, out.split(':')[1].split(','))) for out in batch]
+    assert all(out.startswith('MMSPLICE-RESPONSE:') for out in batch)
+    assert all(len(pred) == 12 for pred in preds)
+
+    single = list(map(float, single.split(':')[1].split(',')))
+    np.testing.assert_almost_equal(preds[1], single, decimal=5)
+
+
+def test_cli_serve(tmpdir):
+    socket_path = str(tmpdir.join('mmsplice.sock'))
+    process = Popen(['mmsplice', 'serve', '--socket', socket_path,
+                     '--max-latency', '0.05'], stdout=PIPE)
+    assert process.stdout.readline().decode() == 'MMSPLICE-RESPONSE:1\n'
+
+    def _request(i):
+        record = {
+            'intronl_len': 4,
+            'intronr_len': 4,
+            'ref_seq': 'A' * 100,
+            'alt_seq': 'ACGT' * (i + 20)
+        }
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socket_path)
+        f = client.makefile('rw')
+        f.write(json.dumps([record, record]) + '\n')
+        f.flush()
+        out = [f.readline().strip() for _ in range(2)]
+        client.close()
+        return out
+
+    with ThreadPoolExecutor(4) as executor:
+        responses = list(executor.map(_request, range(8)))
+    process.terminate()
+
+    for out in responses:
+        assert out[0] == out[1]
+        assert out[0].startswith('MMSPLICE-RESPONSE:')
+        assert len(out[0].split(':')[1].split(',')) == 12
+
+
+def test_cli_predict(vcf_path, tmpdir):
+    runner = CliRunner()
+    args = ['predict', '--gtf', gtf_file, '--fasta', fasta_file,
+            '--vcf', vcf_path, '--vcf-batch-size', '3', '--no-progress']
+
+    output = str(tmpdir.join('pred.csv'))
+    result = runner.invoke(cli, args + ['--out', output, '--pathogenicity'])
+    assert result.exit_code == 0
+    df = pd.read_csv(output)
+    assert 'pathogenicity' in df.columns
+
+    shards = list()
+    for i in range(2):
+        output = str(tmpdir.join('pred%d.csv' % i))
+        result = runner.invoke(cli, args + ['--out', output,
+                                            '--shard', '%d/2' % i])
+        assert result.exit_code == 0
+        shards.append(pd.read_csv(output))
+
+    output = str(tmpdir.join('pred.parquet'))
+    result = runner.invoke(cli, args + ['--out', output, '--workers', '2'])
+    assert result.exit_code == 0
+    df_workers = pd.read_parquet(output)
+
+    cols = ['ID', 'exons', 'delta_logit_psi']
+    expected = df[cols].sort_values(cols[:2]).reset_index(drop=True)
+    for other in [pd.concat(shards), df_workers]:
+        other = other[cols].astype({'ID': str, 'exons': str}) \
+                           .sort_values(cols[:2]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(expected, other,
+                                      check_less_precise=True)
+
+    result = runner.invoke(cli, args + ['--out', output, '--shard', '2/2'])
+    assert result.exit_code != 0
+
+
+def test_worker_cpus():
+    assert worker_cpus(3, list(range(8))) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+
+
+def test_cli_tune(tmpdir):
+    runner = CliRunner()
+    output = str(tmpdir.join('tune.csv'))
+    result = runner.invoke(cli, [
+        'tune', '--gtf', gtf_file, '--fasta', fasta_file,
+        '--n-variants', '20', '--intra-op-threads', '1,2',
+        '--inter-op-threads', '1', '--batch-sizes', '8,16', '--out', output])
+    assert result.exit_code == 0
+    assert 'Best: --intra-op-threads' in result.output
+
+    df = pd.read_csv(output)
+    assert len(df) == 4
+    assert df['seqs_per_s'].is_monotonic_decreasing
+
+
+def test_cli_scan(tmpdir):
+    runner = CliRunner()
+    output = str(tmpdir.join('scan.csv'))
+    result = runner.invoke(cli, [
+        'scan', '--fasta', fasta_file, '--region', '17:41196301-41196500',
+        '--strand', '-', '--chunk-size', '64', '--out', output])
+    assert result.exit_code == 0
+
+    df = pd.read_csv(output)
+    assert len(df) == 200
+    assert df['Position'].tolist() == list(range(41196301, 41196501))
+    assert (df['Strand'] == '-').all()
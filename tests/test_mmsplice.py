@@ -1,12 +1,19 @@
 """Tests for `mmsplice` package."""
+import pytest
+import numpy as np
 import pandas as pd
 from concise.preprocessing import encodeDNA
 from mmsplice import MMSplice
 from mmsplice.vcf_dataloader import SplicingVCFDataloader
-from mmsplice.exon_dataloader import ExonDataset
-from mmsplice import predict_all_table
+from mmsplice.exon_dataloader import ExonDataset, encode_seqs
+from mmsplice import predict_all_table, predict_save, annotate_vcf
+from mmsplice.utils import max_varEff
+from mmsplice.predict import available_cpus
+from mmsplice.mmsplice import unique_exon_variant_pairs, freeze_model, \
+    FrozenMMSplice, read_checkpoint, set_cpu_affinity, predict_dataframe, \
+    predict_batch, exon_chunks, exon_seq_chunks
 
-from conftest import gtf_file, fasta_file, variants, exon_file
+from conftest import gtf_file, fasta_file, variants, exon_file, vcf_file
 
 
 def test_mmsplice():
@@ -17,8 +24,179 @@ def test_mmsplice():
     assert len(pred) == 5
 
 
-def test_predict_save(vcf_path):
-    pass
+def test_mmsplice_predict_many():
+    model = MMSplice()
+    rng = np.random.RandomState(0)
+    seqs = [''.join(rng.choice(list('ACGT'), n))
+            for n in rng.randint(60, 400, 20)]
+    overhangs = [[(50, 20), (100, 100), (4, 4)][i % 3]
+                 for i in range(len(seqs))]
+
+    expected = np.array([model.predict(seq, overhang)
+                         for seq, overhang in zip(seqs, overhangs)])
+    scores = model.predict_many(seqs, overhangs, batch_size=4)
+    assert scores.shape == (len(seqs), 5)
+    np.testing.assert_allclose(scores, expected, atol=1e-5)
+
+    scores = model.predict_many(seqs, (50, 20))
+    np.testing.assert_allclose(scores[0], model.predict(seqs[0], (50, 20)),
+                               atol=1e-5)
+
+
+def test_mmsplice_threads():
+    seq = 'ATGCGACGTACCCAGTAAATGGCATAGTCAG' * 4
+    overhang = (50, 20)
+    expected = MMSplice().predict(seq, overhang)
+    cpus = available_cpus()
+    try:
+        model = MMSplice(intra_op_threads=1, inter_op_threads=1,
+                         cpus=cpus[:1])
+        np.testing.assert_almost_equal(model.predict(seq, overhang),
+                                       expected, decimal=5)
+    finally:
+        set_cpu_affinity(cpus)
+
+
+def test_FrozenMMSplice(tmpdir):
+    seq = 'ATGCGACGTACCCAGTAAATGGCATAGTCAG' * 4
+    overhang = (50, 20)
+    model = MMSplice()
+    frozen_path = str(tmpdir.join('mmsplice.pb'))
+    freeze_model(model, frozen_path)
+
+    frozen = FrozenMMSplice(frozen_path)
+    np.testing.assert_almost_equal(frozen.predict(seq, overhang),
+                                   model.predict(seq, overhang), decimal=5)
+
+    # exons longer than chunk size are scored by keras exon module
+    frozen = FrozenMMSplice(frozen_path, exon_chunk_size=16)
+    seqs = [seq, seq[:90] + seq]
+    np.testing.assert_almost_equal(frozen.predict_many(seqs, overhang),
+                                   model.predict_many(seqs, overhang),
+                                   decimal=5)
+    assert frozen._exonM is not None
+
+
+def test_predict_save(vcf_path, tmpdir):
+    model = MMSplice()
+    dl = SplicingVCFDataloader(gtf_file, fasta_file, vcf_path)
+    output_csv = str(tmpdir.join('pred.csv'))
+    predict_save(model, dl, output_csv, pathogenicity=True)
+
+    df = pd.read_csv(output_csv)
+    assert df.shape[0] == len(variants) - 1
+    assert 'pathogenicity' in df.columns
+
+
+@pytest.mark.parametrize('output_format', ['parquet', 'arrow'])
+def test_predict_save_columnar(vcf_path, tmpdir, output_format):
+    pa = pytest.importorskip('pyarrow')
+    model = MMSplice()
+    dl = SplicingVCFDataloader(gtf_file, fasta_file, vcf_path)
+    output = str(tmpdir.join('pred.%s' % output_format))
+    predict_save(model, dl, output, batch_size=4)
+
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(output)
+    else:
+        table = pa.ipc.open_stream(output).read_all()
+
+    assert table.num_rows == len(variants) - 1
+    assert table.schema.field('delta_logit_psi').type == pa.float32()
+    assert pa.types.is_dictionary(table.schema.field('exons').type)
+
+
+class _KilledModel:
+
+    def __init__(self, model, n_batches):
+        self.model = model
+        self.n_batches = n_batches
+
+    def predict_on_batch(self, batch):
+        if self.n_batches == 0:
+            raise KeyboardInterrupt()
+        self.n_batches -= 1
+        return self.model.predict_on_batch(batch)
+
+
+@pytest.mark.parametrize("output_format", ['csv', 'arrow'])
+def test_predict_save_resume(tmpdir, output_format):
+    if output_format == 'arrow':
+        pytest.importorskip('pyarrow')
+    model = MMSplice()
+
+    def _dl():
+        return SplicingVCFDataloader(gtf_file, fasta_file, vcf_file,
+                                     vcf_batch_size=100)
+
+    expected = str(tmpdir.join('expected.%s' % output_format))
+    predict_save(model, _dl(), expected, batch_size=32, progress=False)
+
+    output = str(tmpdir.join('pred.%s' % output_format))
+    with pytest.raises(KeyboardInterrupt):
+        predict_save(_KilledModel(model, 21), _dl(), output, batch_size=32,
+                     progress=False, checkpoint=True)
+    checkpoint = read_checkpoint(output)
+    assert not checkpoint['done']
+    assert checkpoint['vcf_batch'] > 0
+
+    predict_save(model, _dl(), output, batch_size=32, progress=False,
+                 resume=True)
+    assert read_checkpoint(output)['done']
+
+    if output_format == 'csv':
+        pd.testing.assert_frame_equal(pd.read_csv(output),
+                                      pd.read_csv(expected))
+    else:
+        import pyarrow as pa
+
+        def _read(path):
+            # categories of dictionary columns depend on batches
+            df = pa.ipc.open_stream(path).read_pandas()
+            return df.apply(lambda col: col.astype(str)
+                            if col.dtype.name == 'category' else col)
+        pd.testing.assert_frame_equal(_read(output), _read(expected))
+
+
+def test_predict_save_resume_genes(multi_chrom_data, tmpdir):
+    gtf, fasta, vcf = multi_chrom_data
+    model = MMSplice()
+
+    def _dl():
+        return SplicingVCFDataloader(gtf, fasta, vcf, vcf_batch_size=20,
+                                     genes=['BRCA1'])
+
+    expected = str(tmpdir.join('expected.csv'))
+    predict_save(model, _dl(), expected, batch_size=32, progress=False)
+
+    output = str(tmpdir.join('pred.csv'))
+    with pytest.raises(KeyboardInterrupt):
+        predict_save(_KilledModel(model, 8), _dl(), output, batch_size=32,
+                     progress=False, checkpoint=True)
+    assert read_checkpoint(output)['vcf_batch'] > 0
+
+    predict_save(model, _dl(), output, batch_size=32, progress=False,
+                 resume=True)
+    df = pd.read_csv(output)
+    pd.testing.assert_frame_equal(df, pd.read_csv(expected))
+    assert df['ID'].str.split(':').str[0].unique().tolist() == ['2', '10']
+
+
+def test_annotate_vcf_genes(multi_chrom_data, tmpdir):
+    from cyvcf2 import VCF
+    gtf, fasta, vcf = multi_chrom_data
+    model = MMSplice()
+    dl = SplicingVCFDataloader(gtf, fasta, vcf, genes=['BRCA1'])
+    expected = predict_all_table(model, SplicingVCFDataloader(gtf, fasta, vcf),
+                                 progress=False)
+
+    vcf_out = str(tmpdir.join('out.vcf.gz'))
+    annotate_vcf(vcf, vcf_out, predict_batch(model, dl, progress=False))
+    annotated = [v.CHROM for v in VCF(vcf_out)
+                 if v.INFO.get('mmsplice_delta_logit_psi') is not None]
+    assert len(annotated) == expected['ID'].nunique()
+    assert set(annotated) == {'2', '10'}
 
 
 def test_predict_all_table(vcf_path):
@@ -31,6 +209,78 @@ def test_predict_all_table(vcf_path):
     assert len(df['delta_logit_psi']) == len(variants) - 1
 
 
+def test_predict_all_table_max_per_var(vcf_path):
+    model = MMSplice()
+    dl = SplicingVCFDataloader(gtf_file, fasta_file, vcf_path)
+    df = predict_all_table(model, dl, max_per_var=True)
+
+    assert df['ID'].is_unique
+    assert df.shape[0] == len(variants) - 1
+
+
+def test_predict_all_table_filter(vcf_path):
+    model = MMSplice()
+    # batch size of 1 to avoid padding of sequences of different exons
+    expected = predict_all_table(
+        model, SplicingVCFDataloader(gtf_file, fasta_file, vcf_path),
+        batch_size=1, progress=False, pathogenicity=True)
+    expected = expected[expected['delta_logit_psi'].abs() >= 0.1]
+    expected = max_varEff(expected)
+
+    df = predict_all_table(
+        model, SplicingVCFDataloader(gtf_file, fasta_file, vcf_path),
+        batch_size=1, progress=False, min_delta_logit_psi=0.1, top_k=1)
+    assert 'pathogenicity' not in df.columns
+    df = df.sort_values('ID').reset_index(drop=True)
+    expected = expected.sort_values('ID').reset_index(drop=True)
+    assert df['ID'].tolist() == expected['ID'].tolist()
+    np.testing.assert_allclose(df['delta_logit_psi'],
+                               expected['delta_logit_psi'])
+
+    df = predict_all_table(
+        model, SplicingVCFDataloader(gtf_file, fasta_file, vcf_path),
+        progress=False, pathogenicity=True, min_pathogenicity=0.5)
+    assert (df['pathogenicity'] >= 0.5).all()
+
+
+def test_predict_all_table_cache(vcf_path, tmpdir):
+    model = MMSplice()
+    cache = str(tmpdir.join('cache.sqlite'))
+
+    dl = SplicingVCFDataloader(gtf_file, fasta_file, vcf_path)
+    expected = predict_all_table(model, dl, pathogenicity=True)
+
+    dl = SplicingVCFDataloader(gtf_file, fasta_file, vcf_path)
+    df = predict_all_table(model, dl, pathogenicity=True, cache=cache)
+    assert dl.cache.hits == 0
+    pd.testing.assert_frame_equal(df, expected)
+
+    dl = SplicingVCFDataloader(gtf_file, fasta_file, vcf_path)
+    df = predict_all_table(model, dl, pathogenicity=True, cache=cache)
+    assert dl.cache.misses == 0
+    assert dl.n_unique_pairs == 0
+    # pairs read from cache are counted as deduplicated
+    assert dl.n_pairs == len(df)
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_unique_exon_variant_pairs():
+    metadata = {
+        'exon': {
+            'annotation': np.array(['17:10-20:+', '17:10-20:+', '17:30-40:+']),
+            'left_overhang': np.array([100, 100, 100]),
+            'right_overhang': np.array([100, 100, 100]),
+            'transcript_id': np.array(['T1', 'T2', 'T1'])
+        },
+        'variant': {
+            'STR': np.array(["17:15:A:['G']"] * 3)
+        }
+    }
+    unique_idx, inverse = unique_exon_variant_pairs(metadata)
+    np.testing.assert_array_equal(unique_idx, [0, 2])
+    np.testing.assert_array_equal(inverse, [0, 0, 1])
+
+
 def test_predict_all_table_exon_dataloader(vcf_path):
     model = MMSplice()
     df_exons = pd.read_csv(exon_file)
@@ -41,6 +291,17 @@ def test_predict_all_table_exon_dataloader(vcf_path):
     assert len(df['delta_logit_psi']) == df_exons.shape[0]
 
 
+def test_predict_dataframe():
+    model = MMSplice()
+    df_exons = pd.read_csv(exon_file)
+    expected = predict_all_table(model, ExonDataset(exon_file, fasta_file),
+                                 pathogenicity=True)
+    df = pd.concat(predict_dataframe(model, df_exons, fasta_file,
+                                     pathogenicity=True))
+    pd.testing.assert_frame_equal(df.reset_index(drop=True),
+                                  expected.reset_index(drop=True))
+
+
 def test_exon_model_masking():
     model = MMSplice()
 
@@ -52,3 +313,31 @@ def test_exon_model_masking():
 
     for i in preds:
         assert abs(preds[0] - i) < 1e-6
+
+
+def test_exon_model_chunks():
+    model = MMSplice(exon_chunk_size=16, exon_chunk_batch=3)
+    rng = np.random.RandomState(0)
+    exons = [''.join(rng.choice(list('ACGT'), n)) for n in (100, 37, 16, 5)]
+    exons.append('ACGTNNACGTAGGTCANNNNCAGT' * 3)
+    x = encodeDNA(exons)
+
+    np.testing.assert_allclose(model.predict_exon(x),
+                               model.exonM.predict(x), atol=1e-5)
+    # sequences are chunked before encoding
+    np.testing.assert_allclose(model.predict_exon(exons),
+                               model.exonM.predict(x), atol=1e-5)
+
+
+def test_exon_seq_chunks():
+    rng = np.random.RandomState(0)
+    exons = [''.join(rng.choice(list('ACGT'), n)) for n in (100, 37, 5, 0)]
+    exons.append('ACGTNNACGTAGGTCANNNNCAGT' * 3)
+    x = encode_seqs(exons)
+    assert x.dtype == np.float32
+
+    chunks, owners, cores = exon_seq_chunks(exons, 16, 4)
+    expected = exon_chunks(x, 16, 4)
+    np.testing.assert_array_equal(encode_seqs(chunks), expected[0])
+    np.testing.assert_array_equal(owners, expected[1])
+    np.testing.assert_array_equal(cores, expected[2])
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+from mmsplice import MMSplice, predict_all_table
+from mmsplice.vcf_dataloader import SplicingVCFDataloader
+from mmsplice.precompute import precompute_snvs, SNVScoreTable, \
+    lookup_vcf, BASES
+
+from conftest import gtf_file, fasta_file, variants, parse_vcf_id
+
+
+def test_precompute_snvs_lookup_vcf(tmpdir):
+    # only exons at the end of BRCA1 to keep table small
+    gtf = str(tmpdir.join('test.gtf'))
+    with open(gtf_file) as f_in, open(gtf, 'w') as f_out:
+        for line in f_in:
+            cols = line.split('\t')
+            if cols[2] != 'exon' or int(cols[3]) > 41267000:
+                f_out.write(line)
+
+    model = MMSplice()
+    table = str(tmpdir.join('snvs'))
+    precompute_snvs(model, gtf, fasta_file, table, progress=False)
+
+    score_table = SNVScoreTable(table)
+    exons = score_table.exons
+    assert exons['Start'].is_monotonic_increasing
+    assert np.all((score_table.refs < 4) | (score_table.refs == 255))
+
+    # every 50th position of exons with each alternative base
+    records = list()
+    for exon in exons.itertuples():
+        for i in range(0, exon.End - exon.Start, 50):
+            code = score_table.refs[exon.ref_offset + i]
+            if code < 4:
+                records.append(('17', int(exon.Start + i), BASES[code],
+                                BASES[(code + 1 + i // 50 % 3) % 4]))
+    records = sorted(set(records))
+    assert len(score_table.lookup(*records[0])) > 0
+    score_table.close()
+
+    records += [(chrom, int(pos), ref, alt)
+                for chrom, pos, ref, alt in map(parse_vcf_id, variants)]
+
+    vcf = str(tmpdir.join('test.vcf'))
+    with open(vcf, 'w') as f:
+        f.write('##fileformat=VCFv4.0\n')
+        f.write('##contig=<ID=13,length=115169878>\n')
+        f.write('##contig=<ID=17,length=81195210>\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for record in sorted(records):
+            f.write('%s\t%d\t1\t%s\t%s\t.\t.\t.\n' % record)
+
+    # batch size of 1 to avoid padding of sequences of different exons
+    df = pd.concat(lookup_vcf(table, vcf, gtf, fasta_file, model=model,
+                              batch_size=1))
+    df_model = predict_all_table(model, SplicingVCFDataloader(
+        gtf, fasta_file, vcf), batch_size=1, progress=False)
+
+    cols = ['ID', 'exons', 'delta_logit_psi']
+    df = df.drop_duplicates(cols).sort_values(cols)
+    df_model = df_model.drop_duplicates(cols).sort_values(cols)
+    assert df['ID'].tolist() == df_model['ID'].tolist()
+    assert df['exons'].tolist() == df_model['exons'].tolist()
+    np.testing.assert_allclose(df['delta_logit_psi'],
+                               df_model['delta_logit_psi'],
+                               rtol=1e-5, atol=1e-4)
@@ -0,0 +1,55 @@
+import json
+from mmsplice import MMSplice, predict_save
+from mmsplice.vcf_dataloader import SplicingVCFDataloader
+from mmsplice.profiling import Profiler, stage, start_profiling, \
+    stop_profiling, active_profiler, merge_reports
+
+from conftest import gtf_file, fasta_file, variants
+
+
+def test_stage():
+    assert active_profiler() is None
+    with stage('split') as s:
+        s.items = 10
+
+    profiler = start_profiling()
+    for _ in range(3):
+        with stage('split') as s:
+            s.items = 10
+    assert stop_profiling() is profiler
+    assert active_profiler() is None
+
+    report = profiler.report()
+    assert report['stages']['split']['calls'] == 3
+    assert report['stages']['split']['items'] == 30
+    assert report['peak_rss_mb'] > 0
+
+
+def test_merge_reports(tmpdir):
+    paths = [str(tmpdir.join('%d.json' % i)) for i in range(3)]
+    for path in paths[:2]:
+        profiler = Profiler()
+        profiler.add('extract', 1., 100)
+        profiler.save(path)
+
+    merge_reports(paths, str(tmpdir.join('profile.json')))
+    with open(str(tmpdir.join('profile.json'))) as f:
+        report = json.load(f)
+    assert report['stages']['extract'] == {
+        'time': 2., 'calls': 2, 'items': 200, 'items_per_s': 100.}
+
+
+def test_predict_save_profile(vcf_path, tmpdir):
+    model = MMSplice()
+    dl = SplicingVCFDataloader(gtf_file, fasta_file, vcf_path)
+    profile = str(tmpdir.join('profile.json'))
+    predict_save(model, dl, str(tmpdir.join('pred.csv')), profile=profile)
+    assert active_profiler() is None
+
+    with open(profile) as f:
+        report = json.load(f)
+    stages = report['stages']
+    assert stages['write']['items'] == len(variants) - 1
+    for name in ['read_vcf', 'join', 'extract', 'split', 'encode',
+                 'inference.exon', 'heads']:
+        assert stages[name]['calls'] > 0
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pybedtools import Interval
+from kipoiseq.extractors import FastaStringExtractor
+from mmsplice import MMSplice
+from mmsplice.exon_dataloader import encode_seqs
+from mmsplice.scan import scan_region, sliding_module, SCAN_COLUMNS
+
+from conftest import fasta_file
+
+
+@pytest.mark.parametrize('strand', ['+', '-'])
+def test_scan_region(strand):
+    model = MMSplice()
+    start, end = 41196300, 41196500
+    df = pd.concat(scan_region(model, fasta_file, '17', start, end, strand,
+                               chunk_size=64, batch_size=50))
+    assert df.columns.tolist() == SCAN_COLUMNS
+    np.testing.assert_array_equal(df['Position'],
+                                  np.arange(start + 1, end + 1))
+    df = df.set_index('Position')
+
+    # exon of zero-based [41196340, 41196412) scored with its sequence
+    exon_start, exon_end = 41196340, 41196412
+    fasta = FastaStringExtractor(fasta_file)
+    seq = fasta.extract(Interval('17', exon_start - 100, exon_end + 100,
+                                 strand=strand)).upper()
+    scores = model.predict(seq, (100, 100))
+
+    if strand == '+':
+        acceptor, donor = exon_start + 1, exon_end
+    else:
+        acceptor, donor = exon_end, exon_start + 1
+    assert abs(df.loc[acceptor, 'acceptor'] - scores[1]) < 1e-4
+    assert abs(df.loc[donor, 'donor'] - scores[3]) < 1e-4
+
+
+def test_sliding_module():
+    model = MMSplice()
+    rng = np.random.RandomState(0)
+    x = encode_seqs([''.join(rng.choice(list('ACGTN'), 300))])[0]
+
+    for module in [model.acceptorM, model.donorM]:
+        window, score = sliding_module(module)
+        windows = np.stack([x[i:i + window]
+                            for i in range(len(x) - window + 1)])
+        np.testing.assert_allclose(score(x), module.predict(windows)[:, 0],
+                                   rtol=1e-4, atol=1e-6)
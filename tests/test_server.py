@@ -0,0 +1,165 @@
+import json
+import asyncio
+import numpy as np
+from mmsplice.server import load_model, score_records, LatencyStats, \
+    ScoreCache, ScoringServer
+
+
+def test_LatencyStats():
+    stats = LatencyStats(size=100)
+    for i in range(1, 201):
+        stats.add(i / 1000)
+
+    assert stats.n_requests == 200
+    assert len(stats.latencies) == 100
+
+    percentiles = stats.percentiles()
+    assert list(percentiles) == ['p50', 'p90', 'p99', 'p100']
+    np.testing.assert_almost_equal(percentiles['p100'], 200)
+    np.testing.assert_almost_equal(percentiles['p50'], 150.5)
+    assert str(stats).startswith('latency of 200 requests (ms): p50=150.50')
+
+
+def test_ScoreCache():
+    model = load_model()
+    cache = ScoreCache(maxsize=3)
+    records = [
+        {
+            'intronl_len': 4,
+            'intronr_len': 4,
+            'ref_seq': 'A' * 100,
+            'alt_seq': 'ACGT' * (i + 20)
+        }
+        for i in range(3)
+    ]
+
+    scores = score_records(model, records, cache)
+    assert cache.hits == 2
+    assert cache.misses == 4
+    assert len(cache.scores) == 3
+
+    np.testing.assert_almost_equal(
+        scores, score_records(model, records), decimal=5)
+
+    # ref sequence was least recently inserted so it is evicted
+    score_records(model, records[-1:], cache)
+    assert cache.hits == 3
+    assert cache.misses == 5
+
+
+def test_ScoringServer_handle():
+    model = load_model()
+    server = ScoringServer(model, max_batch_size=4, max_latency=0.01)
+
+    records = [
+        {
+            'intronl_len': 4,
+            'intronr_len': 4,
+            'ref_seq': 'A' * 100,
+            'alt_seq': 'ACGT' * (i + 20)
+        }
+        for i in range(5)
+    ]
+    lines = [json.dumps(records[0]).encode(),
+             json.dumps(records[1:]).encode(),
+             b'not json', b'']
+    responses = list()
+
+    async def readline():
+        return lines.pop(0)
+
+    async def write(data):
+        responses.append(data.decode())
+
+    server.batcher.start()
+    asyncio.get_event_loop().run_until_complete(
+        server.handle(readline, write))
+    server.batcher.stop()
+
+    assert server.latency.n_requests == 3
+    assert responses[-1].startswith('MMSPLICE-RESPONSE:ERROR:')
+
+    preds = [list(map(float, line.split(':')[1].split(',')))
+             for line in ''.join(responses[:-1]).splitlines()]
+    np.testing.assert_almost_equal(
+        preds, score_records(model, records), decimal=5)
+
+
+class _FailingModel:
+
+    def __init__(self, model):
+        self.model = model
+        self.spliter = model.spliter
+
+    def predict_many(self, seqs, overhangs):
+        raise RuntimeError('inference failed')
+
+
+def test_ScoringServer_handle_failure():
+    model = load_model()
+    server = ScoringServer(_FailingModel(model), cache_size=0)
+    records = [
+        {
+            'intronl_len': 4,
+            'intronr_len': 4,
+            'ref_seq': 'A' * 100,
+            'alt_seq': 'ACGT' * (i + 20)
+        }
+        for i in range(3)
+    ]
+    lines = [json.dumps(records).encode(), b'[1, 2', b'"record"', b'']
+    responses = list()
+
+    async def readline():
+        return lines.pop(0)
+
+    async def write(data):
+        responses.append(data.decode())
+
+    server.batcher.start()
+    asyncio.get_event_loop().run_until_complete(
+        server.handle(readline, write))
+    server.batcher.stop()
+
+    # one empty response per record of failed batch request
+    assert responses[0] == 'MMSPLICE-RESPONSE:\n' * 3
+    # single error line for requests which cannot be parsed
+    assert responses[1].startswith('MMSPLICE-RESPONSE:ERROR:')
+    assert responses[2].startswith('MMSPLICE-RESPONSE:ERROR:')
+    assert all(r.count('\n') == 1 for r in responses[1:])
+
+
+def test_ScoringServer_handle_isolates_requests():
+    model = load_model()
+    server = ScoringServer(model, max_batch_size=16, max_latency=0.05,
+                           cache_size=0)
+    record = {
+        'intronl_len': 4,
+        'intronr_len': 4,
+        'ref_seq': 'A' * 100,
+        'alt_seq': 'ACGT' * 20
+    }
+    # invalid bases fail in the micro batch, missing key before it
+    invalid = dict(record, alt_seq='XYZ' * 30)
+    missing = {k: v for k, v in record.items() if k != 'ref_seq'}
+    lines = [json.dumps(record).encode(), json.dumps(invalid).encode(),
+             json.dumps([record, missing]).encode(), b'']
+    responses = list()
+
+    async def readline():
+        return lines.pop(0)
+
+    async def write(data):
+        responses.append(data.decode())
+
+    server.batcher.start()
+    asyncio.get_event_loop().run_until_complete(
+        server.handle(readline, write))
+    server.batcher.stop()
+
+    expected = score_records(model, [record])[0]
+    np.testing.assert_almost_equal(
+        list(map(float, responses[0].split(':')[1].split(','))),
+        expected, decimal=5)
+    assert responses[1] == 'MMSPLICE-RESPONSE:\n'
+    assert responses[2] == 'MMSPLICE-RESPONSE:\n' * 2
@@ -1,7 +1,13 @@
+import pytest
+import numpy as np
+import pandas as pd
 import pyranges
 from pybedtools import Interval
 from mmsplice.utils import pyrange_remove_chr_from_chrom_annotation, Variant, \
-    left_normalized, get_var_side
+    left_normalized, get_var_side, max_varEff, VarEffAccumulator, \
+    read_vep, read_vep_chunks, VEP_KEYS, predict_heads, transform, \
+    load_heads, export_heads, LINEAR_MODEL_FILE, LOGISTIC_MODEL_FILE, \
+    EFFICIENCY_MODEL_FILE, top_k_mask, EffectFilter
 
 
 def test_pyrange_remove_chr_to_chrom_annotation():
@@ -51,3 +57,141 @@ def test_get_var_side():
 
     variant = Variant('chr1', 20, 'A', 'AGG')
     assert get_var_side(variant, exon) == 'left'
+
+
+def _predictions():
+    return pd.DataFrame({
+        'ID': ['a', 'b', 'a', 'b', 'c', 'a'],
+        'exons': ['e1', 'e2', 'e3', 'e4', 'e5', 'e6'],
+        'delta_logit_psi': [0.5, 1., -2., 1., 0., 2.]
+    })
+
+
+def test_max_varEff():
+    df = max_varEff(_predictions())
+    assert df['ID'].tolist() == ['a', 'b', 'c']
+    assert df['exons'].tolist() == ['e3', 'e2', 'e5']
+    np.testing.assert_array_equal(df['delta_logit_psi'], [-2., 1., 0.])
+
+
+def test_VarEffAccumulator():
+    df = _predictions()
+    acc = VarEffAccumulator(min_compact_size=1)
+    for i in range(0, df.shape[0], 2):
+        acc.update(df.iloc[i:i + 2])
+    pd.testing.assert_frame_equal(acc.to_df(), max_varEff(df))
+
+
+def test_top_k_mask():
+    ids = np.array(['a', 'a', 'a', 'b', 'c', 'c'])
+    effect = np.array([1, -3, 2, np.nan, 0.5, np.nan])
+    np.testing.assert_array_equal(
+        top_k_mask(ids, effect, 1),
+        [False, True, False, True, True, False])
+
+
+def test_EffectFilter():
+    ids = np.repeat(['v%d' % i for i in range(20)], 5)
+    effect = np.random.RandomState(0).randn(len(ids)) * 2
+    df = pd.DataFrame({'ID': ids, 'delta_logit_psi': effect})
+
+    expected = df[np.abs(effect) >= 1]
+    expected = expected[top_k_mask(expected['ID'].values,
+                                   expected['delta_logit_psi'].values, 2)]
+
+    # rows of variants are split across batches
+    effect_filter = EffectFilter(min_delta_logit_psi=1, top_k=2)
+    dfs = list()
+    for i in range(0, len(df), 7):
+        batch = df.iloc[i:i + 7]
+        idx = effect_filter.select(batch['ID'].values, {
+            'delta_logit_psi': batch['delta_logit_psi'].values})
+        dfs.append(effect_filter.merge(
+            batch.iloc[idx].reset_index(drop=True), None,
+            batch['ID'].iloc[-1])[0])
+    dfs.append(effect_filter.flush()[0])
+
+    pd.testing.assert_frame_equal(pd.concat(dfs, ignore_index=True),
+                                  expected.reset_index(drop=True))
+    assert effect_filter.n_kept == len(expected)
+
+
+@pytest.fixture
+def vep_output_path(tmpdir):
+    fields = ['mmsplice_' + k.replace('Intron', '_intron') for k in VEP_KEYS]
+    csq = '|'.join(['Allele', 'Feature'] + fields)
+    pred = '|'.join(['1.5'] * (len(VEP_KEYS) - 1) + [''])
+    empty = '|'.join([''] * len(VEP_KEYS))
+
+    path = str(tmpdir.join('vep.vcf'))
+    with open(path, 'w') as f:
+        f.write('##fileformat=VCFv4.1\n')
+        f.write('##INFO=<ID=CSQ,Number=.,Type=String,Description='
+                '"Consequence annotations. Format: %s">\n' % csq)
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        f.write('17\t10\t.\tA\tG\t.\t.\tCSQ=G|T1|%s,G|T2|%s\n'
+                % (pred, empty))
+        f.write('17\t20\t.\tA\tG\t.\t.\tAC=1;CSQ=G|T1|%s,G|T2|%s\n'
+                % (pred, pred.replace('1.5', '-3')))
+        f.write('17\t30\t.\tA\tG\t.\t.\tAC=1\n')
+    return path
+
+
+def test_read_vep(vep_output_path):
+    df = read_vep(vep_output_path)
+    assert df.shape == (3, len(VEP_KEYS) + 1)
+    assert df['ID'].tolist() == ["17:10:A:['G']"] + ["17:20:A:['G']"] * 2
+    assert df['ref_exon'].tolist() == [0, 0, 0]
+    assert df['delta_logit_psi'].tolist() == [1.5, 1.5, -3]
+
+    df = read_vep(vep_output_path, max_per_var=True)
+    assert df.loc["17:20:A:['G']", 'delta_logit_psi'] == -3
+
+
+def test_read_vep_chunks(vep_output_path):
+    chunks = list(read_vep_chunks(vep_output_path, chunksize=1))
+    assert [i.shape[0] for i in chunks] == [1, 2]
+
+
+@pytest.fixture
+def modular_scores():
+    rng = np.random.RandomState(0)
+    X_ref = rng.randn(1000, 5).astype(np.float32)
+    # unchanged modules have zero difference
+    X_alt = X_ref + rng.randn(1000, 5).astype(np.float32) \
+        * (rng.rand(1000, 5) > 0.5)
+    return X_ref, X_alt
+
+
+def test_predict_heads(modular_scores):
+    from sklearn.externals import joblib
+    X_ref, X_alt = modular_scores
+    heads = predict_heads(X_ref, X_alt, pathogenicity=True,
+                          splicing_efficiency=True)
+    assert list(heads) == ['delta_logit_psi', 'pathogenicity', 'efficiency']
+
+    X = transform(X_alt - X_ref)
+    np.testing.assert_allclose(
+        heads['delta_logit_psi'],
+        joblib.load(LINEAR_MODEL_FILE).predict(X), rtol=1e-6)
+    np.testing.assert_allclose(
+        heads['efficiency'],
+        joblib.load(EFFICIENCY_MODEL_FILE).predict(X[:, [1, 2, 3, 5]]),
+        rtol=1e-6)
+    X = transform(X_alt - X_ref, region_only=True)
+    np.testing.assert_allclose(
+        heads['pathogenicity'],
+        joblib.load(LOGISTIC_MODEL_FILE).predict_proba(
+            np.concatenate([X_ref, X_alt, X[:, -3:]], axis=-1))[:, 1],
+        rtol=1e-6)
+
+
+def test_export_heads(tmpdir, modular_scores):
+    path = str(tmpdir.join('heads.npz'))
+    export_heads(path)
+    X = transform(modular_scores[1] - modular_scores[0])
+    linear, _, efficiency = load_heads(path)
+    np.testing.assert_allclose(linear.predict(X),
+                               load_heads()[0].predict(X))
+    np.testing.assert_allclose(efficiency.predict(X[:, [1, 2, 3, 5]]),
+                               load_heads()[2].predict(X[:, [1, 2, 3, 5]]))
@@ -1,9 +1,11 @@
 import numpy as np
+import pytest
 from kipoiseq.extractors import MultiSampleVCF
 from mmsplice.utils import Variant
 from mmsplice.vcf_dataloader import SplicingVCFDataloader, \
     read_exon_pyranges, batch_iter_vcf, variants_to_pyranges, \
-    read_vcf_pyranges
+    read_vcf_pyranges, group_exon_variant_pairs, read_exons, subset_exons, \
+    exon_regions
 
 from conftest import gtf_file, fasta_file, snps, deletions, \
     insertions, variants, vcf_file
@@ -41,6 +43,19 @@ def test_read_vcf_pyranges(vcf_path):
     assert sum(i.df.shape[0] for i in batchs) == len(variants)
 
 
+def test_read_vcf_pyranges_shard(vcf_path):
+    batchs = [
+        list(read_vcf_pyranges(vcf_path, batch_size=3, shard=(i, 2)))
+        for i in range(2)
+    ]
+    assert len(batchs[0]) == 3
+    assert len(batchs[1]) == 2
+
+    ids = sorted(str(v) for shard in batchs
+                 for batch in shard for v in batch.df['variant'])
+    assert ids == sorted(str(v) for v in MultiSampleVCF(vcf_path))
+
+
 def test_SplicingVCFDataloader__chech_chrom_annotation():
     dl = SplicingVCFDataloader('grch37', fasta_file, vcf_file)
     chroms = {str(i) for i in range(1, 22)}.union(['X', 'Y', 'M'])
@@ -412,3 +427,98 @@ def test_splicing_vcf_loads_insertions(vcf_path):
         print(d['metadata']['exon']['end'])
         assert d['inputs']['seq'] == expected_snps_seq[i]['seq']
         assert d['inputs']['mut_seq'] == expected_snps_seq[i]['alt_seq']
+
+
+def test_group_exon_variant_pairs(vcf_path):
+    dl = SplicingVCFDataloader(gtf_file, fasta_file, vcf_path)
+    pr_variants = next(read_vcf_pyranges(vcf_path))
+    df = pr_variants.join(dl.pr_exons, suffix="_exon").df
+    df_grouped = group_exon_variant_pairs(df)
+
+    assert df_grouped.shape == df.shape
+    keys = list(zip(df_grouped['Start_exon'], df_grouped['End_exon'],
+                    df_grouped['Start'], df_grouped['End']))
+    # duplicated pairs are consecutive
+    seen = set()
+    for i, key in enumerate(keys):
+        if key in seen:
+            assert keys[i - 1] == key
+        seen.add(key)
+
+
+def test_SplicingVCFDataloader_dedup(vcf_path):
+    dl = SplicingVCFDataloader(gtf_file, fasta_file, vcf_path,
+                               split_seq=False, encode=False)
+    rows = list(dl)
+    assert dl.n_pairs == len(rows)
+    assert dl.n_unique_pairs <= dl.n_pairs
+    assert dl.dedup_ratio >= 1
+
+
+def _pairs(dl):
+    return sorted((row['metadata']['variant']['STR'],
+                   row['metadata']['exon']['annotation'])
+                  for row in dl)
+
+
+def test_subset_exons():
+    pr_exons = read_exons(gtf_file)
+    assert len(subset_exons(pr_exons, genes=['BRCA1']).df) \
+        == len(pr_exons.df)
+    assert len(subset_exons(pr_exons, genes=['ENSG00000012048.20']).df) \
+        == len(pr_exons.df)
+    with pytest.raises(ValueError):
+        subset_exons(pr_exons, genes=['TP53'])
+
+    regions = exon_regions(pr_exons)
+    assert regions == sorted(regions, key=lambda r: int(r.split(':')[1]
+                                                        .split('-')[0]))
+
+
+def test_SplicingVCFDataloader_genes(vcf_path):
+    kwargs = dict(split_seq=False, encode=False)
+    dl = SplicingVCFDataloader(gtf_file, fasta_file, vcf_path,
+                               genes=['BRCA1'], **kwargs)
+    assert _pairs(dl) == _pairs(SplicingVCFDataloader(
+        gtf_file, fasta_file, vcf_path, **kwargs))
+
+
+def test_SplicingVCFDataloader_bed(tmpdir):
+    bed = str(tmpdir.join('regions.bed'))
+    with open(bed, 'w') as f:
+        f.write('track name=panel\n')
+        f.write('17\t41197000\t41197100\n')
+
+    kwargs = dict(split_seq=False, encode=False)
+    dl = SplicingVCFDataloader(gtf_file, fasta_file, vcf_file,
+                               bed=bed, **kwargs)
+    pairs = _pairs(dl)
+    assert len(pairs) > 0
+
+    exons = {annotation for _, annotation in pairs}
+    for annotation in exons:
+        start, end = map(int, annotation.split(':')[1].split('-'))
+        # exons with overhang of 100 overlap region
+        assert start - 100 < 41197100 and end + 100 > 41197000
+    expected = [(v, annotation) for v, annotation in _pairs(
+        SplicingVCFDataloader(gtf_file, fasta_file, vcf_file, **kwargs))
+        if annotation in exons]
+    assert pairs == expected
+
+
+def test_SplicingVCFDataloader_genes_vcf_order(multi_chrom_data):
+    gtf, fasta, vcf = multi_chrom_data
+    pr_exons = read_exons(gtf)
+    assert [r.split(':')[0] for r in exon_regions(pr_exons)][0] == '10'
+    assert [r.split(':')[0] for r in exon_regions(
+        pr_exons, ['2', '10'])][0] == '2'
+
+    kwargs = dict(split_seq=False, encode=False)
+    dl = SplicingVCFDataloader(gtf, fasta, vcf, genes=['BRCA1'], **kwargs)
+    chroms = [row['metadata']['variant']['CHROM'] for row in dl]
+    # variants are loaded in order of contigs of vcf
+    assert chroms == sorted(chroms, key=['2', '10'].index)
+    assert set(chroms) == {'2', '10'}
+    assert _pairs(SplicingVCFDataloader(gtf, fasta, vcf, genes=['BRCA1'],
+                                        **kwargs)) \
+        == _pairs(SplicingVCFDataloader(gtf, fasta, vcf, **kwargs))
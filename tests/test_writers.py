@@ -0,0 +1,90 @@
+import pytest
+import pandas as pd
+from mmsplice.writers import table_writer, infer_output_format, \
+    concat_tables, VCFAnnotator, annotate_vcf, _import_optional
+
+from conftest import vcf_file
+
+
+def test_infer_output_format():
+    assert infer_output_format('pred.csv') == 'csv'
+    assert infer_output_format('pred.parquet') == 'parquet'
+    assert infer_output_format('pred.arrow') == 'arrow'
+    assert infer_output_format('pred') == 'csv'
+
+
+def test_table_writer_csv(tmpdir):
+    df = pd.DataFrame({'ID': ['a', 'b'], 'delta_logit_psi': [0.1, -1.]})
+    path = str(tmpdir.join('pred.csv'))
+
+    with table_writer(path) as writer:
+        writer.write(df)
+        writer.write(df)
+
+    assert pd.read_csv(path).shape == (4, 2)
+
+
+def test_table_writer_unknown_format(tmpdir):
+    with pytest.raises(ValueError):
+        table_writer(str(tmpdir.join('pred.csv')), 'xlsx')
+
+
+def test_import_optional():
+    with pytest.raises(ImportError, match=r'mmsplice\[arrow\]'):
+        _import_optional('pyarrow_missing', 'arrow', 'arrow output')
+
+
+def test_concat_tables(tmpdir):
+    df = pd.DataFrame({'ID': ['a', 'b'], 'delta_logit_psi': [0.1, -1.]})
+    paths = [str(tmpdir.join('part%d.csv' % i)) for i in range(3)]
+
+    for path in paths[:2]:
+        with table_writer(path) as writer:
+            writer.write(df)
+
+    output = str(tmpdir.join('pred.csv'))
+    concat_tables(paths, output)
+
+    pd.testing.assert_frame_equal(pd.read_csv(output),
+                                  pd.concat([df, df], ignore_index=True))
+
+
+def _predictions(ids):
+    return pd.DataFrame({
+        'ID': [i for i in ids for _ in range(2)],
+        'exons': ['17:10-20:+', '17:30-40:+'] * len(ids),
+        'delta_logit_psi': [0.5, -1.] * len(ids)
+    })
+
+
+def test_VCFAnnotator():
+    ids = ["17:10:A:['G']", "17:20:A:['G']"]
+    df = _predictions(ids)
+    # variant predictions are split between batches
+    annotator = VCFAnnotator([df.iloc[:3], df.iloc[3:]])
+
+    assert annotator.info('17', 5, "17:5:A:['G']") is None
+    assert annotator.info('17', 10, ids[0]) == \
+        'mmsplice_exons=17:10-20:+,17:30-40:+;' \
+        'mmsplice_delta_logit_psi=0.5,-1'
+    assert annotator.info('17', 20, ids[1]).startswith(
+        'mmsplice_exons=17:10-20:+,17:30-40:+')
+    assert len(annotator.pending) == 0
+
+
+def test_annotate_vcf(tmpdir):
+    from cyvcf2 import VCF
+    variants = ["%s:%d:%s:['%s']" % (v.CHROM, v.POS, v.REF, v.ALT[0])
+                for v in VCF(vcf_file)]
+    df = _predictions(variants[::2])
+    batches = [df.iloc[i:i + 7] for i in range(0, df.shape[0], 7)]
+
+    vcf_out = str(tmpdir.join('out.vcf.gz'))
+    annotate_vcf(vcf_file, vcf_out, batches)
+
+    annotated = [v.INFO.get('mmsplice_delta_logit_psi')
+                 for v in VCF(vcf_out)]
+    assert len(annotated) == len(variants)
+    assert annotated[0] == (0.5, -1.)
+    assert annotated[1] is None
+    assert tmpdir.join('out.vcf.gz.tbi').check()